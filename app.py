@@ -1,15 +1,42 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import concurrent.futures
+import contextvars
+import copy
 import flask
+import hashlib
 from markupsafe import Markup
+import math
 import mwapi  # type: ignore
 import random
+import re
 import string
+import sys
+import threading
+import time
 import toolforge
-from typing import Mapping, Optional, Sequence
+from typing import Any, Callable, Iterable, Iterator, Mapping, Optional, \
+    Sequence, Tuple, TypeVar, Union
+import urllib.parse
 import yaml
+from werkzeug.datastructures import MultiDict
 
-from pagepile import load_pagepile, create_pagepile
+from cache import make_cache
+from filters import Filters, PARAMS as FILTER_PARAMS
+from http_session import make_http_session, make_upstream_session
+from imageinfo import ImageInfo
+import metrics
+from overload import Overloaded, Upstreams
+from page_cache import CachedPage, PageCache, PageCompressor
+import pagepile as pagepile_api
+from pagepile import fetch_pagepile, post_pagepile
+from selection import complement_runs, decode_selection, encode_runs, \
+    indices_to_runs
+from single_flight import SingleFlight, make_lock_store
+import sitematrix
+from thumbnails import ThumbnailCache, ThumbnailProxy, TokenBucket, \
+    is_thumbnail_url
 
 
 app = flask.Flask(__name__)
@@ -29,6 +56,106 @@ if app.secret_key is None:
     random_string = ''.join(random.choice(characters) for _ in range(64))
     app.secret_key = random_string
 
+if 'PAGEPILE_API_URL' in app.config:
+    pagepile_api.api_url = app.config['PAGEPILE_API_URL']
+sitematrix.persist_path = app.config.get('SITEMATRIX_CACHE_PATH')
+
+cache = make_cache(app.config)
+
+http_session = make_http_session(app.config)
+# for the calls guarded by upstreams (see _with_timeout())
+upstream_http_session = make_upstream_session(http_session)
+_anonymous_sessions: dict[str, mwapi.Session] = {}
+_anonymous_sessions_lock = threading.Lock()
+
+# the rate limit of the requests to upload.wikimedia.org (per worker),
+# by the thumbnail proxy and the duplicate finder (see _fetch_thumbnail())
+thumbnail_bucket = TokenBucket(app.config.get('THUMBNAIL_RATE', 10),
+                               app.config.get('THUMBNAIL_BURST', 20))
+
+thumbnail_proxy: Optional[ThumbnailProxy] = None
+if app.config.get('THUMBNAIL_PROXY', False):
+    thumbnail_proxy = ThumbnailProxy(
+        upstream_http_session,
+        user_agent,
+        ThumbnailCache(app.config.get('THUMBNAIL_CACHE_DIR', 'thumbnails'),
+                       app.config.get('THUMBNAIL_CACHE_SIZE', 2**30)),
+        thumbnail_bucket,
+        max_size=app.config.get('THUMBNAIL_MAX_SIZE', 2**22))
+
+# large selections are filtered in a background job (see jobs.py),
+# so that the upload to PagePile is not cut off by the worker timeout;
+# like the other optional features below, only imported if enabled
+job_queue: Optional['JobQueue'] = None
+if app.config.get('FILTER_JOBS', False):
+    from jobs import JobQueue
+    job_queue = JobQueue(app.config.get('JOBS_PATH', 'jobs.sqlite3'),
+                         lambda params: _run_filter_job(params),
+                         retries=app.config.get('JOB_RETRIES', 3))
+    # with PRELOAD, the app is loaded in a process that forks the workers
+    # (see gunicorn.conf.py), and only they start the job worker
+    if not app.config.get('PRELOAD', False):
+        job_queue.start()
+
+# near-duplicate grouping (see duplicates.py), requires Pillow
+duplicate_finder: Optional['DuplicateFinder'] = None
+if app.config.get('DUPLICATES', False):
+    from duplicates import DuplicateFinder
+    duplicate_finder = DuplicateFinder(
+        cache,
+        lambda url: _fetch_thumbnail(url),
+        max_distance=app.config.get('DUPLICATES_MAX_DISTANCE', 6),
+        processes=app.config.get('DUPLICATES_PROCESSES'))
+
+# rendered gallery pages, compressed (see page_cache.py)
+page_cache: Optional[PageCache] = None
+if app.config.get('PAGE_CACHE_SIZE', 64 * 2**20):
+    page_cache = PageCache(app.config.get('PAGE_CACHE_SIZE', 64 * 2**20),
+                           app.config.get('CACHE_TTL', 24 * 60 * 60))
+
+# concurrent loads of the same pile or imageinfo chunk are coalesced
+# (see single_flight.py), across workers if the cache is shared
+single_flight = SingleFlight(make_lock_store(cache),
+                             lock_ttl=2 * app.config.get('HTTP_TIMEOUT', 30))
+
+# calls to PagePile and the wikis are shed when they are overloaded
+# (see overload.py), instead of letting requests queue up behind them
+upstreams = Upstreams(
+    initial_limit=app.config.get('UPSTREAM_CONCURRENCY', 50),
+    max_limit=app.config.get('UPSTREAM_MAX_CONCURRENCY', 100),
+    latency_target=app.config.get('UPSTREAM_LATENCY_TARGET', 5),
+    queue_timeout=app.config.get('UPSTREAM_QUEUE_TIMEOUT', 2),
+    failure_threshold=app.config.get('CIRCUIT_FAILURES', 5),
+    reset_timeout=app.config.get('CIRCUIT_RESET_TIMEOUT', 30),
+    retries=app.config.get('HTTP_RETRIES', 3),
+    backoff=app.config.get('HTTP_BACKOFF', 0.5))
+
+# key of the deadline of a request in the ASGI scope (see asgi.py)
+DEADLINE_SCOPE_KEY = 'pagepile_visual_filter.deadline'
+
+# width and height of the thumbnails shown in the gallery
+THUMB_SIZE = 250
+
+COMMONS_DOMAIN = 'commons.wikimedia.org'
+
+# a file of a pile, as cached for its wiki: its imageinfo,
+# None if there is no such file, or (on wikis other than Commons)
+# its title on Commons if it is a file from Commons
+# (see _cache_queried_files())
+WikiFile = Union[ImageInfo, str, None]
+
+
+def render_template(template_name: str, **context) -> str:
+    with metrics.timed(metrics.render_duration,
+                       'render',
+                       template=template_name):
+        return flask.render_template(template_name, **context)
+
+
+@app.template_global()
+def duplicates_enabled() -> bool:
+    return duplicate_finder is not None
+
 
 @app.template_global()
 def csrf_token() -> str:
@@ -65,13 +192,167 @@ def pagepile_url(id: int) -> str:
         '?action=get_data&id=%d&format=html' % id
 
 
+@app.template_filter()
+def thumbnail_url(url: str) -> str:
+    """Route the thumbnail URL through the thumbnail proxy, if enabled."""
+    if thumbnail_proxy is None or not is_thumbnail_url(url):
+        return url
+    return flask.url_for('thumbnail', url=url)
+
+
+@app.template_global()
+def thumbnail_proxy_enabled() -> bool:
+    return thumbnail_proxy is not None
+
+
+def client_density() -> float:
+    """Get the device pixel ratio of the browser making the request.
+
+    From the dpr URL parameter (sent by static/load-more-files.js)
+    or the Sec-CH-DPR client hint (see accept_client_hints()),
+    defaulting to 1.
+    """
+    density = flask.request.args.get('dpr', type=float)
+    if density is None:
+        density = flask.request.headers.get('Sec-CH-DPR', type=float)
+    if density is None or not math.isfinite(density):
+        return 1.0
+    return density
+
+
+def prefetch_thumbnails(session: mwapi.Session,
+                        titles: Sequence[str],
+                        domain: str) -> None:
+    """Prefetch the thumbnails of the given files (e.g. the next window
+    of a pile) into the thumbnail proxy, if it is enabled.
+
+    The imageinfo is loaded in the background, and the thumbnails are
+    prefetched in the size the browser will pick for its density.
+    """
+    if thumbnail_proxy is None:
+        return
+    density = client_density()
+
+    def urls() -> Iterator[str]:
+        for imageinfo in load_files(session, titles, domain).values():
+            if imageinfo:
+                yield imageinfo.thumburl_for(density)
+
+    thumbnail_proxy.prefetch(urls())
+
+
 def anonymous_session(domain: str = 'meta.wikimedia.org') -> mwapi.Session:
-    return mwapi.Session(host='https://'+domain, user_agent=user_agent)
+    """Get the shared anonymous session for the given domain.
+
+    All sessions use the same pooled HTTP session (see http_session.py),
+    so connections are kept alive across requests.
+    The WIKI_URL_TEMPLATE config (default "https://{domain}")
+    can point the sessions somewhere else, e.g. for benchmarks.
+    """
+    with _anonymous_sessions_lock:
+        try:
+            return _anonymous_sessions[domain]
+        except KeyError:
+            url_template = app.config.get('WIKI_URL_TEMPLATE',
+                                          'https://{domain}')
+            session = mwapi.Session(host=url_template.format(domain=domain),
+                                    user_agent=user_agent,
+                                    timeout=app.config.get('HTTP_TIMEOUT', 30),
+                                    session=http_session)
+            _anonymous_sessions[domain] = session
+            return session
+
+
+def pagepile_host() -> str:
+    """Get the host of the PagePile API, as named in upstreams."""
+    return urllib.parse.urlsplit(pagepile_api.api_url).netloc
+
+
+def request_deadline() -> Optional[float]:
+    """Get the deadline of the current request, if any.
+
+    The deadline is a time.monotonic() value (see start_deadline());
+    there is none outside of requests, e.g. in filter jobs.
+    """
+    if not flask.has_app_context():
+        return None
+    return flask.g.get('deadline')
+
+
+def _with_timeout(session: mwapi.Session, timeout: float) -> mwapi.Session:
+    # a copy of the shared session (and its connection pool)
+    # with the timeout of one call, capped by the request deadline,
+    # which raises for responses of an unavailable upstream
+    # and leaves retries to upstreams.run()
+    session = copy.copy(session)
+    session.timeout = timeout
+    session.session = upstream_http_session
+    return session
+
+
+def warm_up() -> None:
+    """Prepare the app for serving requests, before forking workers.
+
+    Called in the gunicorn master (see gunicorn.conf.py), so that the
+    workers inherit the compiled templates and the sitematrix,
+    instead of each loading them on its first request.
+    The sitematrix is fetched with a separate HTTP session,
+    so that the workers do not inherit any connections.
+    """
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    url_template = app.config.get('WIKI_URL_TEMPLATE', 'https://{domain}')
+    with make_http_session(app.config) as session:
+        try:
+            sitematrix.warm_up(mwapi.Session(
+                host=url_template.format(domain='meta.wikimedia.org'),
+                user_agent=user_agent,
+                timeout=app.config.get('HTTP_TIMEOUT', 30),
+                session=session))
+        except Exception:
+            # the first request of each worker will try again
+            app.logger.warning('Could not load sitematrix', exc_info=True)
+
+
+def after_fork() -> None:
+    """Set up a worker process forked from a process that ran warm_up().
+
+    Drops the database connections inherited from the parent process,
+    starts the job worker, and connects to the wikis and to PagePile
+    in the background, so that the first request does not wait for the
+    TCP and TLS handshakes, but the worker does not wait for them either.
+    """
+    cache.after_fork()
+    single_flight.after_fork()
+    if job_queue is not None:
+        job_queue.after_fork()
+        job_queue.start()
+    threading.Thread(target=_connect_upstreams,
+                     name='connect-upstreams',
+                     daemon=True).start()
+
+
+def _connect_upstreams() -> None:
+    # only to open connections, so one attempt each, with a short timeout
+    timeout = min(app.config.get('HTTP_TIMEOUT', 30), 5)
+    for domain in ('commons.wikimedia.org', 'meta.wikimedia.org'):
+        try:
+            _with_timeout(anonymous_session(domain),
+                          timeout).get(action='query')
+        except Exception:
+            app.logger.warning('Could not connect to %s', domain,
+                               exc_info=True)
+    try:
+        upstream_http_session.head(pagepile_api.api_url,
+                                   headers={'User-Agent': user_agent},
+                                   timeout=timeout)
+    except Exception:
+        app.logger.warning('Could not connect to PagePile', exc_info=True)
 
 
 @app.route('/')
 def index() -> str:
-    return flask.render_template('index.html')
+    return render_template('index.html')
 
 
 @app.route('/pagepile/')
@@ -84,62 +365,872 @@ def pagepile_redirect():
 
 @app.route('/pagepile/<int:id>/')
 def pagepile(id: int):
-    pile = load_pagepile(anonymous_session('meta.wikimedia.org'), id)
+    # the duplicate groups change as more hashes are computed
+    duplicates = duplicate_finder is not None \
+        and bool(flask.request.args.get('duplicates'))
+    page_key = None
+    if page_cache is not None and not duplicates:
+        page_key = pagepile_page_key(id, flask.request.args)
+        cached_page = page_cache.get(page_key)
+        if cached_page is not None:
+            return cached_page_response(cached_page)
+    pile = get_pagepile(id)
     if not pile:
-        return flask.render_template('no-such-pagepile.html',
-                                     id=id), 404
+        return render_template('no-such-pagepile.html',
+                               id=id), 404
     domain, pages = pile
-    if domain != 'commons.wikimedia.org':
-        return flask.render_template('not-commons-pagepile.html',
-                                     id=id,
-                                     domain=domain), 400
-    files = load_files(anonymous_session(domain), pages)
-    return flask.render_template('pagepile.html',
-                                 id=id,
-                                 domain=domain,
-                                 files=files)
+    if not wiki_supported(domain):
+        return render_template('unsupported-wiki-pagepile.html',
+                               id=id,
+                               domain=domain), 400
+    metrics.pile_size.observe(len(pages))
+    try:
+        filters = Filters.from_args(flask.request.args)
+    except ValueError:
+        return 'invalid filter', 400
+    _, window_size = pagepile_window(flask.request.args, len(pages))
+    next_offset = window_size if window_size < len(pages) else None
+    window = pages[:window_size]
+    session = anonymous_session(domain)
+    if next_offset is not None:
+        prefetch_thumbnails(session,
+                            pages[next_offset:next_offset+window_size],
+                            domain)
+    if app.config.get('STREAM_PAGEPILE', False) and not duplicates:
+        # make sure the session cookie is sent with the headers,
+        # before the template starts streaming
+        token = csrf_token()
+        # errors after this point can no longer become a 503 response
+        upstreams.check(domain, request_deadline())
+        chunks = flask.stream_template(
+            'pagepile.html',
+            id=id,
+            domain=domain,
+            files=with_indices(
+                filters.apply(iter_files(session, window, domain)),
+                window,
+                0),
+            filters=filters,
+            window_size=window_size,
+            next_offset=next_offset,
+        )
+        if page_key is not None:
+            chunks = _cache_streamed_page(page_key, token, chunks)
+        return flask.Response(chunks)
+    files = load_files(session, window, domain)
+    indexed_files = with_indices(filters.apply(files.items()), window, 0)
+    if duplicates:
+        assert duplicate_finder is not None
+        groups, pending = duplicate_finder.group(
+            list(indexed_files),
+            timeout=app.config.get('DUPLICATES_TIME_BUDGET', 10))
+        return render_template('pagepile.html',
+                               id=id,
+                               domain=domain,
+                               groups=groups,
+                               pending_duplicates=pending,
+                               filters=filters,
+                               window_size=window_size,
+                               next_offset=next_offset)
+    html = render_template('pagepile.html',
+                           id=id,
+                           domain=domain,
+                           files=indexed_files,
+                           filters=filters,
+                           window_size=window_size,
+                           next_offset=next_offset)
+    if page_cache is not None and page_key is not None:
+        cached_page = page_cache.put(page_key, html, csrf_token())
+        if cached_page is not None:
+            return cached_page_response(cached_page)
+    return html
+
+
+def pagepile_page_key(id: int, args: MultiDict) -> Tuple:
+    """Get the key of a pagepile page in the page_cache."""
+    return id, tuple(sorted(args.items(multi=True)))
+
+
+def _cache_streamed_page(key: Any,
+                         token: str,
+                         chunks: Iterator[str]) -> Iterator[str]:
+    """Pass the chunks of a streamed page through, then cache the page.
+
+    The chunks are compressed as they pass,
+    so the page is never held in memory in full.
+    If the client disconnects early, the incomplete page is not cached.
+    """
+    compressor = PageCompressor(token)
+    for chunk in chunks:
+        compressor.write(chunk)
+        yield chunk
+    page = compressor.close()
+    if page_cache is not None and page is not None:
+        page_cache.put_page(key, page)
+
+
+def cached_page_response(page: CachedPage) -> flask.Response:
+    """Respond with a cached page, including the CSRF token of the session.
+
+    The response is gzip-compressed if the client accepts that,
+    and has an ETag (which depends on the CSRF token),
+    so that the browser can revalidate it with a conditional request
+    and get a 304 response if it has not changed.
+    """
+    token = csrf_token()
+    etag = page.etag(token)
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    elif flask.request.accept_encodings['gzip']:
+        response = flask.Response(page.gzip(token), mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = flask.Response(page.text(token), mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.update(['Accept-Encoding', 'Cookie'])
+    return response
+
+
+@app.route('/pagepile/<int:id>/files')
+def pagepile_files(id: int):
+    """Return the imageinfo of one window of the files in a pile, as JSON.
+
+    The window is selected by the offset and limit URL parameters,
+    the limit being capped at the PAGEPILE_WINDOW_SIZE config.
+    """
+    pile = get_pagepile(id)
+    if not pile:
+        return flask.jsonify(error='no such pagepile'), 404
+    domain, pages = pile
+    if not wiki_supported(domain):
+        return flask.jsonify(error='unsupported wiki'), 400
+    offset, limit = files_window(flask.request.args)
+    window = pages[offset:offset+limit]
+    session = anonymous_session(domain)
+    files = load_files(session, window, domain)
+    next_offset = offset + limit if offset + limit < len(pages) else None
+    if next_offset is not None:
+        prefetch_thumbnails(session,
+                            pages[next_offset:next_offset+limit],
+                            domain)
+    return flask.jsonify(files=[{'index': index,
+                                 'title': title,
+                                 'imageinfo': imageinfo.to_json()
+                                 if imageinfo else None}
+                                for index, title, imageinfo
+                                in with_indices(files.items(),
+                                                window,
+                                                offset)],
+                         next_offset=next_offset,
+                         total=len(pages))
 
 
 @app.route('/pagepile/<int:id>/filter', methods=['POST'])
 def filter_pagepile(id: int):
     if not submitted_request_valid():
         return 'CSRF error', 400  # TODO nicer error
-    session = anonymous_session('meta.wikimedia.org')
-    original_pile = load_pagepile(session, id)
+    original_pile = get_pagepile(id)
     if not original_pile:
-        return flask.render_template('no-such-pagepile.html',
-                                     id=id), 404
+        return render_template('no-such-pagepile.html',
+                               id=id), 404
     domain, original_pages = original_pile
-    new_pages = flask.request.form.getlist('file')
-    if not new_pages or len(new_pages) >= len(original_pages):
+    size = len(original_pages)
+    rest_offset = size
+    if flask.request.form.get('rest_selected'):
+        # the user did not load all the windows of the pile,
+        # but selected all of the remaining files in bulk
+        try:
+            rest_offset = max(int(flask.request.form['rest_offset']), 0)
+        except (KeyError, ValueError):
+            return 'invalid rest_offset', 400
+    if 'selection' in flask.request.form:
+        # compact format, see selection.py
+        try:
+            runs = decode_selection(flask.request.form['selection'], size)
+        except ValueError:
+            return 'invalid selection', 400
+    else:
+        selected = set(flask.request.form.getlist('file'))
+        runs = indices_to_runs(index
+                               for index, page in enumerate(original_pages)
+                               if page in selected)
+    if rest_offset < size:
+        runs = [range(run.start, min(run.stop, rest_offset))
+                for run in runs if run.start < rest_offset]
+        runs.append(range(rest_offset, size))
+    kept = sum(len(run) for run in runs)
+    if not kept or kept >= size:
         return 'no changes', 200  # TODO better response
-    new_id = create_pagepile(session, domain, new_pages)
+    if job_queue is not None \
+       and kept >= app.config.get('FILTER_JOB_THRESHOLD', 10_000):
+        job_id = job_queue.submit({'id': id, 'kept': encode_runs(runs)})
+        return flask.redirect(flask.url_for('job', job_id=job_id), code=303)
+    new_id = create_filtered_pagepile(anonymous_session('meta.wikimedia.org'),
+                                      id,
+                                      original_pile,
+                                      runs)
     return flask.redirect(pagepile_url(new_id))
 
 
+@app.route('/job/<job_id>')
+def job(job_id: str):
+    job = job_queue.get(job_id) if job_queue is not None else None
+    if job is None:
+        return render_template('no-such-job.html', job_id=job_id), 404
+    if job.state == 'done':
+        return flask.redirect(pagepile_url(job.result))
+    return render_template('job.html', job=job)
+
+
+@app.route('/job/<job_id>/status')
+def job_status(job_id: str):
+    """Return the state of a filter job, as JSON, for static/poll-job.js."""
+    job = job_queue.get(job_id) if job_queue is not None else None
+    if job is None:
+        return flask.jsonify(error='no such job'), 404
+    return flask.jsonify(state=job.state,
+                         pile=job.result,
+                         url=pagepile_url(job.result)
+                         if job.state == 'done' else None,
+                         error=job.error)
+
+
+@app.route('/thumbnail')
+def thumbnail():
+    if thumbnail_proxy is None:
+        flask.abort(404)
+    url = flask.request.args.get('url', '')
+    if not is_thumbnail_url(url):
+        return 'not a thumbnail URL of upload.wikimedia.org', 400
+    status, data, content_type = thumbnail_proxy.get(
+        url,
+        timeout=app.config.get('THUMBNAIL_TIMEOUT', 4))
+    if status != 200:
+        # static/reload-images.js will retry
+        return flask.Response(status=status, headers={'Retry-After': '1'})
+    return flask.Response(data,
+                          content_type=content_type,
+                          headers={'Cache-Control': 'public, max-age=86400'})
+
+
 @app.route('/healthz')
 def health():
-    return ''
-
-
-def load_files(session: mwapi.Session,
-               titles: Sequence[str]) -> Mapping[str, Optional[Mapping]]:
-    files = dict.fromkeys(titles)
-    for chunk in [titles[i:i+50] for i in range(0, len(titles), 50)]:
-        for response in session.get(continuation=True,
-                                    action='query',
-                                    titles=chunk,
-                                    prop=['imageinfo'],
-                                    iiprop=['url'],
-                                    iiurlwidth=250,
-                                    iiurlheight=250,
-                                    formatversion=2):
-            for page in response.get('query', {}).get('pages', []):
-                try:
-                    files[page['title']] = page['imageinfo'][0]
-                except LookupError:
-                    pass
-    return files
+    """Report whether this worker is healthy, and the state of the upstreams.
+
+    The worker is degraded (503) while it refuses calls to PagePile,
+    Meta or Commons (see overload.py), which all piles depend on;
+    other wikis only affect their own piles.
+    """
+    degraded = any(upstreams.degraded(host)
+                   for host in (pagepile_host(),
+                                'meta.wikimedia.org',
+                                COMMONS_DOMAIN))
+    return flask.jsonify(status='degraded' if degraded else 'ok',
+                         upstreams=upstreams.status()), \
+        503 if degraded else 200
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return flask.Response(metrics.expose(),
+                          mimetype='text/plain; version=0.0.4')
+
+
+@app.errorhandler(Overloaded)
+def overloaded(error: Overloaded):
+    """Fail fast when an upstream call was refused (see overload.py)."""
+    headers = {'Retry-After': str(max(math.ceil(error.retry_after), 1))}
+    if flask.request.path.endswith('/files'):
+        return flask.jsonify(error='overloaded'), 503, headers
+    return render_template('overloaded.html'), 503, headers
+
+
+def pagepile_window(args: MultiDict[str, str],
+                    pile_size: int) -> Tuple[int, int]:
+    """Get the offset and limit of the files shown on the pagepile page.
+
+    Metadata filters (see filters.py) and near-duplicate grouping
+    (see duplicates.py) apply to the whole pile.
+    """
+    if args.get('all') \
+       or duplicate_finder is not None and args.get('duplicates') \
+       or any(args.get(name) for name in FILTER_PARAMS):
+        return 0, pile_size
+    return 0, app.config.get('PAGEPILE_WINDOW_SIZE', 500)
+
+
+def files_window(args: MultiDict[str, str]) -> Tuple[int, int]:
+    """Get the offset and limit of the files returned as JSON."""
+    window_size = app.config.get('PAGEPILE_WINDOW_SIZE', 500)
+    offset = max(args.get('offset', 0, type=int), 0)
+    limit = args.get('limit', window_size, type=int)
+    return offset, min(max(limit, 1), window_size)
+
+
+def with_indices(
+        files: Iterable[Tuple[str, Optional[ImageInfo]]],
+        window: Sequence[str],
+        offset: int,
+) -> Iterator[Tuple[Optional[int], str, Optional[ImageInfo]]]:
+    """Add the index in the pile to each (title, imageinfo) pair.
+
+    The window is the slice of the pile's pages starting at offset
+    from which the files were loaded. Titles that are not in the window
+    (e.g. because the API normalized them) get the index None.
+    """
+    indices = {page: offset + i for i, page in enumerate(window)}
+    for title, imageinfo in files:
+        yield indices.get(title), title, imageinfo
+
+
+def get_pagepile(id: int) -> Optional[Tuple[str, Sequence[str]]]:
+    """Load the given PagePile, using the cache if possible.
+
+    Piles are immutable once created, so they can be cached for as long
+    as the cache allows; nonexistent piles are not cached.
+    """
+    pile = cached_pagepile(id)
+    if pile is not None:
+        return pile
+    # a shared pile link is often opened by many users at once
+    return single_flight.run('pile:%d' % id,
+                             lambda: _load_pagepile(id),
+                             lambda: _lookup_pagepile(id),
+                             request_deadline())
+
+
+def _load_pagepile(id: int) -> Optional[Tuple[str, Sequence[str]]]:
+    session = anonymous_session('meta.wikimedia.org')
+    fetched = upstreams.run(
+        pagepile_host(),
+        lambda timeout: fetch_pagepile(_with_timeout(session, timeout), id),
+        session.timeout,
+        request_deadline())
+    if fetched is None:
+        return None
+    # the (usually cached) sitematrix comes from Meta, not PagePile,
+    # so it is looked up outside of the call to PagePile, and with the
+    # shared session, not one with the timeout left for this request
+    # (a stale sitematrix is refreshed with it in the background)
+    dbname, pages = fetched
+    pile = sitematrix.dbname_to_domain(session, dbname), pages
+    cache.set('pile:%d' % id, pile)
+    return pile
+
+
+def _lookup_pagepile(id: int) -> Optional[Tuple[str, Sequence[str]]]:
+    # only the full pile, as stored by _load_pagepile(), without metrics
+    cached = cache.get('pile:%d' % id)
+    if cached is None:
+        return None
+    domain, pages = cached
+    return domain, pages
+
+
+def cached_pagepile(id: int) -> Optional[Tuple[str, Sequence[str]]]:
+    """Get the given PagePile from the cache, if possible.
+
+    Piles created by filter_pagepile() are not cached in full,
+    only as the indices removed from the pile they were filtered from
+    (their parent); they are reconstructed from the parent pile
+    (which may itself be such a diff against its own parent),
+    so a chain of filtering rounds does not store the full list
+    of pages once per round, nor load the new pile from PagePile.
+    """
+    cached = cache.get_many(['pile:%d' % id, 'pile-diff:%d' % id])
+    if 'pile:%d' % id in cached:
+        metrics.cache_requests.inc(cache='pile', result='hit')
+        domain, pages = cached['pile:%d' % id]
+        return domain, pages
+    if 'pile-diff:%d' % id in cached:
+        parent_id, removed = cached['pile-diff:%d' % id]
+        parent = cached_pagepile(parent_id)
+        if parent is not None:
+            domain, parent_pages = parent
+            try:
+                runs = complement_runs(decode_selection(removed,
+                                                        len(parent_pages)),
+                                       len(parent_pages))
+            except ValueError:
+                pass  # stale diff, fall through to loading the pile
+            else:
+                return domain, [page
+                                for run in runs
+                                for page in parent_pages[run.start:run.stop]]
+    metrics.cache_requests.inc(cache='pile', result='miss')
+    return None
+
+
+def create_filtered_pagepile(session: mwapi.Session,
+                             id: int,
+                             pile: Tuple[str, Sequence[str]],
+                             runs: Sequence[range]) -> int:
+    """Create a new PagePile with the given runs of pages of a pile."""
+    domain, pages = pile
+    # not part of the call to PagePile (see _load_pagepile())
+    dbname = sitematrix.domain_to_dbname(
+        anonymous_session('meta.wikimedia.org'), domain)
+    # uploading a large pile (e.g. in a filter job) takes long
+    # without PagePile being slow
+    with upstreams.call(pagepile_host(),
+                        session.timeout,
+                        request_deadline(),
+                        expect_slow=True) as timeout:
+        new_id = post_pagepile(_with_timeout(session, timeout),
+                               dbname,
+                               (page
+                                for run in runs
+                                for page in pages[run.start:run.stop]))
+    # remember the new pile as a diff against this one (see get_pagepile)
+    cache.set('pile-diff:%d' % new_id,
+              (id, encode_runs(complement_runs(runs, len(pages)))))
+    return new_id
+
+
+def _run_filter_job(params: Mapping[str, Any]) -> int:
+    pile = get_pagepile(params['id'])
+    if pile is None:
+        raise ValueError('PagePile #%d not found' % params['id'])
+    _, pages = pile
+    runs = decode_selection(params['kept'], len(pages))
+    # not the shared session, for a longer timeout than requests get
+    url_template = app.config.get('WIKI_URL_TEMPLATE', 'https://{domain}')
+    session = mwapi.Session(host=url_template.format(
+                                domain='meta.wikimedia.org'),
+                            user_agent=user_agent,
+                            timeout=app.config.get('JOB_TIMEOUT', 600),
+                            session=http_session)
+    return create_filtered_pagepile(session, params['id'], pile, runs)
+
+
+def _fetch_thumbnail(url: str) -> bytes:
+    """Get a thumbnail for the duplicate finder.
+
+    Goes through the thumbnail proxy if enabled (and the URL is
+    a thumbnail, not a small original), so that its cache also applies
+    here; otherwise, the thumbnail is fetched directly, but with the same
+    rate limit, one token per request (without retries: 429 and 5xx
+    responses raise an HTTPError, and the hash is computed again
+    on a later request).
+    """
+    if thumbnail_proxy is not None and is_thumbnail_url(url):
+        status, data, _ = thumbnail_proxy.get(url, timeout=None)
+        if status != 200:
+            raise RuntimeError('HTTP %d for %s' % (status, url))
+        return data
+    thumbnail_bucket.acquire()
+    r = upstream_http_session.get(url,
+                                  headers={'User-Agent': user_agent},
+                                  timeout=app.config.get('HTTP_TIMEOUT', 30))
+    r.raise_for_status()
+    return r.content
+
+
+def wiki_supported(domain: str) -> bool:
+    """Whether the tool supports piles of the wiki with the given domain.
+
+    Looks up the capabilities precomputed from the sitematrix,
+    which was already loaded to find the domain of the pile,
+    so unsupported wikis are rejected without another request.
+    """
+    if domain == COMMONS_DOMAIN:
+        return True
+    capabilities = sitematrix.capabilities(
+        anonymous_session('meta.wikimedia.org'),
+        domain)
+    return capabilities is not None and capabilities.supported
+
+
+def _imageinfo_cache_key(title: str, domain: str = COMMONS_DOMAIN) -> str:
+    # the format of the value is ImageInfo.to_cached(),
+    # or a str for files from Commons on other wikis (see WikiFile)
+    if domain == COMMONS_DOMAIN:
+        return 'imageinfo4:%d:%s' % (THUMB_SIZE, title)
+    return 'imageinfo4:%d@%s:%s' % (THUMB_SIZE, domain, title)
+
+
+def load_files(
+        session: mwapi.Session,
+        titles: Sequence[str],
+        domain: str = COMMONS_DOMAIN,
+) -> Mapping[str, Optional[ImageInfo]]:
+    """Load the imageinfo of the given titles.
+
+    See iter_files() for details.
+    """
+    return dict(iter_files(session, titles, domain))
+
+
+def iter_files(
+        session: mwapi.Session,
+        titles: Sequence[str],
+        domain: str = COMMONS_DOMAIN,
+) -> Iterator[Tuple[str, Optional[ImageInfo]]]:
+    """Load the imageinfo of the given titles, chunk by chunk.
+
+    The session is for the wiki with the given domain.
+    The titles are queried in chunks of the wiki's batch size
+    (see _batch_size()), several chunks in parallel
+    (up to the LOAD_FILES_CONCURRENCY config, default 4);
+    titles whose imageinfo is cached are not queried again.
+    The results are yielded in the order of the titles,
+    as soon as each chunk has been loaded.
+    """
+    titles = list(dict.fromkeys(titles))
+    chunks = _chunks(session.host, titles)
+    for chunk_files in _map_ordered(
+            lambda chunk: _load_files_chunk(session, chunk, domain),
+            chunks,
+            app.config.get('LOAD_FILES_CONCURRENCY', 4),
+    ):
+        yield from chunk_files.items()
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def _map_ordered(function: Callable[[T], R],
+                 items: Iterable[T],
+                 max_workers: int) -> Iterator[R]:
+    """Like map(), but call the function in a thread pool.
+
+    The results are yielded in the order of the items.
+    Only a limited number of items is submitted ahead of the consumer,
+    so that a slow consumer does not make the results pile up in memory.
+    """
+    if max_workers <= 1:
+        yield from map(function, items)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        pending: collections.deque[concurrent.futures.Future[R]] = \
+            collections.deque()
+        try:
+            for item in items:
+                # run in a copy of the current context,
+                # so that the function can still access flask.g etc.
+                context = contextvars.copy_context()
+                pending.append(executor.submit(context.run, function, item))
+                if len(pending) >= 2 * max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # only relevant if the consumer stopped early
+            for future in pending:
+                future.cancel()
+
+
+def _chunks(host: Optional[str],
+            titles: Sequence[str]) -> Iterator[Sequence[str]]:
+    """Split the titles into chunks of the batch size of the host.
+
+    The chunks are generated lazily, so that chunks generated after
+    the batch size changed (see _batch_size()) already use the new size.
+    """
+    start = 0
+    while start < len(titles):
+        size = _batch_size(host)
+        yield titles[start:start+size]
+        start += size
+
+
+def _load_files_chunk(
+        session: mwapi.Session,
+        titles: Sequence[str],
+        domain: str = COMMONS_DOMAIN,
+) -> Mapping[str, Optional[ImageInfo]]:
+    files, missing_titles = _cached_files(titles, domain)
+    if missing_titles:
+        # concurrent views of the same pile load the same chunks
+        files.update(single_flight.run(
+            _chunk_flight_key(session.host, missing_titles),
+            lambda: _query_files(session, missing_titles, domain),
+            lambda: _lookup_files(missing_titles, domain),
+            request_deadline()))
+    commons_titles = _commons_titles(files)
+    if not commons_titles:
+        return _merge_commons_files(files, {})
+    # files from Commons that are no longer cached on Commons,
+    # loaded from there in separate batches (see _cache_queried_files())
+    commons_session = anonymous_session(COMMONS_DOMAIN)
+    commons_files: dict[str, Optional[ImageInfo]] = {}
+    for chunk in _chunks(commons_session.host, commons_titles):
+        commons_files.update(_load_files_chunk(commons_session, chunk))
+    return _merge_commons_files(files, commons_files)
+
+
+def _commons_titles(files: Mapping[str, WikiFile]) -> list[str]:
+    return list(dict.fromkeys(file for file in files.values()
+                              if isinstance(file, str)))
+
+
+def _merge_commons_files(
+        files: Mapping[str, WikiFile],
+        commons_files: Mapping[str, Optional[ImageInfo]],
+) -> dict[str, Optional[ImageInfo]]:
+    """Replace the Commons titles among the files with their imageinfo."""
+    return {title: commons_files.get(file) if isinstance(file, str) else file
+            for title, file in files.items()}
+
+
+def _chunk_flight_key(host: Optional[str], titles: Sequence[str]) -> str:
+    digest = hashlib.sha1('\n'.join(titles).encode('utf-8')).hexdigest()
+    return 'imageinfo:%s:%s' % (host, digest)
+
+
+def _query_files(
+        session: mwapi.Session,
+        titles: Sequence[str],
+        domain: str = COMMONS_DOMAIN,
+) -> dict[str, WikiFile]:
+    """Query the imageinfo of the given titles, and cache it.
+
+    On wikis other than Commons, the result includes the files
+    from Commons (in one round trip), see _cache_queried_files().
+    """
+    loaded_files: dict[str, WikiFile] = dict.fromkeys(titles)
+    shared_titles: dict[str, str] = {}
+    with metrics.timed(metrics.upstream_duration, 'load_files_chunk'):
+        batches: list[Sequence[str]] = [titles]
+        lagged = 0
+        while batches:
+            batch = batches.pop(0)
+            params = _imageinfo_params(session.host, batch, lagged)
+            try:
+                responses = upstreams.run(
+                    domain,
+                    lambda timeout: list(_with_timeout(session, timeout).get(
+                        continuation=True, **params)),
+                    session.timeout,
+                    request_deadline())
+                for response in responses:
+                    _update_batch_size(session.host, response)
+                    loaded_files.update(_imageinfo_from_response(response))
+                    if domain != COMMONS_DOMAIN:
+                        shared_titles.update(
+                            _shared_titles_from_response(response))
+            except mwapi.errors.APIError as e:
+                retry_batches, delay = _retry_imageinfo(session.host,
+                                                        batch,
+                                                        e,
+                                                        lagged)
+                if e.code == 'maxlag':
+                    lagged += 1
+                upstreams.check(domain, request_deadline(), delay)
+                time.sleep(delay)
+                batches[:0] = retry_batches
+            else:
+                metrics.imageinfo_batch_size.observe(len(batch))
+    _cache_queried_files(loaded_files, shared_titles, domain)
+    return loaded_files
+
+
+def _cache_queried_files(files: Mapping[str, WikiFile],
+                         shared_titles: Mapping[str, str],
+                         domain: str) -> None:
+    """Cache the files queried on a wiki.
+
+    shared_titles maps the titles of files from Commons
+    (on wikis other than Commons) to their titles on Commons.
+    Those files are cached on Commons, and as their title on Commons
+    on the wiki (see WikiFile), so that piles of Commons and other wikis
+    share them; if they expire from the cache on Commons first,
+    they are loaded from Commons, batched separately from the local files.
+    """
+    _cache_files({title: shared_titles.get(title, file)
+                  for title, file in files.items()},
+                 domain)
+    if shared_titles:
+        _cache_files({commons_title: files[title]
+                      for title, commons_title in shared_titles.items()})
+
+
+def _lookup_files(
+        titles: Sequence[str],
+        domain: str = COMMONS_DOMAIN,
+) -> Optional[dict[str, WikiFile]]:
+    # the files of a chunk loaded by another process, once all are cached
+    files, missing_titles = _cached_files(titles,
+                                          domain,
+                                          count_requests=False)
+    return files if not missing_titles else None
+
+
+def _cached_files(
+        titles: Sequence[str],
+        domain: str = COMMONS_DOMAIN,
+        count_requests: bool = True,
+) -> Tuple[dict[str, WikiFile], list[str]]:
+    """Look up the given titles of the given wiki in the cache.
+
+    Returns the files (with imageinfo from the cache, None,
+    or their title on Commons, see WikiFile)
+    and the titles that were not found in the cache.
+    The hits and misses are counted in the metrics if count_requests.
+    """
+    files: dict[str, WikiFile] = dict.fromkeys(titles)
+    keys = {title: _imageinfo_cache_key(title, domain) for title in titles}
+    cached = cache.get_many(keys.values())
+    missing_titles = []
+    for title in titles:
+        try:
+            cached_imageinfo = cached[keys[title]]
+        except KeyError:
+            missing_titles.append(title)
+        else:
+            if isinstance(cached_imageinfo, str):
+                files[title] = cached_imageinfo
+            elif cached_imageinfo is not None:
+                files[title] = ImageInfo.from_cached(cached_imageinfo)
+    if not count_requests:
+        return files, missing_titles
+    metrics.cache_requests.inc(len(titles) - len(missing_titles),
+                               cache='imageinfo',
+                               result='hit')
+    metrics.cache_requests.inc(len(missing_titles),
+                               cache='imageinfo',
+                               result='miss')
+    return files, missing_titles
+
+
+def _cache_files(files: Mapping[str, WikiFile],
+                 domain: str = COMMONS_DOMAIN) -> None:
+    cache.set_many({_imageinfo_cache_key(title, domain):
+                    file.to_cached() if isinstance(file, ImageInfo) else file
+                    for title, file in files.items()})
+
+
+# the batch size of each API host whose limits are known
+_batch_sizes: dict[Optional[str], int] = {}
+_batch_sizes_lock = threading.Lock()
+
+
+def _batch_size(host: Optional[str]) -> int:
+    """Get the number of titles to query at once on the given API host.
+
+    This is the IMAGEINFO_BATCH_SIZE config (default 50, the limit
+    for anonymous users) until the first response from the host
+    says whether the session has the apihighlimits right,
+    in which case it is raised to IMAGEINFO_HIGH_BATCH_SIZE
+    (default 500, the limit with that right);
+    if the API still rejects a batch as too large,
+    it is lowered to whatever limit the API reports.
+    """
+    with _batch_sizes_lock:
+        try:
+            return _batch_sizes[host]
+        except KeyError:
+            return app.config.get('IMAGEINFO_BATCH_SIZE', 50)
+
+
+def _update_batch_size(host: Optional[str], response: Mapping) -> None:
+    try:
+        rights = response['query']['userinfo']['rights']
+    except LookupError:
+        return
+    if 'apihighlimits' in rights:
+        size = app.config.get('IMAGEINFO_HIGH_BATCH_SIZE', 500)
+    else:
+        size = app.config.get('IMAGEINFO_BATCH_SIZE', 50)
+    with _batch_sizes_lock:
+        _batch_sizes.setdefault(host, size)
+
+
+def _retry_imageinfo(
+        host: Optional[str],
+        titles: Sequence[str],
+        error: mwapi.errors.APIError,
+        lagged: int,
+) -> Tuple[list[Sequence[str]], float]:
+    """Decide how to retry an imageinfo query that failed.
+
+    lagged is the number of times the chunk was already retried
+    because of maxlag.
+    Returns the batches to query instead of the titles,
+    and the number of seconds to wait before querying them;
+    raises the error again if it should not be retried.
+    """
+    if error.code == 'toomanyvalues' and len(titles) > 1:
+        # "Too many values supplied for parameter "titles". The limit is 50."
+        match = re.search(r'limit is ([0-9]+)', error.info or '')
+        if match and int(match.group(1)) < len(titles):
+            size = max(int(match.group(1)), 1)
+        else:
+            size = len(titles) // 2
+        with _batch_sizes_lock:
+            _batch_sizes[host] = min(_batch_sizes.get(host, size), size)
+        metrics.upstream_retries.inc(reason='toomanyvalues')
+        return [titles[i:i+size] for i in range(0, len(titles), size)], 0
+    if error.code == 'maxlag' \
+       and lagged < app.config.get('MAXLAG_RETRIES', 2):
+        # MediaWiki sends a Retry-After of the lag, but at least 5 seconds;
+        # mwapi does not expose the headers, but the lag is in the info:
+        # "Waiting for 10.64.16.8: 6 seconds lagged."
+        match = re.search(r'([0-9.]+) seconds? lagged', error.info or '')
+        lag = float(match.group(1)) if match else 0
+        delay = max(lag, app.config.get('MAXLAG_BACKOFF', 5)) * 2 ** lagged
+        metrics.upstream_retries.inc(reason='maxlag')
+        return [titles], delay
+    raise error
+
+
+def _imageinfo_params(host: Optional[str],
+                      titles: Sequence[str],
+                      lagged: int = 0) -> dict:
+    """Get the API parameters to query the imageinfo of the titles.
+
+    The maxlag parameter (MAXLAG config, default 5 seconds) is sent
+    until the chunk has been retried MAXLAG_RETRIES times (default 2),
+    after which the tool would rather add to the lag than fail the page.
+    As long as the batch size of the host is unknown,
+    the rights of the session are queried too (see _batch_size()).
+    """
+    params: dict[str, Any] = {
+        'action': 'query',
+        'titles': titles,
+        'prop': ['imageinfo'],
+        'iiprop': ['url', 'mime', 'size', 'timestamp', 'sha1'],
+        'iiurlwidth': THUMB_SIZE,
+        'iiurlheight': THUMB_SIZE,
+        'formatversion': 2,
+    }
+    maxlag = app.config.get('MAXLAG', 5)
+    if maxlag is not None \
+       and lagged < app.config.get('MAXLAG_RETRIES', 2):
+        params['maxlag'] = maxlag
+    with _batch_sizes_lock:
+        batch_size_known = host in _batch_sizes
+    if not batch_size_known:
+        params['meta'] = ['userinfo']
+        params['uiprop'] = ['rights']
+    return params
+
+
+def _imageinfo_from_response(
+        response: Mapping,
+) -> Iterator[Tuple[str, ImageInfo]]:
+    for page in response.get('query', {}).get('pages', []):
+        try:
+            imageinfo = page['imageinfo'][0]
+        except LookupError:
+            continue
+        # interned, so that the title is shared with the pile
+        # (see pagepile.fetch_pagepile())
+        yield sys.intern(page['title']), ImageInfo.from_api(imageinfo)
+
+
+def _shared_titles_from_response(
+        response: Mapping,
+) -> Iterator[Tuple[str, str]]:
+    # the (title, title on Commons) of files from Commons on another wiki
+    for page in response.get('query', {}).get('pages', []):
+        if 'imageinfo' in page \
+           and page.get('imagerepository', 'local') != 'local':
+            # the namespace may be localized ("Datei:A.jpg")
+            name = page['title'].split(':', 1)[1]
+            yield sys.intern(page['title']), 'File:' + name
 
 
 def full_url(endpoint: str, **kwargs) -> str:
@@ -168,6 +1259,23 @@ def submitted_request_valid() -> bool:
     return True
 
 
+@app.before_request
+def start_deadline() -> None:
+    """Set the deadline of the request (REQUEST_DEADLINE config).
+
+    Upstream calls get at most the time left until the deadline
+    (default 25 seconds, less than gunicorn's 30 second worker timeout),
+    and are not made at all once it has passed (see overload.py).
+    Under ASGI, the deadline starts before the prefetch (see asgi.py).
+    """
+    seconds = app.config.get('REQUEST_DEADLINE', 25)
+    if seconds is None:
+        return
+    scope = flask.request.environ.get('asgi.scope', {})
+    flask.g.deadline = scope.get(DEADLINE_SCOPE_KEY,
+                                 time.monotonic() + seconds)
+
+
 @app.after_request
 def deny_frame(response: flask.Response) -> flask.Response:
     """Disallow embedding the tool’s pages in other websites.
@@ -177,3 +1285,25 @@ def deny_frame(response: flask.Response) -> flask.Response:
     """
     response.headers['X-Frame-Options'] = 'deny'
     return response
+
+
+@app.after_request
+def accept_client_hints(response: flask.Response) -> flask.Response:
+    """Ask browsers for their device pixel ratio (see client_density())."""
+    if thumbnail_proxy is not None:
+        response.headers['Accept-CH'] = 'Sec-CH-DPR'
+    return response
+
+
+@app.after_request
+def server_timing(response: flask.Response) -> flask.Response:
+    """Add a Server-Timing header if enabled (SERVER_TIMING config).
+
+    For streamed responses, this only includes the timings
+    of operations that happened before the response started.
+    """
+    if app.config.get('SERVER_TIMING', False):
+        header = metrics.server_timing_header()
+        if header:
+            response.headers['Server-Timing'] = header
+    return response
@@ -0,0 +1,304 @@
+"""ASGI entry point for the tool, e.g.: uvicorn asgi:app
+
+Requests are still handled by the Flask app (via a2wsgi's thread pool),
+but for the upstream-bound GET routes (/pagepile/<id>/ and
+/pagepile/<id>/files), the pile and the imageinfo of the requested window
+are first loaded asynchronously into the cache. The Flask view then finds
+everything in the cache and only has to render, so one worker process
+can wait for PagePile and the Commons API on behalf of hundreds of
+concurrent requests, instead of one request per thread.
+This requires a cache shared with the Flask app, which the default
+in-process cache is. The WSGI entry point (app:app) is unaffected.
+
+The deadline of a request (see app.start_deadline()) starts here,
+so the prefetch counts against it too; the asynchronous upstream calls
+go through the same circuit breakers and concurrency limits as the
+Flask app's (see overload.py), but never wait for a slot.
+"""
+
+import a2wsgi
+import aiohttp
+import asyncio
+import contextvars
+import mwapi  # type: ignore
+import re
+import time
+from typing import Any, Awaitable, Callable, Mapping, Optional, Sequence, \
+    Tuple
+import urllib.parse
+from werkzeug.datastructures import MultiDict
+
+import app as pagepile_visual_filter
+from http_session import unavailable
+from imageinfo import ImageInfo
+from pagepile import fetch_pagepile_async
+import metrics
+import sitematrix
+
+
+flask_app = pagepile_visual_filter.app
+wsgi_app = a2wsgi.WSGIMiddleware(
+    flask_app,  # type: ignore
+    workers=flask_app.config.get('ASGI_WSGI_THREADS', 10))
+
+_http_session: Optional[aiohttp.ClientSession] = None
+_async_sessions: dict[str, mwapi.AsyncSession] = {}
+# the deadline of the current request, as a time.monotonic() value
+_deadline: contextvars.ContextVar[Optional[float]] = \
+    contextvars.ContextVar('deadline', default=None)
+
+Scope = dict[str, Any]
+Receive = Callable[[], Awaitable[dict]]
+Send = Callable[[dict], Awaitable[None]]
+
+
+def http_session() -> aiohttp.ClientSession:
+    """Get the shared aiohttp session, creating it if necessary."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        config = flask_app.config
+        _http_session = aiohttp.ClientSession(
+            headers={'User-Agent': pagepile_visual_filter.user_agent},
+            timeout=aiohttp.ClientTimeout(
+                total=config.get('HTTP_TIMEOUT', 30)),
+            # one event loop serves many requests,
+            # so it needs more connections than one WSGI worker
+            connector=aiohttp.TCPConnector(
+                limit_per_host=config.get('ASGI_HTTP_POOL_SIZE', 100)),
+            raise_for_status=_raise_if_unavailable,
+        )
+        _async_sessions.clear()
+    return _http_session
+
+
+async def _raise_if_unavailable(response: aiohttp.ClientResponse) -> None:
+    # like http_session.raise_if_unavailable(), so that mwapi does not
+    # report these responses as invalid JSON (see overload.is_failure())
+    if unavailable(response.status):
+        response.raise_for_status()
+
+
+def anonymous_async_session(domain: str) -> mwapi.AsyncSession:
+    """Get the shared anonymous async session for the given domain."""
+    try:
+        return _async_sessions[domain]
+    except KeyError:
+        url_template = flask_app.config.get('WIKI_URL_TEMPLATE',
+                                            'https://{domain}')
+        session = mwapi.AsyncSession(host=url_template.format(domain=domain),
+                                     user_agent=pagepile_visual_filter
+                                     .user_agent,
+                                     session=http_session())
+        # mwapi would otherwise override the session timeout per request
+        session.timeout = http_session().timeout
+        _async_sessions[domain] = session
+        return session
+
+
+async def get_pagepile_async(id: int) -> Optional[Tuple[str, Sequence[str]]]:
+    """Like app.get_pagepile(), but asynchronous."""
+    pile = await asyncio.to_thread(pagepile_visual_filter.cached_pagepile, id)
+    if pile is not None:
+        return pile
+    return await pagepile_visual_filter.single_flight.run_async(
+        'pile:%d' % id,
+        lambda: _load_pagepile_async(id),
+        lambda: pagepile_visual_filter._lookup_pagepile(id),
+        _deadline.get())
+
+
+async def _load_pagepile_async(
+        id: int,
+) -> Optional[Tuple[str, Sequence[str]]]:
+    async with pagepile_visual_filter.upstreams.call_async(
+            pagepile_visual_filter.pagepile_host(),
+            flask_app.config.get('HTTP_TIMEOUT', 30),
+            _deadline.get(),
+    ) as timeout, asyncio.timeout(timeout):
+        fetched = await fetch_pagepile_async(http_session(), id)
+    if fetched is None:
+        return None
+    # see app._load_pagepile()
+    dbname, pages = fetched
+    domain = await asyncio.to_thread(
+        sitematrix.dbname_to_domain,
+        pagepile_visual_filter.anonymous_session('meta.wikimedia.org'),
+        dbname)
+    pile = domain, pages
+    await asyncio.to_thread(pagepile_visual_filter.cache.set,
+                            'pile:%d' % id,
+                            pile)
+    return pile
+
+
+async def load_files_async(
+        session: mwapi.AsyncSession,
+        titles: Sequence[str],
+        domain: str = pagepile_visual_filter.COMMONS_DOMAIN,
+) -> Mapping[str, Optional[ImageInfo]]:
+    """Like app.load_files(), but asynchronous.
+
+    The chunks are loaded concurrently,
+    up to the LOAD_FILES_CONCURRENCY config (default 4) at a time.
+    """
+    titles = list(dict.fromkeys(titles))
+    semaphore = asyncio.Semaphore(
+        flask_app.config.get('LOAD_FILES_CONCURRENCY', 4))
+
+    async def load_chunk(chunk: Sequence[str]) -> Mapping:
+        async with semaphore:
+            return await _load_files_chunk_async(session, chunk, domain)
+
+    files: dict[str, Optional[ImageInfo]] = {}
+    for chunk_files in await asyncio.gather(*[
+            load_chunk(chunk)
+            for chunk in pagepile_visual_filter._chunks(session.host, titles)
+    ]):
+        files.update(chunk_files)
+    return files
+
+
+async def _load_files_chunk_async(
+        session: mwapi.AsyncSession,
+        titles: Sequence[str],
+        domain: str,
+) -> Mapping[str, Optional[ImageInfo]]:
+    files, missing_titles = await asyncio.to_thread(
+        pagepile_visual_filter._cached_files, titles, domain)
+    if missing_titles:
+        files.update(await pagepile_visual_filter.single_flight.run_async(
+            pagepile_visual_filter._chunk_flight_key(session.host,
+                                                     missing_titles),
+            lambda: _query_files_async(session, missing_titles, domain),
+            lambda: pagepile_visual_filter._lookup_files(missing_titles,
+                                                         domain),
+            _deadline.get()))
+    commons_titles = pagepile_visual_filter._commons_titles(files)
+    commons_files: Mapping[str, Optional[ImageInfo]] = {}
+    if commons_titles:
+        commons_files = await load_files_async(
+            anonymous_async_session(pagepile_visual_filter.COMMONS_DOMAIN),
+            commons_titles)
+    return pagepile_visual_filter._merge_commons_files(files, commons_files)
+
+
+async def _query_files_async(
+        session: mwapi.AsyncSession,
+        titles: Sequence[str],
+        domain: str,
+) -> dict[str, pagepile_visual_filter.WikiFile]:
+    loaded_files: dict[str, pagepile_visual_filter.WikiFile] = \
+        dict.fromkeys(titles)
+    shared_titles: dict[str, str] = {}
+    with metrics.timed(metrics.upstream_duration, 'load_files_chunk'):
+        batches: list[Sequence[str]] = [titles]
+        lagged = 0
+        while batches:
+            batch = batches.pop(0)
+            params = pagepile_visual_filter._imageinfo_params(session.host,
+                                                              batch,
+                                                              lagged)
+            try:
+                async with pagepile_visual_filter.upstreams.call_async(
+                        domain,
+                        flask_app.config.get('HTTP_TIMEOUT', 30),
+                        _deadline.get(),
+                ) as timeout, asyncio.timeout(timeout):
+                    responses = [response async for response
+                                 in await session.get(continuation=True,
+                                                      **params)]
+                for response in responses:
+                    pagepile_visual_filter._update_batch_size(session.host,
+                                                              response)
+                    loaded_files.update(pagepile_visual_filter
+                                        ._imageinfo_from_response(response))
+                    if domain != pagepile_visual_filter.COMMONS_DOMAIN:
+                        shared_titles.update(
+                            pagepile_visual_filter
+                            ._shared_titles_from_response(response))
+            except (mwapi.errors.APIError, mwapi.errors.RequestError) as e:
+                # mwapi.AsyncSession wraps API errors in RequestErrors
+                error = e.__cause__ \
+                    if isinstance(e, mwapi.errors.RequestError) else e
+                if not isinstance(error, mwapi.errors.APIError):
+                    raise
+                retry_batches, delay = pagepile_visual_filter \
+                    ._retry_imageinfo(session.host, batch, error, lagged)
+                if error.code == 'maxlag':
+                    lagged += 1
+                pagepile_visual_filter.upstreams.check(domain,
+                                                       _deadline.get(),
+                                                       delay)
+                await asyncio.sleep(delay)
+                batches[:0] = retry_batches
+            else:
+                metrics.imageinfo_batch_size.observe(len(batch))
+    await asyncio.to_thread(pagepile_visual_filter._cache_queried_files,
+                            loaded_files,
+                            shared_titles,
+                            domain)
+    return loaded_files
+
+
+async def prefetch(path: str, query_string: bytes) -> None:
+    """Load whatever the Flask view for this request will need into the cache.
+
+    Errors are ignored here: the Flask view will run into them again
+    and handle them as usual.
+    """
+    match = re.fullmatch(r'/pagepile/(\d+)/(files)?', path)
+    if not match:
+        return
+    id = int(match.group(1))
+    args = MultiDict(urllib.parse.parse_qsl(query_string.decode('latin-1')))
+    page_cache = pagepile_visual_filter.page_cache
+    if not match.group(2) and page_cache is not None and page_cache.get(
+            pagepile_visual_filter.pagepile_page_key(id, args)):
+        # the view will not need the pile or the files
+        return
+    try:
+        pile = await get_pagepile_async(id)
+        if not pile:
+            return
+        domain, pages = pile
+        if not await asyncio.to_thread(pagepile_visual_filter.wiki_supported,
+                                       domain):
+            return
+        if match.group(2):
+            window = pagepile_visual_filter.files_window(args)
+        else:
+            window = pagepile_visual_filter.pagepile_window(args, len(pages))
+        offset, limit = window
+        await load_files_async(anonymous_async_session(domain),
+                               pages[offset:offset+limit],
+                               domain)
+    except Exception:
+        pass
+
+
+async def lifespan(receive: Receive, send: Send) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            http_session()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _http_session is not None:
+                await _http_session.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope: Scope, receive: Receive, send: Send) -> None:
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] == 'http':
+        seconds = flask_app.config.get('REQUEST_DEADLINE', 25)
+        if seconds is not None:
+            deadline = time.monotonic() + seconds
+            scope[pagepile_visual_filter.DEADLINE_SCOPE_KEY] = deadline
+            _deadline.set(deadline)
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        await prefetch(scope['path'], scope.get('query_string', b''))
+    await wsgi_app(scope, receive, send)  # type: ignore
@@ -0,0 +1,346 @@
+"""Offline benchmarks for the tool.
+
+Runs the Flask app against a local fake PagePile and MediaWiki API
+(see fake_upstream.py) and reports latency percentiles, throughput
+and peak memory usage, one JSON object per line, e.g.:
+
+    python benchmark.py --sizes 10 1000 50000 --output bench.jsonl
+
+The results include the current git commit,
+so that they can be compared across versions.
+The view_local scenario views a pile of another wiki than Commons,
+to compare it with the Commons-only path of the view scenario.
+With --memory, the memory used per loaded file is measured instead
+(the imageinfo as returned by the API vs. as kept by the tool),
+and with --startup the startup time of a worker and its first request
+(importing the app itself vs. forked from a preloaded app).
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Iterable, Mapping, Optional, TextIO
+
+import app as pagepile_visual_filter
+from cache import Cache, MemoryCache
+from fake_upstream import FakeUpstream, LOCAL_PILE_OFFSET, \
+    imageinfo_response, pile_pages
+from page_cache import PageCache
+import pagepile
+
+
+class NullCache(Cache):
+    """A cache that never caches anything, for cold-cache benchmarks."""
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        return {}
+
+    def set_many(self, items: Mapping[str, Any]) -> None:
+        pass
+
+
+def configure(fake: FakeUpstream) -> None:
+    """Point the app at the given fake upstream."""
+    app = pagepile_visual_filter.app
+    app.testing = True
+    app.config['WIKI_URL_TEMPLATE'] = fake.wiki_url_template
+    pagepile.api_url = fake.pagepile_api_url
+    with pagepile_visual_filter._anonymous_sessions_lock:
+        pagepile_visual_filter._anonymous_sessions.clear()
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def peak_rss_kib() -> int:
+    # ru_maxrss is in KiB on Linux (but in bytes on macOS)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def git_version() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def request_view(client: Any, size: int) -> None:
+    response = client.get('/pagepile/%d/' % size)
+    assert response.status_code == 200, response.status_code
+    response.get_data()
+
+
+def request_view_local(client: Any, size: int) -> None:
+    # a pile of another wiki, half local files and half from Commons
+    response = client.get('/pagepile/%d/' % (LOCAL_PILE_OFFSET + size))
+    assert response.status_code == 200, response.status_code
+    response.get_data()
+
+
+def request_view_all(client: Any, size: int) -> None:
+    response = client.get('/pagepile/%d/?all=1' % size)
+    assert response.status_code == 200, response.status_code
+    response.get_data()
+
+
+def request_filter(client: Any, size: int) -> None:
+    with client.session_transaction() as session:
+        session['csrf_token'] = 'benchmark'
+    # keep every other file
+    selection = ','.join(str(i) for i in range(0, size, 2))
+    response = client.post('/pagepile/%d/filter' % size, data={
+        'csrf_token': 'benchmark',
+        'selection': selection,
+    })
+    assert response.status_code in {200, 302}, response.status_code
+
+
+SCENARIOS: dict[str, Callable[[Any, int], None]] = {
+    'view': request_view,
+    'view_local': request_view_local,
+    'view_all': request_view_all,
+    'filter': request_filter,
+}
+
+
+def allocated_bytes(build: Callable[[], Any]) -> int:
+    """Measure the memory still allocated by the result of build()."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return after - before
+
+
+def measure_memory(size: int) -> dict[str, Any]:
+    """Measure the memory used per file for the imageinfo of a pile."""
+    titles = pile_pages(size)
+    # serialized, so that each measurement parses its own fresh copy
+    data = json.dumps(imageinfo_response(titles))
+
+    def api_files() -> dict:
+        return {page['title']: page['imageinfo'][0]
+                for page in json.loads(data)['query']['pages']}
+
+    def compact_files() -> dict:
+        return dict(pagepile_visual_filter._imageinfo_from_response(
+            json.loads(data)))
+
+    api_bytes = allocated_bytes(api_files)
+    compact_bytes = allocated_bytes(compact_files)
+    return {
+        'version': git_version(),
+        'scenario': 'memory',
+        'size': size,
+        'api_bytes_per_file': round(api_bytes / size, 1),
+        'compact_bytes_per_file': round(compact_bytes / size, 1),
+        'ratio': round(api_bytes / compact_bytes, 2),
+    }
+
+
+# run in a fresh interpreter (see measure_startup()),
+# with the mode ("cold" or "preload") and pile size as arguments
+_STARTUP_SCRIPT = """
+import json, os, sys, time
+mode, size = sys.argv[1], int(sys.argv[2])
+start = time.perf_counter()
+import app
+result = {'import_ms': (time.perf_counter() - start) * 1000}
+if mode == 'preload':
+    start = time.perf_counter()
+    app.warm_up()
+    result['warm_up_ms'] = (time.perf_counter() - start) * 1000
+    if os.fork():
+        os.wait()
+        sys.exit()
+    start = time.perf_counter()
+    app.after_fork()
+    result['after_fork_ms'] = (time.perf_counter() - start) * 1000
+app.app.testing = True
+start = time.perf_counter()
+response = app.app.test_client().get('/pagepile/%d/' % size)
+assert response.status_code == 200, response.status_code
+result['first_request_ms'] = (time.perf_counter() - start) * 1000
+print(json.dumps(result))
+"""
+
+
+def measure_startup(fake: FakeUpstream,
+                    mode: str,
+                    size: int) -> dict[str, Any]:
+    """Measure the startup of a worker and its first request.
+
+    In the "cold" mode, the worker imports the app itself;
+    in the "preload" mode, it is forked from a process that
+    imported and warmed up the app (like gunicorn.conf.py does),
+    and the times before the fork are spent once for all workers.
+    """
+    fake.counts.clear()
+    env = dict(os.environ,
+               TOOL_WIKI_URL_TEMPLATE=fake.wiki_url_template,
+               TOOL_PAGEPILE_API_URL=fake.pagepile_api_url)
+    child = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT,
+                            mode, str(size)],
+                           env=env,
+                           capture_output=True,
+                           text=True,
+                           check=True)
+    times = json.loads(child.stdout.splitlines()[-1])
+    return {
+        'version': git_version(),
+        'scenario': 'startup',
+        'mode': mode,
+        'size': size,
+        'latency': fake.latency,
+        **{name: round(value, 3) for name, value in times.items()},
+        'upstream_requests': dict(fake.counts),
+    }
+
+
+def run_startup(sizes: Iterable[int],
+                latency: float = 0,
+                output: TextIO = sys.stdout) -> list[dict[str, Any]]:
+    results = []
+    with FakeUpstream(latency=latency) as fake:
+        for size in sizes:
+            for mode in ['cold', 'preload']:
+                result = measure_startup(fake, mode, size)
+                print(json.dumps(result), file=output, flush=True)
+                results.append(result)
+    return results
+
+
+def run_scenario(fake: FakeUpstream,
+                 scenario: str,
+                 size: int,
+                 iterations: int,
+                 concurrency: int,
+                 warm: bool) -> dict[str, Any]:
+    request = SCENARIOS[scenario]
+    app = pagepile_visual_filter.app
+    pagepile_visual_filter.cache = MemoryCache(maxsize=1_000_000,
+                                               ttl=3600) \
+        if warm else NullCache()
+    pagepile_visual_filter.page_cache = PageCache(max_bytes=2**30,
+                                                  ttl=3600) \
+        if warm else None
+    if warm:
+        request(app.test_client(), size)
+    fake.counts.clear()
+
+    def timed_request(i: int) -> float:
+        client = app.test_client()
+        start = time.perf_counter()
+        request(client, size)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        latencies = list(executor.map(timed_request, range(iterations)))
+    elapsed = time.perf_counter() - start
+    return {
+        'version': git_version(),
+        'scenario': scenario,
+        'size': size,
+        'iterations': iterations,
+        'concurrency': concurrency,
+        'warm': warm,
+        'latency': fake.latency,
+        'error_rate': fake.error_rate,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'requests_per_second': round(iterations / elapsed, 3),
+        'peak_rss_kib': peak_rss_kib(),
+        'upstream_requests': dict(fake.counts),
+    }
+
+
+def run(sizes: Iterable[int],
+        scenarios: Iterable[str],
+        iterations: int,
+        concurrency: int = 1,
+        latency: float = 0,
+        error_rate: float = 0,
+        warm: bool = False,
+        output: TextIO = sys.stdout) -> list[dict[str, Any]]:
+    results = []
+    with FakeUpstream(latency=latency, error_rate=error_rate) as fake:
+        configure(fake)
+        for scenario in scenarios:
+            for size in sizes:
+                result = run_scenario(fake,
+                                      scenario,
+                                      size,
+                                      iterations,
+                                      concurrency,
+                                      warm)
+                print(json.dumps(result), file=output, flush=True)
+                results.append(result)
+    return results
+
+
+def run_memory(sizes: Iterable[int],
+               output: TextIO = sys.stdout) -> list[dict[str, Any]]:
+    results = []
+    for size in sizes:
+        result = measure_memory(size)
+        print(json.dumps(result), file=output, flush=True)
+        results.append(result)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000, 10_000, 50_000])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS,
+                        default=list(SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='fake upstream latency per request (seconds)')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of fake upstream requests that fail')
+    parser.add_argument('--warm', action='store_true',
+                        help='keep the cache warm instead of disabling it')
+    parser.add_argument('--memory', action='store_true',
+                        help='measure the memory used per loaded file')
+    parser.add_argument('--startup', action='store_true',
+                        help='measure the startup time of a worker '
+                        'and its first request, with and without preloading')
+    parser.add_argument('--output', type=argparse.FileType('a'),
+                        default=sys.stdout)
+    args = parser.parse_args()
+    if args.memory:
+        run_memory(args.sizes, output=args.output)
+        return
+    if args.startup:
+        run_startup(args.sizes, latency=args.latency, output=args.output)
+        return
+    run(args.sizes,
+        args.scenarios,
+        args.iterations,
+        concurrency=args.concurrency,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        warm=args.warm,
+        output=args.output)
+
+
+if __name__ == '__main__':
+    main()
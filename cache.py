@@ -0,0 +1,224 @@
+import cachetools
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Iterable, Mapping
+
+
+class Cache:
+    """A key-value cache with expiry and size-bounded LRU eviction.
+
+    Keys are strings, values anything that can be serialized as JSON
+    (tuples come back as lists from the shared backends).
+    Subclasses implement get_many() and set_many();
+    get_many() only includes keys that were found in the cache,
+    so that a cached None can be told apart from a cache miss.
+    """
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        raise NotImplementedError
+
+    def set_many(self, items: Mapping[str, Any]) -> None:
+        raise NotImplementedError
+
+    def after_fork(self) -> None:
+        """Drop any state that must not be shared with a parent process."""
+        pass
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.get_many([key]).get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        self.set_many({key: value})
+
+
+class MemoryCache(Cache):
+    """A cache in the memory of the current process."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache: cachetools.TTLCache[str, Any] = cachetools.TTLCache(
+            maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                try:
+                    found[key] = self._cache[key]
+                except KeyError:
+                    pass
+        return found
+
+    def set_many(self, items: Mapping[str, Any]) -> None:
+        with self._lock:
+            self._cache.update(items)
+
+
+class SqliteConnections:
+    """Connections to an SQLite database file, one per thread.
+
+    SQLite connections must not be shared between threads,
+    nor used across a fork (see after_fork()).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        """Get the connection of the current thread."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            self._local.connection = connection
+        return connection
+
+    def after_fork(self) -> None:
+        """Drop the connections inherited from a parent process."""
+        self._local = threading.local()
+
+
+class SqliteCache(Cache):
+    """A cache in an SQLite database file.
+
+    The file can be shared between several processes,
+    e.g. the workers of one gunicorn master.
+    Each thread uses its own connection to the database.
+
+    To keep writes (which lock the whole database) short and rare,
+    the access time of an entry, which the LRU eviction goes by,
+    is only updated if it is older than touch_interval seconds,
+    and expired and least recently used entries are evicted in batches,
+    once a process has written another 1% of maxsize entries
+    (so the cache can exceed its maxsize by that much per process).
+    """
+
+    def __init__(self,
+                 path: str,
+                 maxsize: int,
+                 ttl: float,
+                 touch_interval: float = 60):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self._evict_every = max(maxsize // 100, 1)
+        self._written = 0
+        self._written_lock = threading.Lock()
+        self._connections = SqliteConnections(path)
+        with self._connections.get() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                               'key TEXT PRIMARY KEY, '
+                               'value TEXT NOT NULL, '
+                               'expires REAL NOT NULL, '
+                               'accessed REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed '
+                               'ON cache (accessed)')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_expires '
+                               'ON cache (expires)')
+
+    def after_fork(self) -> None:
+        self._connections.after_fork()
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        with self._connections.get() as connection:
+            # SQLite limits the number of host parameters per statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                placeholders = ', '.join('?' * len(chunk))
+                rows = connection.execute(
+                    'SELECT key, value, accessed FROM cache '
+                    f'WHERE key IN ({placeholders}) AND expires > ?',
+                    (*chunk, now),
+                ).fetchall()
+                stale = [key
+                         for key, _, accessed in rows
+                         if accessed < now - self.touch_interval]
+                if stale:
+                    connection.execute(
+                        'UPDATE cache SET accessed = ? '
+                        f'WHERE key IN ({", ".join("?" * len(stale))})',
+                        (now, *stale),
+                    )
+                for key, value, _ in rows:
+                    found[key] = json.loads(value)
+        return found
+
+    def set_many(self, items: Mapping[str, Any]) -> None:
+        now = time.time()
+        with self._connections.get() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO cache (key, value, expires, accessed) '
+                'VALUES (?, ?, ?, ?)',
+                [(key, json.dumps(value), now + self.ttl, now)
+                 for key, value in items.items()],
+            )
+            with self._written_lock:
+                self._written += len(items)
+                evict = self._written >= self._evict_every
+                if evict:
+                    self._written = 0
+            if evict:
+                connection.execute('DELETE FROM cache WHERE expires <= ?',
+                                   (now,))
+                connection.execute(
+                    'DELETE FROM cache WHERE key IN ('
+                    'SELECT key FROM cache ORDER BY accessed DESC '
+                    'LIMIT -1 OFFSET ?)',
+                    (self.maxsize,),
+                )
+
+
+class RedisCache(Cache):
+    """A cache in a Redis-compatible key-value store.
+
+    Only the GET, MGET and SET commands are used,
+    so any client object offering mget() and set(..., ex=...)
+    (such as redis.Redis) can be used.
+    Size-bounded eviction is left to the store itself
+    (e.g. maxmemory-policy allkeys-lru), the maxsize is not enforced here.
+    """
+
+    def __init__(self, client: Any, ttl: float, prefix: str = 'ppvf:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self.prefix + key for key in keys])
+        return {key: json.loads(value)
+                for key, value in zip(keys, values)
+                if value is not None}
+
+    def set_many(self, items: Mapping[str, Any]) -> None:
+        for key, value in items.items():
+            self.client.set(self.prefix + key,
+                            json.dumps(value),
+                            ex=int(self.ttl))
+
+
+def make_cache(config: Mapping[str, Any]) -> Cache:
+    """Create a cache according to the CACHE_* config variables."""
+    backend = config.get('CACHE_BACKEND', 'memory')
+    maxsize = config.get('CACHE_MAXSIZE', 100_000)
+    ttl = config.get('CACHE_TTL', 24 * 60 * 60)
+    if backend == 'memory':
+        return MemoryCache(maxsize=maxsize, ttl=ttl)
+    if backend == 'sqlite':
+        return SqliteCache(config.get('CACHE_PATH', 'cache.sqlite3'),
+                           maxsize=maxsize,
+                           ttl=ttl)
+    if backend == 'redis':
+        import redis  # type: ignore
+        return RedisCache(redis.Redis.from_url(config['CACHE_REDIS_URL']),
+                          ttl=ttl)
+    raise ValueError('Unknown CACHE_BACKEND: %r' % backend)
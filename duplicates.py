@@ -0,0 +1,276 @@
+"""Grouping of near-duplicate files by perceptual hashes of their thumbnails.
+
+Each thumbnail is reduced to a 64-bit difference hash (dHash),
+which changes little for re-encoded, rescaled or slightly cropped
+versions of the same image; files whose hashes differ in at most
+a few bits are grouped together, using a multi-index hash to find
+the neighbors of each hash without comparing all pairs of files.
+
+Computing the hashes requires Pillow, which is an optional dependency
+(only imported once a hash is computed). The hashes are computed in
+a process pool, cached by the SHA-1 of the file, and computed in the
+background: a request waits for them only up to a time budget,
+and later requests pick up the hashes finished in the meantime.
+"""
+
+import concurrent.futures
+import io
+import logging
+import multiprocessing
+import threading
+from typing import Any, Callable, Generic, Iterable, Optional, \
+    Sequence, Tuple, TypeVar
+
+from cache import Cache
+from imageinfo import ImageInfo
+
+
+T = TypeVar('T')
+
+_logger = logging.getLogger(__name__)
+
+
+def dhash(data: bytes) -> int:
+    """Compute the 64-bit difference hash of an image.
+
+    The image is converted to grayscale and shrunk to 9×8 pixels,
+    and each bit records whether a pixel is brighter than its right
+    neighbor. This runs in the process pool, so it must be picklable.
+    """
+    from PIL import Image  # type: ignore
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = list(image.convert('L').resize((9, 8)).getdata())
+    hash = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            hash = hash << 1 | (left > right)
+    return hash
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class HashIndex(Generic[T]):
+    """An index of 64-bit hashes, for lookups by Hamming distance.
+
+    Uses multi-index hashing: each hash is split into four 16-bit bands,
+    and if two hashes differ in at most max_distance bits,
+    at least one of their bands differs in at most max_distance // 4 bits
+    (pigeonhole principle). So a search only looks up the items
+    in the buckets of each band of the hash and of the values
+    within that many bits of it, and checks their full distance.
+    """
+
+    BANDS = 4
+    BAND_BITS = 16
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        self._buckets: list[dict[int, list[Tuple[int, T]]]] = [
+            {} for _ in range(self.BANDS)]
+        # the XOR masks of all band values within max_distance // 4 bits
+        masks = [0]
+        for _ in range(max_distance // self.BANDS):
+            masks = list({mask | 1 << bit
+                          for mask in masks
+                          for bit in range(self.BAND_BITS)} | set(masks))
+        self._masks = masks
+
+    def _bands(self, hash: int) -> list[int]:
+        mask = (1 << self.BAND_BITS) - 1
+        return [hash >> (band * self.BAND_BITS) & mask
+                for band in range(self.BANDS)]
+
+    def add(self, hash: int, item: T) -> None:
+        for buckets, band in zip(self._buckets, self._bands(hash)):
+            buckets.setdefault(band, []).append((hash, item))
+
+    def search(self, hash: int) -> list[T]:
+        """Get the items whose hash is within max_distance of the hash.
+
+        An item may be returned more than once
+        (if it is found through several bands).
+        """
+        max_distance = self.max_distance
+        masks = self._masks
+        found: list[T] = []
+        for buckets, band in zip(self._buckets, self._bands(hash)):
+            get = buckets.get
+            for mask in masks:
+                bucket = get(band ^ mask)
+                if bucket:
+                    for other_hash, item in bucket:
+                        if (hash ^ other_hash).bit_count() <= max_distance:
+                            found.append(item)
+        return found
+
+
+def cluster(hashes: Sequence[Tuple[T, int]],
+            max_distance: int) -> list[list[T]]:
+    """Group items whose hashes are within max_distance of each other.
+
+    Grouping is transitive (if A is close to B and B to C,
+    all three are grouped even if A and C are further apart).
+    Each item is in exactly one group; the groups are in the order
+    of their first item, and the items in each group in input order.
+    """
+    index: HashIndex[int] = HashIndex(max_distance)
+    # union-find over the positions
+    parents = list(range(len(hashes)))
+
+    def find(position: int) -> int:
+        while parents[position] != position:
+            parents[position] = parents[parents[position]]
+            position = parents[position]
+        return position
+
+    for position, (item, hash) in enumerate(hashes):
+        # each pair only needs to be found once,
+        # so only search the hashes added before this one
+        for neighbor in index.search(hash):
+            a, b = find(position), find(neighbor)
+            if a != b:
+                parents[max(a, b)] = min(a, b)
+        index.add(hash, position)
+    groups: dict[int, list[T]] = {}
+    for position, (item, hash) in enumerate(hashes):
+        groups.setdefault(find(position), []).append(item)
+    return list(groups.values())
+
+
+class DuplicateFinder:
+    """Computes, caches and groups the perceptual hashes of files.
+
+    fetch is called with a thumbnail URL and returns its content;
+    it runs in a thread pool of fetch_workers threads,
+    while the hash_function (by default dhash) runs
+    in a pool of processes processes.
+    """
+
+    def __init__(self,
+                 cache: Cache,
+                 fetch: Callable[[str], bytes],
+                 max_distance: int = 6,
+                 processes: Optional[int] = None,
+                 fetch_workers: int = 8,
+                 hash_function: Callable[[bytes], int] = dhash):
+        self.cache = cache
+        self.fetch = fetch
+        self.hash_function = hash_function
+        self.max_distance = max_distance
+        self.processes = processes
+        self._fetch_executor = concurrent.futures.ThreadPoolExecutor(
+            fetch_workers, thread_name_prefix='duplicates-fetch')
+        self._hash_executor: Optional[
+            concurrent.futures.ProcessPoolExecutor] = None
+        self._pending: dict[str, concurrent.futures.Future[Optional[int]]] \
+            = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(title: str, imageinfo: ImageInfo) -> str:
+        if imageinfo.sha1 is not None:
+            return 'dhash:%040x' % imageinfo.sha1
+        return 'dhash:title:' + title
+
+    def _hash_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._hash_executor is None:
+                # not forked from this (multi-threaded) process
+                self._hash_executor = concurrent.futures.ProcessPoolExecutor(
+                    self.processes,
+                    mp_context=multiprocessing.get_context('forkserver'))
+            return self._hash_executor
+
+    def _compute(self, key: str, url: str) -> Optional[int]:
+        try:
+            try:
+                data = self.fetch(url)
+            except Exception:
+                # probably temporary, try again on the next request
+                _logger.warning('Could not fetch %s', url, exc_info=True)
+                return None
+            hash: Optional[int]
+            try:
+                hash = self._hash_pool().submit(self.hash_function,
+                                                data).result()
+            except Exception:
+                _logger.warning('Could not hash %s', url, exc_info=True)
+                # cached as None, so that broken thumbnails are not hashed
+                # again on every request (they are simply never grouped)
+                hash = None
+            self.cache.set(key, hash)
+            return hash
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def hashes(self,
+               files: Iterable[Tuple[str, ImageInfo]],
+               timeout: Optional[float]) -> dict[str, Optional[int]]:
+        """Get the hashes of the given files, by title.
+
+        Waits up to timeout seconds for hashes that are not cached yet;
+        the ones not finished by then are left out of the result,
+        but still computed in the background.
+        """
+        files = [(title, imageinfo) for title, imageinfo in files
+                 if imageinfo is not None]
+        keys = {title: self._cache_key(title, imageinfo)
+                for title, imageinfo in files}
+        urls = {title: imageinfo.thumburl for title, imageinfo in files}
+        cached = self.cache.get_many(keys.values())
+        result: dict[str, Optional[int]] = {}
+        futures: dict[concurrent.futures.Future[Optional[int]], str] = {}
+        for title, key in keys.items():
+            if key in cached:
+                result[title] = cached[key]
+                continue
+            with self._lock:
+                future = self._pending.get(key)
+                if future is None:
+                    future = self._fetch_executor.submit(self._compute,
+                                                         key,
+                                                         urls[title])
+                    self._pending[key] = future
+            futures[future] = title
+        done, _ = concurrent.futures.wait(futures, timeout=timeout)
+        for future in done:
+            result[futures[future]] = future.result()
+        return result
+
+    def group(self,
+              files: Sequence[Tuple[Any, str, Optional[ImageInfo]]],
+              timeout: Optional[float],
+              ) -> Tuple[list[list[Tuple[Any, str, Optional[ImageInfo]]]],
+                         int]:
+        """Group (index, title, imageinfo) triples into near-duplicates.
+
+        Returns the groups (each file is in exactly one of them,
+        most groups have a single file) in the order of their
+        first file, and the number of files whose hash was not ready
+        (those are each in a group of their own).
+        """
+        hashes = self.hashes([(title, imageinfo)
+                              for index, title, imageinfo in files
+                              if imageinfo is not None],
+                             timeout)
+        hashed = [(position, hash)
+                  for position, (index, title, imageinfo) in enumerate(files)
+                  if (hash := hashes.get(title)) is not None]
+        clusters = {positions[0]: positions
+                    for positions in cluster(hashed, self.max_distance)}
+        clustered = {position for position, hash in hashed}
+        groups = []
+        pending = 0
+        for position, (index, title, imageinfo) in enumerate(files):
+            if position in clusters:
+                groups.append([files[p] for p in clusters[position]])
+            elif position not in clustered:
+                if imageinfo is not None and title not in hashes:
+                    pending += 1
+                groups.append([files[position]])
+        return groups, pending
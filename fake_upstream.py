@@ -0,0 +1,273 @@
+"""A local stand-in for PagePile and the MediaWiki API.
+
+Used by the benchmarks (benchmark.py) and some tests,
+so that the tool can be exercised without an internet connection.
+The server implements just enough of both APIs for this tool:
+
+- PagePile: action=get_data and action=create_pile_with_data,
+  served under /pagepile/api.php.
+- MediaWiki: action=sitematrix and action=query&prop=imageinfo,
+  served under /<domain>/w/api.php
+  (use "http://host:port/{domain}" as the WIKI_URL_TEMPLATE).
+
+Pile N contains N files, "File:Benchmark N-0.jpg" etc.;
+piles created through the fake server get IDs starting at 1,000,000,
+and are kept in memory. Pile LOCAL_PILE_OFFSET + N is a pile of
+de.wikipedia.org with N files, every other one a local file
+("File:Benchmark local N-1.jpg" etc.) and the others from Commons
+(the same files as in pile N).
+"""
+
+import http.server
+import json
+import random
+import threading
+import time
+from typing import Any, Optional
+import urllib.parse
+
+
+SITES = [
+    {'url': 'https://commons.wikimedia.org', 'dbname': 'commonswiki',
+     'code': 'commons', 'lang': 'commons', 'sitename': 'Wikimedia Commons'},
+    {'url': 'https://meta.wikimedia.org', 'dbname': 'metawiki',
+     'code': 'meta', 'lang': 'meta', 'sitename': 'Meta-Wiki'},
+    {'url': 'https://de.wikipedia.org', 'dbname': 'dewiki',
+     'code': 'wiki', 'lang': 'de', 'sitename': 'Wikipedia'},
+    {'url': 'https://office.wikimedia.org', 'dbname': 'officewiki',
+     'code': 'office', 'lang': 'office', 'sitename': 'Wikimedia Office',
+     'private': True},
+]
+
+COMMONS = 'commons.wikimedia.org'
+LOCAL_PILE_OFFSET = 2_000_000
+
+
+def pile_pages(id: int) -> list[str]:
+    return ['File:Benchmark_%d-%d.jpg' % (id, i) for i in range(id)]
+
+
+def local_pile_pages(size: int) -> list[str]:
+    return ['File:Benchmark_local_%d-%d.jpg' % (size, i) if i % 2
+            else 'File:Benchmark_%d-%d.jpg' % (size, i)
+            for i in range(size)]
+
+
+def is_local_file(title: str) -> bool:
+    """Whether the title is a local file on wikis other than Commons."""
+    return title.replace(' ', '_').startswith('File:Benchmark_local_')
+
+
+def imageinfo(title: str, wiki: str = 'commons') -> dict:
+    name = urllib.parse.quote(title[len('File:'):].replace(' ', '_'))
+    base = 'https://upload.wikimedia.org/wikipedia/' + wiki
+    return {
+        'thumburl': '%s/thumb/a/ab/%s/250px-%s' % (base, name, name),
+        'thumbwidth': 250,
+        'thumbheight': 188,
+        'responsiveUrls': {
+            '1.5': '%s/thumb/a/ab/%s/375px-%s' % (base, name, name),
+            '2': '%s/thumb/a/ab/%s/500px-%s' % (base, name, name),
+        },
+        'timestamp': '2020-01-01T00:00:00Z',
+        'size': 123456,
+        'width': 4000,
+        'height': 3000,
+        'mime': 'image/jpeg',
+        'url': '%s/a/ab/%s' % (base, name),
+        'descriptionurl': 'https://commons.wikimedia.org/wiki/' + name,
+        'descriptionshorturl': 'https://commons.wikimedia.org/'
+        'w/index.php?curid=1',
+    }
+
+
+def imageinfo_response(titles: list[str], domain: str = COMMONS) -> dict:
+    """Get the response to an imageinfo query on the given wiki.
+
+    On wikis other than Commons, files that are not local
+    (see is_local_file()) are files from Commons.
+    """
+    pages: list[dict[str, Any]] = []
+    for title in titles:
+        if not title.startswith('File:'):
+            pages.append({'title': title, 'ns': 0, 'missing': True})
+        elif domain == COMMONS or is_local_file(title):
+            pages.append({'title': title,
+                          'ns': 6,
+                          'imageinfo': [imageinfo(title,
+                                                  domain.split('.')[0])],
+                          'imagerepository': 'local'})
+        else:
+            pages.append({'title': title,
+                          'ns': 6,
+                          'missing': True,
+                          'known': True,
+                          'imageinfo': [imageinfo(title)],
+                          'imagerepository': 'shared'})
+    return {'batchcomplete': True, 'query': {'pages': pages}}
+
+
+class FakeUpstream:
+    """The fake server, running in a background thread.
+
+    latency is the delay (in seconds) before each response,
+    error_rate the fraction of requests that fail with a 503 error.
+    Like the real API, imageinfo queries are limited to titles_limit
+    titles (500 if high_limits is true, which also gives the
+    apihighlimits right in meta=userinfo), and fail if lag
+    (in seconds) is higher than their maxlag parameter.
+    The counts attribute records the number of requests per action
+    (suffixed with "@domain" for wikis other than Commons and Meta).
+    The last_titles attribute records the titles of the last
+    imageinfo query.
+    """
+
+    def __init__(self,
+                 latency: float = 0,
+                 error_rate: float = 0,
+                 titles_limit: int = 50,
+                 high_limits: bool = False,
+                 lag: float = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.titles_limit = 500 if high_limits else titles_limit
+        self.high_limits = high_limits
+        self.lag = lag
+        self.counts: dict[str, int] = {}
+        # the titles of the last imageinfo query
+        self.last_titles: list[str] = []
+        self.created_piles: dict[int, tuple[str, list[str]]] = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self) -> None:
+                url = urllib.parse.urlsplit(self.path)
+                self.respond(url.path,
+                             urllib.parse.parse_qs(url.query,
+                                                   keep_blank_values=True))
+
+            def do_POST(self) -> None:
+                url = urllib.parse.urlsplit(self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length).decode('utf-8')
+                self.respond(url.path,
+                             urllib.parse.parse_qs(body,
+                                                   keep_blank_values=True))
+
+            def respond(self, path: str, params: dict[str, list[str]]) -> None:
+                status, body = fake.handle(path, {k: v[0]
+                                                  for k, v in params.items()})
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        class Server(http.server.ThreadingHTTPServer):
+            daemon_threads = True
+            # the default of 5 drops connections in concurrent benchmarks
+            request_queue_size = 1024
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> 'FakeUpstream':
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def pagepile_api_url(self) -> str:
+        return self.url + '/pagepile/api.php'
+
+    @property
+    def wiki_url_template(self) -> str:
+        return self.url + '/{domain}'
+
+    def handle(self, path: str, params: dict[str, str]) -> tuple[int, Any]:
+        action = params.get('action', '')
+        if action == 'query':
+            action = 'query+' + params.get('prop', '')
+        domain = path.split('/')[1]
+        counted = action
+        if path.endswith('/w/api.php') \
+           and domain not in {COMMONS, 'meta.wikimedia.org'}:
+            counted += '@' + domain
+        with self._lock:
+            self.counts[counted] = self.counts.get(counted, 0) + 1
+            fail = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            return 503, {'error': 'injected error'}
+        if path == '/pagepile/api.php':
+            if action == 'get_data':
+                return 200, self.get_data(int(params['id']))
+            if action == 'create_pile_with_data':
+                return 200, self.create_pile_with_data(params['wiki'],
+                                                       params['data'])
+        elif path.endswith('/w/api.php'):
+            if action == 'sitematrix':
+                return 200, {'sitematrix': {'count': len(SITES),
+                                            'specials': SITES}}
+            if action == 'query+imageinfo':
+                return 200, self.query_imageinfo(params, domain)
+            if action == 'query+':
+                return 200, {'batchcomplete': True}
+        return 400, {'error': 'unsupported request'}
+
+    def get_data(self, id: int) -> dict:
+        with self._lock:
+            created = self.created_piles.get(id)
+        if created:
+            wiki, pages = created
+            return {'wiki': wiki, 'pages': pages}
+        if id >= LOCAL_PILE_OFFSET:
+            return {'wiki': 'dewiki',
+                    'pages': local_pile_pages(id - LOCAL_PILE_OFFSET)}
+        return {'wiki': 'commonswiki', 'pages': pile_pages(id)}
+
+    def create_pile_with_data(self, wiki: str, data: str) -> dict:
+        pages = [line.split('\t')[0] for line in data.split('\n') if line]
+        with self._lock:
+            id = 1_000_000 + len(self.created_piles)
+            self.created_piles[id] = wiki, pages
+        return {'pile': {'id': id}}
+
+    def query_imageinfo(self,
+                        params: dict[str, str],
+                        domain: str = COMMONS) -> dict:
+        if 'maxlag' in params and self.lag > float(params['maxlag']):
+            return {'error': {'code': 'maxlag',
+                              'info': 'Waiting for 10.0.0.1: '
+                              '%d seconds lagged.' % self.lag}}
+        titles = params['titles'].split('|')
+        self.last_titles = titles
+        if len(titles) > self.titles_limit:
+            return {'error': {'code': 'toomanyvalues',
+                              'info': 'Too many values supplied for '
+                              'parameter "titles". The limit is %d.'
+                              % self.titles_limit}}
+        response = imageinfo_response(titles, domain)
+        if 'userinfo' in params.get('meta', ''):
+            rights = ['read']
+            if self.high_limits:
+                rights.append('apihighlimits')
+            response['query']['userinfo'] = {'id': 0, 'name': '127.0.0.1',
+                                             'anon': True, 'rights': rights}
+        return response
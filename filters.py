@@ -0,0 +1,123 @@
+"""Metadata pre-filters for the files of a pile.
+
+The filters are given as URL parameters of the pagepile page, e.g.
+/pagepile/123/?mime=image/jpeg&min_width=1000&before=2010-01-01,
+and only files whose imageinfo matches all of them are shown,
+so that the visual review only has to cover the remaining files.
+"""
+
+import calendar
+import time
+from typing import Callable, Iterable, Iterator, Optional, Tuple, TypeVar
+
+from werkzeug.datastructures import MultiDict
+
+from imageinfo import ImageInfo
+
+
+T = TypeVar('T')
+
+# URL parameter => (ImageInfo attribute, whether it is a minimum)
+_INT_PARAMS = {
+    'min_size': ('size', True),
+    'max_size': ('size', False),
+    'min_width': ('width', True),
+    'max_width': ('width', False),
+    'min_height': ('height', True),
+    'max_height': ('height', False),
+}
+_TIMESTAMP_PARAMS = {
+    'after': ('timestamp', True),
+    'before': ('timestamp', False),
+}
+
+PARAMS = ['mime', *_INT_PARAMS, *_TIMESTAMP_PARAMS]
+
+
+def _parse_date(value: str) -> int:
+    for format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return calendar.timegm(time.strptime(value, format))
+        except ValueError:
+            pass
+    raise ValueError('Invalid date: %r' % value)
+
+
+class Filters:
+    """A set of metadata filters, parsed from URL parameters.
+
+    mime may be given several times (matching any of them),
+    and may end in /* to match a whole class of types (e.g. image/*);
+    the min_ and max_ parameters (size in bytes, width and height
+    in pixels) and after and before (dates in YYYY-MM-DD format
+    or timestamps, in UTC) are inclusive bounds.
+    Files without the relevant metadata never match a bound.
+    """
+
+    def __init__(self,
+                 mimes: Iterable[str] = (),
+                 bounds: Iterable[Tuple[str, bool, int]] = ()):
+        self.mimes = frozenset(mime for mime in mimes
+                               if not mime.endswith('/*'))
+        self.mime_prefixes = tuple(mime[:-1] for mime in mimes
+                                   if mime.endswith('/*'))
+        self.bounds = list(bounds)
+
+    @classmethod
+    def from_args(cls, args: MultiDict) -> 'Filters':
+        """Parse the filters from URL parameters.
+
+        Empty parameters are ignored (as submitted by an empty form field),
+        invalid ones raise ValueError.
+        """
+        mimes = [mime for mime in args.getlist('mime') if mime]
+        bounds = []
+        for name, (attribute, minimum) in _INT_PARAMS.items():
+            if args.get(name):
+                bounds.append((attribute, minimum, int(args[name])))
+        for name, (attribute, minimum) in _TIMESTAMP_PARAMS.items():
+            if args.get(name):
+                bounds.append((attribute, minimum, _parse_date(args[name])))
+        return cls(mimes, bounds)
+
+    def __bool__(self) -> bool:
+        return bool(self.mimes or self.mime_prefixes or self.bounds)
+
+    def _predicates(self) -> list[Callable[[ImageInfo], bool]]:
+        predicates: list[Callable[[ImageInfo], bool]] = []
+        if self.mimes or self.mime_prefixes:
+            mimes, prefixes = self.mimes, self.mime_prefixes
+            predicates.append(lambda imageinfo: imageinfo.mime is not None
+                              and (imageinfo.mime in mimes
+                                   or imageinfo.mime.startswith(prefixes)))
+        for attribute, minimum, bound in self.bounds:
+            def predicate(imageinfo: ImageInfo,
+                          attribute: str = attribute,
+                          minimum: bool = minimum,
+                          bound: int = bound) -> bool:
+                value = getattr(imageinfo, attribute)
+                if value is None:
+                    return False
+                return value >= bound if minimum else value <= bound
+            predicates.append(predicate)
+        return predicates
+
+    def matches(self, imageinfo: Optional[ImageInfo]) -> bool:
+        if imageinfo is None:
+            return False
+        return all(predicate(imageinfo) for predicate in self._predicates())
+
+    def apply(
+            self,
+            files: Iterable[Tuple[str, Optional[ImageInfo]]],
+    ) -> Iterator[Tuple[str, Optional[ImageInfo]]]:
+        """Filter (title, imageinfo) pairs, e.g. from app.iter_files().
+
+        The predicates are built once and then applied to all the files,
+        lazily, so this also works for streamed responses.
+        """
+        predicates = self._predicates()
+        for title, imageinfo in files:
+            if imageinfo is not None \
+               and all(predicate(imageinfo) for predicate in predicates):
+                yield title, imageinfo
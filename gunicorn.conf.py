@@ -0,0 +1,25 @@
+"""gunicorn configuration, read by the web command of the Procfile.
+
+The app is loaded and warmed up once in the master process,
+before the workers are forked (see app.warm_up() and app.after_fork()),
+so that new workers (e.g. after a restart, or when one is recycled)
+start serving without importing everything again and without
+fetching the sitematrix on their first request.
+"""
+
+from typing import Any
+
+
+preload_app = True
+# tells the app not to start background threads in the master
+raw_env = ['TOOL_PRELOAD=true']
+
+
+def when_ready(server: Any) -> None:
+    import app
+    app.warm_up()
+
+
+def post_fork(server: Any, worker: Any) -> None:
+    import app
+    app.after_fork()
@@ -0,0 +1,73 @@
+import requests
+import requests.adapters
+from typing import Any, Mapping
+import urllib3.util
+
+
+def make_http_session(config: Mapping[str, Any]) -> requests.Session:
+    """Create a pooled HTTP session according to the HTTP_* config variables.
+
+    The session keeps connections alive, with up to HTTP_POOL_SIZE
+    connections per host (default 10), for up to HTTP_POOL_HOSTS hosts
+    (default 50, since piles can come from many wikis; the connections
+    of the least recently used host are closed beyond that),
+    and retries failed GET requests up to HTTP_RETRIES times (default 3)
+    with exponential backoff (HTTP_BACKOFF, default 0.5 seconds),
+    honoring Retry-After headers.
+    POST requests are not retried, since they may not be idempotent.
+    The session is meant to be shared by all requests of one worker.
+    """
+    pool_size = config.get('HTTP_POOL_SIZE', 10)
+    retry = urllib3.util.Retry(
+        total=config.get('HTTP_RETRIES', 3),
+        backoff_factor=config.get('HTTP_BACKOFF', 0.5),
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=['GET'],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=config.get('HTTP_POOL_HOSTS', 50),
+        pool_maxsize=pool_size,
+        max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def unavailable(status: int) -> bool:
+    """Whether an HTTP status means that the server is unavailable,
+    i.e. 429 (Too Many Requests) or a 5xx server error."""
+    return status == 429 or status >= 500
+
+
+def raise_if_unavailable(response: requests.Response, *args: Any,
+                         **kwargs: Any) -> None:
+    """Raise an HTTPError if the response means that the server is unavailable.
+
+    Can also be used as a response hook of a session.
+    """
+    if unavailable(response.status_code):
+        response.close()
+        response.raise_for_status()
+
+
+def make_upstream_session(session: requests.Session) -> requests.Session:
+    """Create a session for the calls guarded by overload.Upstreams.
+
+    It shares the connection pools of the given session, but raises
+    an HTTPError for responses that mean that the upstream is unavailable
+    (which mwapi and PagePile would otherwise only report as invalid JSON),
+    so that they count as failures of the upstream, and does not retry:
+    Upstreams.run() retries instead, within the deadline of the request
+    (each retry here would get the full timeout again).
+    """
+    upstream = requests.Session()
+    for prefix, adapter in session.adapters.items():
+        no_retries = requests.adapters.HTTPAdapter(max_retries=0)
+        # the retries are passed to the pools per request
+        no_retries.poolmanager = getattr(adapter, 'poolmanager')
+        upstream.mount(prefix, no_retries)
+    upstream.hooks['response'].append(raise_if_unavailable)
+    return upstream
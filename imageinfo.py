@@ -0,0 +1,243 @@
+"""A compact representation of the imageinfo of a file.
+
+The MediaWiki API returns a dict with many more fields than the tool
+needs; large piles hold one of these per file, in the cache and in
+the responses being rendered, so only the thumbnail fields are kept,
+in a record with __slots__, and the URLs are stored without the prefix
+that (almost) all of them share; the responsive URLs are usually
+reduced to just their width. See benchmark.py --memory.
+"""
+
+import calendar
+import re
+import sys
+import time
+from typing import Any, Mapping, Optional, Sequence, Tuple, Union
+
+
+URL_PREFIX = 'https://upload.wikimedia.org/wikipedia/commons/thumb/'
+
+# responsiveUrls reduced to widths are the same for most files,
+# so instances share them (up to a limited number of distinct ones)
+_shared_responsive: dict[tuple, tuple] = {}
+_SHARED_RESPONSIVE_MAX = 1000
+
+
+def _compress_url(url: str) -> str:
+    if url.startswith(URL_PREFIX):
+        return url[len(URL_PREFIX):]
+    return url
+
+
+def _expand_url(url: str) -> str:
+    if url.startswith(('https://', 'http://')):
+        return url
+    return URL_PREFIX + url
+
+
+def _split_thumb_url(url: str) -> Optional[Tuple[str, int, str]]:
+    # ".../A.jpg/250px-A.jpg" => (".../A.jpg/", 250, "px-A.jpg")
+    match = re.fullmatch(r'(.*/)([0-9]+)(px-[^/]*)', url)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2)), match.group(3)
+
+
+def _compress_responsive_url(thumburl: str, url: str) -> Union[int, str]:
+    # usually, the responsive URLs only differ from the thumb URL
+    # in the width, in which case only the width is stored
+    thumb = _split_thumb_url(thumburl)
+    responsive = _split_thumb_url(url)
+    if thumb is not None and responsive is not None \
+       and (thumb[0], thumb[2]) == (responsive[0], responsive[2]):
+        return responsive[1]
+    return _compress_url(url)
+
+
+def _expand_responsive_url(thumburl: str, url: Union[int, str]) -> str:
+    if isinstance(url, int):
+        thumb = _split_thumb_url(thumburl)
+        assert thumb is not None
+        return '%s%d%s' % (thumb[0], url, thumb[2])
+    return _expand_url(url)
+
+
+def _share_responsive(responsive: tuple) -> tuple:
+    if not all(isinstance(url, int) for factor, url in responsive):
+        return responsive
+    shared = _shared_responsive.get(responsive)
+    if shared is not None:
+        return shared
+    if len(_shared_responsive) < _SHARED_RESPONSIVE_MAX:
+        _shared_responsive[responsive] = responsive
+    return responsive
+
+
+def parse_timestamp(timestamp: str) -> int:
+    """Parse a MediaWiki API timestamp (e.g. 2001-01-15T14:56:00Z)."""
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def format_timestamp(timestamp: int) -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+class ImageInfo:
+    """The imageinfo of a file, as far as the tool uses it.
+
+    Has the same thumburl, thumbwidth, thumbheight and responsiveUrls
+    attributes as the imageinfo dict returned by the API,
+    so that templates can use either, as well as the metadata
+    used by the pre-filters (see filters.py), if the API returned it:
+    mime, size, width, height and timestamp
+    (the latter as seconds since the epoch, not as a string),
+    and the SHA-1 of the file (as an int, not as a hex string),
+    which identifies the file contents (see duplicates.py).
+    """
+
+    __slots__ = ('_thumburl', 'thumbwidth', 'thumbheight', '_responsive',
+                 'mime', 'size', 'width', 'height', 'timestamp', 'sha1')
+
+    def __init__(self,
+                 thumburl: str,
+                 thumbwidth: Optional[int],
+                 thumbheight: Optional[int],
+                 responsive: Sequence[Tuple[str, str]] = (),
+                 *,
+                 mime: Optional[str] = None,
+                 size: Optional[int] = None,
+                 width: Optional[int] = None,
+                 height: Optional[int] = None,
+                 timestamp: Optional[int] = None,
+                 sha1: Optional[int] = None):
+        """Create an instance.
+
+        responsive holds the (factor, URL) pairs of the responsiveUrls.
+        """
+        self._thumburl = _compress_url(thumburl)
+        self.thumbwidth = thumbwidth
+        self.thumbheight = thumbheight
+        self._responsive = _share_responsive(tuple(
+            (sys.intern(factor), _compress_responsive_url(thumburl, url))
+            for factor, url in responsive))
+        # there are only a few different MIME types
+        self.mime = sys.intern(mime) if mime is not None else None
+        self.size = size
+        self.width = width
+        self.height = height
+        self.timestamp = timestamp
+        self.sha1 = sha1
+
+    @classmethod
+    def from_api(cls, imageinfo: Mapping[str, Any]) -> 'ImageInfo':
+        """Create an instance from an imageinfo dict returned by the API."""
+        timestamp = imageinfo.get('timestamp')
+        sha1 = imageinfo.get('sha1')
+        return cls(imageinfo['thumburl'],
+                   imageinfo.get('thumbwidth'),
+                   imageinfo.get('thumbheight'),
+                   tuple(imageinfo.get('responsiveUrls', {}).items()),
+                   mime=imageinfo.get('mime'),
+                   size=imageinfo.get('size'),
+                   width=imageinfo.get('width'),
+                   height=imageinfo.get('height'),
+                   timestamp=parse_timestamp(timestamp)
+                   if timestamp is not None else None,
+                   sha1=int(sha1, 16) if sha1 is not None else None)
+
+    @property
+    def thumburl(self) -> str:
+        return _expand_url(self._thumburl)
+
+    @property
+    def responsiveUrls(self) -> dict[str, str]:
+        thumburl = self.thumburl
+        return {factor: _expand_responsive_url(thumburl, url)
+                for factor, url in self._responsive}
+
+    def thumburl_for(self, density: float) -> str:
+        """Get the URL of the thumbnail for a device pixel ratio.
+
+        Like a browser picking from the srcset of the responsiveUrls
+        (with the thumburl as 1x): the smallest factor that is at least
+        the density, or else the largest factor.
+        """
+        candidates = sorted([(1.0, self.thumburl)]
+                            + [(float(factor), url)
+                               for factor, url
+                               in self.responsiveUrls.items()])
+        for factor, url in candidates:
+            if factor >= density:
+                return url
+        return candidates[-1][1]
+
+    def to_json(self) -> dict[str, Any]:
+        """Convert to a dict in the same format as the API."""
+        json: dict[str, Any] = {
+            'thumburl': self.thumburl,
+            'thumbwidth': self.thumbwidth,
+            'thumbheight': self.thumbheight,
+        }
+        if self._responsive:
+            json['responsiveUrls'] = self.responsiveUrls
+        for name in ('mime', 'size', 'width', 'height'):
+            if getattr(self, name) is not None:
+                json[name] = getattr(self, name)
+        if self.timestamp is not None:
+            json['timestamp'] = format_timestamp(self.timestamp)
+        if self.sha1 is not None:
+            json['sha1'] = '%040x' % self.sha1
+        return json
+
+    def to_cached(self) -> tuple:
+        """Convert to a compact tuple that can be stored in the cache.
+
+        The shared cache backends store values as JSON
+        (turning the tuples into lists),
+        which is why this is not simply the instance itself.
+        """
+        return (self._thumburl,
+                self.thumbwidth,
+                self.thumbheight,
+                self._responsive,
+                self.mime,
+                self.size,
+                self.width,
+                self.height,
+                self.timestamp,
+                self.sha1)
+
+    @classmethod
+    def from_cached(cls, cached: Sequence) -> 'ImageInfo':
+        """Create an instance from the result of to_cached()."""
+        imageinfo = cls.__new__(cls)
+        thumburl, thumbwidth, thumbheight, responsive, \
+            mime, size, width, height, timestamp, sha1 = cached
+        imageinfo._thumburl = thumburl
+        imageinfo.thumbwidth = thumbwidth
+        imageinfo.thumbheight = thumbheight
+        imageinfo._responsive = _share_responsive(
+            tuple((sys.intern(factor), url) for factor, url in responsive))
+        imageinfo.mime = sys.intern(mime) if mime is not None else None
+        imageinfo.size = size
+        imageinfo.width = width
+        imageinfo.height = height
+        imageinfo.timestamp = timestamp
+        imageinfo.sha1 = sha1
+        return imageinfo
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ImageInfo):
+            return NotImplemented
+        return self.to_cached() == other.to_cached()
+
+    def __hash__(self) -> int:
+        return hash(self.to_cached())
+
+    def __repr__(self) -> str:
+        return 'ImageInfo(%r, %r, %r, %r)' % (
+            self.thumburl,
+            self.thumbwidth,
+            self.thumbheight,
+            tuple(self.responsiveUrls.items()),
+        )
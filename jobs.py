@@ -0,0 +1,187 @@
+"""A small job queue in an SQLite database, for work that may take
+longer than a request is allowed to (e.g. creating huge piles).
+
+The database file can be shared between several processes, and jobs
+survive restarts: each process runs one worker thread, and a worker
+only leases a job for a limited time, so that a job whose worker died
+is picked up again once the lease expires.
+"""
+
+import json
+import logging
+import random
+import string
+import threading
+import time
+from typing import Any, Callable, NamedTuple, Optional
+
+from cache import SqliteConnections
+
+
+_logger = logging.getLogger(__name__)
+
+
+class Job(NamedTuple):
+    id: str
+    state: str  # 'queued', 'running', 'done' or 'failed'
+    params: Any
+    result: Any
+    error: Optional[str]
+    attempts: int
+
+
+class JobQueue:
+    """A queue of jobs, all handled by the same handler function.
+
+    The handler is called with the params of a job (anything that can
+    be serialized as JSON) and returns its result (likewise).
+    If it raises an exception, the job is retried up to retries times,
+    with exponential backoff; after that, it is marked as failed.
+    """
+
+    def __init__(self,
+                 path: str,
+                 handler: Callable[[Any], Any],
+                 retries: int = 3,
+                 backoff: float = 5,
+                 lease: float = 15 * 60,
+                 poll_interval: float = 5):
+        self.path = path
+        self.handler = handler
+        self.retries = retries
+        self.backoff = backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._connections = SqliteConnections(path)
+        self._wakeup = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+        with self._connections.get() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                               'id TEXT PRIMARY KEY, '
+                               'state TEXT NOT NULL, '
+                               'params TEXT NOT NULL, '
+                               'result TEXT, '
+                               'error TEXT, '
+                               'attempts INTEGER NOT NULL DEFAULT 0, '
+                               'not_before REAL NOT NULL, '
+                               'created REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS jobs_pending '
+                               'ON jobs (state, not_before)')
+
+    def after_fork(self) -> None:
+        """Reset the state inherited from a parent process.
+
+        The database connections must not be used across a fork,
+        and the worker thread of the parent does not exist in the child
+        (call start() to start one).
+        """
+        self._connections.after_fork()
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def submit(self, params: Any) -> str:
+        """Add a job to the queue and return its ID.
+
+        The IDs are random, so that users cannot look at each other's jobs.
+        """
+        characters = string.ascii_letters + string.digits
+        id = ''.join(random.SystemRandom().choice(characters)
+                     for _ in range(32))
+        now = time.time()
+        with self._connections.get() as connection:
+            connection.execute('INSERT INTO jobs '
+                               '(id, state, params, not_before, created) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               (id, 'queued', json.dumps(params), now, now))
+        self._wakeup.set()
+        return id
+
+    def get(self, id: str) -> Optional[Job]:
+        row = self._connections.get().execute(
+            'SELECT id, state, params, result, error, attempts '
+            'FROM jobs WHERE id = ?',
+            (id,),
+        ).fetchone()
+        if row is None:
+            return None
+        id, state, params, result, error, attempts = row
+        return Job(id,
+                   state,
+                   json.loads(params),
+                   json.loads(result) if result is not None else None,
+                   error,
+                   attempts)
+
+    def _claim(self) -> Optional[Job]:
+        now = time.time()
+        with self._connections.get() as connection:
+            # queued jobs, and running jobs whose lease expired
+            # (not_before doubles as the end of the lease)
+            row = connection.execute(
+                'UPDATE jobs SET state = ?, attempts = attempts + 1, '
+                'not_before = ? '
+                'WHERE id = ('
+                'SELECT id FROM jobs '
+                'WHERE state IN (?, ?) AND not_before <= ? '
+                'ORDER BY not_before LIMIT 1) '
+                'RETURNING id, state, params, attempts',
+                ('running', now + self.lease, 'queued', 'running', now),
+            ).fetchone()
+        if row is None:
+            return None
+        id, state, params, attempts = row
+        return Job(id, state, json.loads(params), None, None, attempts)
+
+    def run_pending(self) -> bool:
+        """Run one pending job, if there is one.
+
+        Returns whether a job was run (successfully or not).
+        """
+        job = self._claim()
+        if job is None:
+            return False
+        try:
+            result = self.handler(job.params)
+        except Exception as e:
+            _logger.warning('Job %s failed (attempt %d)',
+                            job.id, job.attempts, exc_info=True)
+            if job.attempts <= self.retries:
+                state = 'queued'
+                not_before = time.time() \
+                    + self.backoff * 2 ** (job.attempts - 1)
+            else:
+                state = 'failed'
+                not_before = time.time()
+            with self._connections.get() as connection:
+                connection.execute('UPDATE jobs SET state = ?, error = ?, '
+                                   'not_before = ? WHERE id = ?',
+                                   (state, str(e), not_before, job.id))
+            return True
+        with self._connections.get() as connection:
+            connection.execute('UPDATE jobs SET state = ?, result = ?, '
+                               'error = NULL WHERE id = ?',
+                               ('done', json.dumps(result), job.id))
+        return True
+
+    def start(self) -> None:
+        """Start the worker thread of this process, unless it is running."""
+        with self._worker_lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._work,
+                                            name='job-worker',
+                                            daemon=True)
+            self._worker.start()
+
+    def _work(self) -> None:
+        while True:
+            try:
+                if self.run_pending():
+                    continue
+            except Exception:
+                _logger.warning('Job worker error', exc_info=True)
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
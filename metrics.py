@@ -0,0 +1,226 @@
+"""Minimal metrics in the Prometheus text exposition format.
+
+The metrics are kept in the memory of each worker process,
+so with several gunicorn workers, /metrics only shows the numbers
+of the worker that happened to serve the scrape.
+"""
+
+import contextlib
+import flask
+import math
+import threading
+import time
+from typing import Iterator, Sequence
+
+
+def _format_labels(labels: Sequence[tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, value.replace('\\', '\\\\')
+                                       .replace('"', '\\"')
+                                       .replace('\n', '\\n'))
+                          for name, value in labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[tuple[tuple[str, str], ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def expose(self) -> Iterator[str]:
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s counter' % self.name
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                yield '%s%s %s' % (self.name,
+                                   _format_labels(key),
+                                   _format_value(value))
+
+
+class Gauge:
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[tuple[tuple[str, str], ...], float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def expose(self) -> Iterator[str]:
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s gauge' % self.name
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                yield '%s%s %s' % (self.name,
+                                   _format_labels(key),
+                                   _format_value(value))
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.buckets = [*sorted(buckets), math.inf]
+        self._values: dict[tuple[tuple[str, str], ...],
+                           tuple[list[int], float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0.0))
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    counts[i] += 1
+            self._values[key] = counts, total + value
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            counts, total = self._values.get(
+                tuple(sorted(labels.items())), ([0], 0.0))
+            return counts[-1]
+
+    def expose(self) -> Iterator[str]:
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s histogram' % self.name
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bucket, count in zip(self.buckets, counts):
+                    le = (('le', _format_value(bucket)),)
+                    yield '%s_bucket%s %d' % (self.name,
+                                              _format_labels(key + le),
+                                              count)
+                yield '%s_sum%s %s' % (self.name,
+                                       _format_labels(key),
+                                       _format_value(total))
+                yield '%s_count%s %d' % (self.name,
+                                         _format_labels(key),
+                                         counts[-1])
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+upstream_duration = Histogram(
+    'pagepile_visual_filter_upstream_duration_seconds',
+    'Duration of calls to PagePile and the MediaWiki API.',
+    LATENCY_BUCKETS)
+render_duration = Histogram(
+    'pagepile_visual_filter_render_duration_seconds',
+    'Duration of template rendering.',
+    LATENCY_BUCKETS)
+cache_requests = Counter(
+    'pagepile_visual_filter_cache_requests_total',
+    'Cache lookups, by cache and result (hit or miss).')
+pile_size = Histogram(
+    'pagepile_visual_filter_pile_size',
+    'Number of pages in the piles that were viewed.',
+    (10, 100, 1000, 10_000, 100_000))
+imageinfo_batch_size = Histogram(
+    'pagepile_visual_filter_imageinfo_batch_size',
+    'Number of titles per successful imageinfo query.',
+    (1, 10, 50, 100, 500))
+upstream_retries = Counter(
+    'pagepile_visual_filter_upstream_retries_total',
+    'Retried upstream calls, by reason (maxlag, toomanyvalues or failure).')
+coalesced_requests = Counter(
+    'pagepile_visual_filter_coalesced_requests_total',
+    'Loads shared with a concurrent request for the same pile or chunk, '
+    'by kind (pile or imageinfo) and scope (process or shared).')
+shed_requests = Counter(
+    'pagepile_visual_filter_shed_requests_total',
+    'Upstream calls refused to shed load, by host and reason '
+    '(deadline, circuit or limit).')
+upstream_concurrency_limit = Gauge(
+    'pagepile_visual_filter_upstream_concurrency_limit',
+    'Current adaptive limit of concurrent calls to each upstream host.')
+upstream_circuit_open = Gauge(
+    'pagepile_visual_filter_upstream_circuit_open',
+    'Whether the circuit breaker of each upstream host is open '
+    '(1, including half-open) or closed (0).')
+
+registry: list[Counter | Gauge | Histogram] = [
+    upstream_duration,
+    render_duration,
+    cache_requests,
+    pile_size,
+    imageinfo_batch_size,
+    upstream_retries,
+    coalesced_requests,
+    shed_requests,
+    upstream_concurrency_limit,
+    upstream_circuit_open,
+]
+
+
+def expose() -> str:
+    """Return all metrics in the text exposition format."""
+    return ''.join(line + '\n'
+                   for metric in registry
+                   for line in metric.expose())
+
+
+@contextlib.contextmanager
+def timed(histogram: Histogram, name: str, **labels: str) -> Iterator[None]:
+    """Time the enclosed block into the given histogram.
+
+    The name is used as the value of the histogram's "operation" label
+    and, if there is a request context, also added to the timings
+    for the Server-Timing header of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        histogram.observe(duration, operation=name, **labels)
+        if flask.has_request_context():
+            with _server_timings_lock:
+                timings = flask.g.setdefault('server_timings', {})
+                count, total = timings.get(name, (0, 0.0))
+                timings[name] = count + 1, total + duration
+
+
+# flask.g is shared with the threads that load imageinfo chunks
+_server_timings_lock = threading.Lock()
+
+
+def server_timing_header() -> str:
+    """Format the timings of the current request as a Server-Timing header.
+
+    Timings of operations that happened several times (e.g. chunks)
+    are summed up, even if they overlapped in time.
+    """
+    timings = flask.g.get('server_timings', {})
+    return ', '.join('%s;desc="%d calls";dur=%.1f' % (name,
+                                                      count,
+                                                      total * 1000)
+                     for name, (count, total) in timings.items())
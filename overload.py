@@ -0,0 +1,489 @@
+"""Load shedding for the calls to the upstreams (PagePile and the wikis).
+
+When an upstream slows down, the requests of a worker would otherwise
+all wait for it until they time out, while new requests queue up behind
+them. Instead, each call to an upstream host goes through:
+
+- a circuit breaker, which refuses calls to a host that keeps failing
+  (after several consecutive failures, for a cooldown period);
+- an adaptive concurrency limit (AIMD: additive increase,
+  multiplicative decrease), which lowers the number of concurrent calls
+  to the host when they get slow or fail, and raises it again while
+  they are fast; calls wait only briefly for a free slot;
+- the deadline of the request, which caps the timeout of each call
+  to the time the request has left, and only leaves time for retries
+  of failed calls (see Upstreams.run()) while the request has some left.
+
+Calls that are refused for one of these reasons raise Overloaded,
+which the app turns into a 503 response. The state is kept per worker.
+"""
+
+import aiohttp
+import contextlib
+import mwapi  # type: ignore
+import requests
+import threading
+import time
+from typing import AsyncIterator, Callable, Iterator, NamedTuple, Optional, \
+    TypeVar
+
+from http_session import unavailable
+import metrics
+
+
+T = TypeVar('T')
+
+
+class Overloaded(Exception):
+    """An upstream call was refused to shed load.
+
+    The reason is "deadline", "circuit" or "limit";
+    retry_after is how many seconds a client should wait
+    before trying again.
+    """
+
+    def __init__(self, message: str, reason: str, retry_after: float = 1):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def is_failure(error: BaseException) -> bool:
+    """Whether the error means that the upstream is unavailable.
+
+    Connection errors, timeouts (including the ones wrapped by mwapi)
+    and HTTP errors with a 429 or 5xx status are failures;
+    API errors and other HTTP errors are not, since the upstream answered.
+    """
+    if isinstance(error.__cause__, mwapi.errors.APIError):
+        # mwapi.AsyncSession wraps API errors in RequestErrors
+        return False
+    status = _status(error)
+    if status is not None:
+        return unavailable(status)
+    return isinstance(error, (OSError, aiohttp.ClientError))
+
+
+def _status(error: BaseException) -> Optional[int]:
+    # the HTTP status of a requests or aiohttp error,
+    # which mwapi wraps in its own errors
+    for e in (error, error.__cause__):
+        if isinstance(e, requests.HTTPError) and e.response is not None:
+            return e.response.status_code
+        if isinstance(e, aiohttp.ClientResponseError):
+            return e.status
+    return None
+
+
+class AdaptiveLimit:
+    """A concurrency limit, adjusted by AIMD.
+
+    A call that failed or took longer than latency_target seconds
+    multiplies the limit by backoff (at most once per latency_target,
+    so that a burst of calls that were slow together counts once);
+    any other call adds 1 / limit, that is, the limit grows by one
+    for each limit's worth of fast calls, as long as at least half of it
+    is in use (an idle limit says nothing about the upstream).
+    """
+
+    def __init__(self,
+                 initial: int = 10,
+                 minimum: int = 1,
+                 maximum: int = 50,
+                 latency_target: float = 5,
+                 backoff: float = 0.5,
+                 clock: Callable[[], float] = time.monotonic):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self._clock = clock
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._decreased = -latency_target
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def acquire(self, timeout: float) -> bool:
+        """Take a slot, waiting up to timeout seconds for one.
+
+        Returns False if no slot became free in time.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self._in_flight += 1
+            return True
+
+    def release(self,
+                latency: Optional[float] = None,
+                failed: bool = False) -> None:
+        """Give back a slot, adjusting the limit to the call's outcome.
+
+        The limit is not adjusted if latency is None
+        (e.g. the call was not made after all).
+        """
+        with self._condition:
+            in_use = self._in_flight
+            self._in_flight -= 1
+            if latency is not None:
+                now = self._clock()
+                if failed or latency > self.latency_target:
+                    if now - self._decreased >= self.latency_target:
+                        self._decreased = now
+                        self._limit = max(self.minimum,
+                                          self._limit * self.backoff)
+                elif in_use >= self._limit / 2:
+                    self._limit = min(self.maximum,
+                                      self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """Refuses calls to a host that keeps failing.
+
+    After failure_threshold consecutive failed calls, the circuit opens,
+    and calls are refused for reset_timeout seconds; then it is half-open:
+    one trial call is let through, which closes the circuit if it succeeds
+    and opens it again if it fails.
+    """
+
+    def __init__(self,
+                 failure_threshold: int = 5,
+                 reset_timeout: float = 30,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """"closed", "open" or "half-open"."""
+        with self._lock:
+            if self._opened is None:
+                return 'closed'
+            if self._clock() - self._opened < self.reset_timeout:
+                return 'open'
+            return 'half-open'
+
+    def retry_after(self) -> float:
+        """Seconds until the circuit lets a trial call through."""
+        with self._lock:
+            if self._opened is None:
+                return 0
+            return max(self._opened + self.reset_timeout - self._clock(), 0)
+
+    def allow(self) -> bool:
+        """Whether a call may be made now; it must then be recorded."""
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial \
+               or self._clock() - self._opened < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record(self, success: Optional[bool]) -> None:
+        """Record the outcome of an allowed call.
+
+        None means that the call was not made after all.
+        """
+        with self._lock:
+            self._trial = False
+            if success is None:
+                return
+            if success:
+                self._failures = 0
+                self._opened = None
+                return
+            self._failures += 1
+            if self._opened is not None \
+               or self._failures >= self.failure_threshold:
+                self._opened = self._clock()
+
+
+class _Upstream(NamedTuple):
+    breaker: CircuitBreaker
+    limit: AdaptiveLimit
+
+
+class Upstreams:
+    """The circuit breakers and concurrency limits of the upstream hosts.
+
+    The hosts are identified by name (e.g. the domain of a wiki),
+    and their state is created on first use.
+    A host counts as degraded while its circuit is open,
+    or for degraded_window seconds after a call was refused
+    because its limit was reached.
+    """
+
+    def __init__(self,
+                 initial_limit: int = 50,
+                 max_limit: int = 100,
+                 latency_target: float = 5,
+                 queue_timeout: float = 2,
+                 failure_threshold: int = 5,
+                 reset_timeout: float = 30,
+                 retries: int = 3,
+                 backoff: float = 0.5,
+                 degraded_window: float = 10):
+        self.initial_limit = initial_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.queue_timeout = queue_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.degraded_window = degraded_window
+        self._upstreams: dict[str, _Upstream] = {}
+        self._refused: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _upstream(self, host: str) -> _Upstream:
+        with self._lock:
+            try:
+                return self._upstreams[host]
+            except KeyError:
+                upstream = self._upstreams[host] = _Upstream(
+                    CircuitBreaker(self.failure_threshold,
+                                   self.reset_timeout),
+                    AdaptiveLimit(self.initial_limit,
+                                  maximum=self.max_limit,
+                                  latency_target=self.latency_target))
+                return upstream
+
+    def check(self,
+              host: str,
+              deadline: Optional[float] = None,
+              delay: float = 0) -> None:
+        """Raise Overloaded if a call to the host would be refused
+        after waiting delay seconds (e.g. before retrying a call).
+
+        Also used before a response starts streaming,
+        after which it is too late to respond with an error.
+        """
+        remaining = _remaining(host, deadline)
+        if remaining is not None and delay >= remaining:
+            raise _shed(host, 'deadline')
+        breaker = self._upstream(host).breaker
+        if breaker.state == 'open' and breaker.retry_after() > delay:
+            raise _shed(host, 'circuit', breaker.retry_after())
+
+    @contextlib.contextmanager
+    def call(self,
+             host: str,
+             timeout: float,
+             deadline: Optional[float] = None,
+             expect_slow: bool = False) -> Iterator[float]:
+        """Guard one call to the host, yielding the timeout to use for it.
+
+        The timeout is capped to the time left until the deadline
+        (a time.monotonic() value, or None if there is none);
+        if the call fails once the deadline has passed,
+        Overloaded is raised instead of the error,
+        and the failure does not count against the host.
+        Calls that may take longer than the latency target
+        without the host being slow (expect_slow, e.g. uploads)
+        only lower the host's limit if they fail.
+        Waits up to queue_timeout seconds for a slot of the host's limit.
+        """
+        upstream, timeout = self._enter(host,
+                                        timeout,
+                                        deadline,
+                                        self.queue_timeout)
+        start = time.monotonic()
+        success: Optional[bool] = True
+        try:
+            yield timeout
+        except BaseException as e:
+            success = _success(deadline, e)
+            if success is None:
+                raise _shed(host, 'deadline') from e
+            raise
+        finally:
+            self._exit(host,
+                       upstream,
+                       success,
+                       None if expect_slow and success
+                       else time.monotonic() - start)
+
+    def run(self,
+            host: str,
+            function: Callable[[float], T],
+            timeout: float,
+            deadline: Optional[float] = None) -> T:
+        """Make a call to the host with call(), retrying it if it fails.
+
+        function makes the call, with the timeout to use for it.
+        Failed calls (see is_failure()) are retried up to retries times,
+        after backoff seconds, doubled on each retry (or the Retry-After
+        of the response, if longer), as long as there is time left until
+        the deadline; otherwise, Overloaded is raised.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.call(host, timeout, deadline) as attempt_timeout:
+                    return function(attempt_timeout)
+            except Overloaded:
+                raise
+            except Exception as e:
+                if attempt >= self.retries or not is_failure(e):
+                    raise
+                delay = max(self.backoff * 2 ** attempt, _retry_after(e))
+                try:
+                    self.check(host, deadline, delay)
+                except Overloaded as overloaded:
+                    raise overloaded from e
+            metrics.upstream_retries.inc(reason='failure')
+            time.sleep(delay)
+            attempt += 1
+
+    @contextlib.asynccontextmanager
+    async def call_async(self,
+                         host: str,
+                         timeout: float,
+                         deadline: Optional[float] = None,
+                         ) -> AsyncIterator[float]:
+        """Like call(), but never waits for a slot.
+
+        Waiting would block the event loop, so if the host's limit
+        is reached, the call is refused immediately.
+        """
+        upstream, timeout = self._enter(host, timeout, deadline, 0)
+        start = time.monotonic()
+        success: Optional[bool] = True
+        try:
+            yield timeout
+        except BaseException as e:
+            success = _success(deadline, e)
+            if success is None:
+                raise _shed(host, 'deadline') from e
+            raise
+        finally:
+            self._exit(host, upstream, success, time.monotonic() - start)
+
+    def _enter(self,
+               host: str,
+               timeout: float,
+               deadline: Optional[float],
+               queue_timeout: float) -> tuple[_Upstream, float]:
+        remaining = _remaining(host, deadline)
+        upstream = self._upstream(host)
+        if not upstream.breaker.allow():
+            raise _shed(host, 'circuit', upstream.breaker.retry_after())
+        if remaining is not None:
+            queue_timeout = min(queue_timeout, remaining)
+        if not upstream.limit.acquire(queue_timeout):
+            upstream.breaker.record(None)
+            with self._lock:
+                self._refused[host] = time.monotonic()
+            raise _shed(host, 'limit')
+        try:
+            # the wait for the slot took some of the remaining time
+            remaining = _remaining(host, deadline)
+        except Overloaded:
+            upstream.limit.release()
+            upstream.breaker.record(None)
+            raise
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        return upstream, timeout
+
+    def _exit(self,
+              host: str,
+              upstream: _Upstream,
+              success: Optional[bool],
+              latency: Optional[float]) -> None:
+        # None: the outcome says nothing about the host
+        if success is None:
+            upstream.limit.release()
+        else:
+            upstream.limit.release(latency, failed=not success)
+        upstream.breaker.record(success)
+        metrics.upstream_concurrency_limit.set(upstream.limit.limit,
+                                               host=host)
+        metrics.upstream_circuit_open.set(
+            0 if upstream.breaker.state == 'closed' else 1,
+            host=host)
+
+    def status(self) -> dict[str, dict]:
+        """The state of each host, e.g. for a health check."""
+        with self._lock:
+            upstreams = dict(self._upstreams)
+        return {host: {'circuit': upstream.breaker.state,
+                       'limit': upstream.limit.limit,
+                       'in_flight': upstream.limit.in_flight,
+                       'degraded': self.degraded(host)}
+                for host, upstream in sorted(upstreams.items())}
+
+    def degraded(self, host: str) -> bool:
+        """Whether calls to the host are currently being refused."""
+        with self._lock:
+            upstream = self._upstreams.get(host)
+            refused = self._refused.get(host)
+        if upstream is None:
+            return False
+        return upstream.breaker.state == 'open' \
+            or (refused is not None
+                and time.monotonic() - refused < self.degraded_window)
+
+
+def _retry_after(error: BaseException) -> float:
+    # the Retry-After of a response (e.g. a 429 or 503) in seconds, or 0
+    for e in (error, error.__cause__):
+        if isinstance(e, requests.HTTPError) and e.response is not None:
+            try:
+                return float(e.response.headers.get('Retry-After', 0))
+            except ValueError:
+                return 0  # an HTTP date, not worth waiting for
+    return 0
+
+
+def _success(deadline: Optional[float],
+             error: BaseException) -> Optional[bool]:
+    # the outcome of a call that raised the error
+    if not is_failure(error):
+        return True
+    if deadline is not None and time.monotonic() >= deadline:
+        # it failed because it only got the time the request had left
+        # (e.g. a timeout): the request is out of time,
+        # which says nothing about the host
+        return None
+    return False
+
+
+def _remaining(host: str, deadline: Optional[float]) -> Optional[float]:
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise _shed(host, 'deadline')
+    return remaining
+
+
+def _shed(host: str, reason: str, retry_after: float = 1) -> Overloaded:
+    metrics.shed_requests.inc(host=host, reason=reason)
+    messages = {
+        'deadline': 'out of time for a call to %s',
+        'circuit': '%s is failing',
+        'limit': 'too many concurrent calls to %s',
+    }
+    return Overloaded(messages[reason] % host, reason, retry_after)
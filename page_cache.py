@@ -0,0 +1,238 @@
+"""A cache of rendered pages, stored gzip-compressed.
+
+The gallery of a pile only depends on the pile (which never changes),
+the imageinfo of its files and the URL parameters, so each worker
+renders it once and keeps it in memory, compressed.
+The only part that differs between users is a secret (the CSRF token
+of the session): the parts of the page before and after it are
+compressed once, as separate deflate streams, so that for each response
+only the secret has to be compressed and put between them,
+without compressing the whole page again;
+the CRC-32 of the page is combined from those of the parts.
+Pages that are streamed to the client are compressed chunk by chunk
+(see PageCompressor), so that they are never held in memory in full.
+"""
+
+import cachetools
+import hashlib
+import struct
+import threading
+import zlib
+from typing import Hashable, NamedTuple, Optional, Sequence
+
+
+# gzip header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def _gf2_times(matrix: Sequence[int], vector: int) -> int:
+    # product of a 32x32 matrix over GF(2) (given by its columns)
+    # and a 32-bit vector
+    total = 0
+    for column in matrix:
+        if not vector:
+            break
+        if vector & 1:
+            total ^= column
+        vector >>= 1
+    return total
+
+
+def _gf2_square(matrix: Sequence[int]) -> list[int]:
+    return [_gf2_times(matrix, column) for column in matrix]
+
+
+def _crc32_shift(length: int) -> tuple[int, ...]:
+    """Get the operator that appends length zero bytes to a CRC-32.
+
+    As in zlib's crc32_combine(), the CRC-32 of a + b is then
+    _gf2_times(_crc32_shift(len(b)), crc32(a)) ^ crc32(b).
+    """
+    # one zero bit: the CRC polynomial (reversed), or shift right by one
+    operator = [0xedb88320] + [1 << i for i in range(31)]
+    for _ in range(3):  # two, four, eight zero bits
+        operator = _gf2_square(operator)
+    shift = [1 << i for i in range(32)]
+    while length:
+        if length & 1:
+            shift = [_gf2_times(operator, column) for column in shift]
+        length >>= 1
+        if length:
+            operator = _gf2_square(operator)
+    return tuple(shift)
+
+
+def _deflate(data: bytes, flush: int) -> bytes:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(flush)
+
+
+def _inflate(deflated: bytes) -> str:
+    return zlib.decompressobj(-zlib.MAX_WBITS).decompress(deflated) \
+        .decode('utf-8')
+
+
+class CachedPage(NamedTuple):
+    head: bytes  # raw deflate stream of the part before the secret
+    head_crc: int  # CRC-32 of that part
+    head_length: int  # length of that part, in bytes
+    tail: bytes  # raw deflate stream of the part after the secret
+    tail_crc: int
+    tail_length: int
+    tail_shift: tuple[int, ...]  # see _crc32_shift()
+    digest: str  # hash of both parts
+
+    @classmethod
+    def compress(cls, html: str, secret: str) -> Optional['CachedPage']:
+        """Split the page at the secret and compress the parts.
+
+        Returns None if the secret occurs more than once
+        (it would end up in a cached part), or not at all.
+        """
+        compressor = PageCompressor(secret)
+        compressor.write(html)
+        return compressor.close()
+
+    def gzip(self, secret: str) -> bytes:
+        """Get the whole page, with the given secret, as gzip data."""
+        data = secret.encode('utf-8')
+        crc = zlib.crc32(data, self.head_crc)
+        crc = _gf2_times(self.tail_shift, crc) ^ self.tail_crc
+        return b''.join([
+            _GZIP_HEADER,
+            self.head,
+            _deflate(data, zlib.Z_SYNC_FLUSH),
+            self.tail,
+            struct.pack('<II',
+                        crc,
+                        (self.head_length + len(data) + self.tail_length)
+                        & 0xffffffff),
+        ])
+
+    def text(self, secret: str) -> str:
+        """Get the whole page, with the given secret, uncompressed."""
+        return _inflate(self.head) + secret + _inflate(self.tail)
+
+    def etag(self, secret: str) -> str:
+        """Get an entity tag for the whole page, with the given secret.
+
+        The secret is hashed into the tag, rather than included in it.
+        """
+        return hashlib.sha256(
+            (self.digest + secret).encode('utf-8'),
+        ).hexdigest()[:32]
+
+
+class PageCompressor:
+    """Compresses a page into a CachedPage, one chunk at a time.
+
+    Only the compressed parts are kept, plus the last few characters
+    of the text, which may be the beginning of the secret.
+    """
+
+    def __init__(self, secret: str):
+        self.secret = secret
+        self._head: Optional[tuple[bytes, int, int]] = None
+        self._pending = ''
+        self._failed = False
+        self._digest = hashlib.sha256()
+        self._start_part()
+
+    def _start_part(self) -> None:
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._deflated: list[bytes] = []
+        self._crc = 0
+        self._length = 0
+
+    def _compress(self, text: str) -> None:
+        data = text.encode('utf-8')
+        self._deflated.append(self._compressor.compress(data))
+        self._crc = zlib.crc32(data, self._crc)
+        self._length += len(data)
+        self._digest.update(data)
+
+    def write(self, chunk: str) -> None:
+        if self._failed:
+            return
+        # plain str, since a Markup chunk (e.g. from flask.stream_template)
+        # would escape the text it is concatenated with
+        text = self._pending + str(chunk)
+        if self._head is None:
+            head, found, text = text.partition(self.secret)
+            if not found:
+                text = head
+            else:
+                self._compress(head)
+                # a sync flush ends the data on a byte boundary, without
+                # a final block, so that another deflate stream can be
+                # appended to it
+                self._deflated.append(
+                    self._compressor.flush(zlib.Z_SYNC_FLUSH))
+                self._head = b''.join(self._deflated), self._crc, self._length
+                self._digest.update(b'\0')
+                self._start_part()
+        if self._head is not None and self.secret in text:
+            # it would end up in the tail
+            self._failed = True
+            self._deflated = []
+            return
+        split = max(len(text) - len(self.secret) + 1, 0)
+        self._compress(text[:split])
+        self._pending = text[split:]
+
+    def close(self) -> Optional[CachedPage]:
+        """Get the compressed page.
+
+        Returns None if the secret occurred more than once, or not at all.
+        """
+        if self._failed or self._head is None:
+            return None
+        self._compress(self._pending)
+        self._pending = ''
+        self._deflated.append(self._compressor.flush(zlib.Z_FINISH))
+        head, head_crc, head_length = self._head
+        return CachedPage(head,
+                          head_crc,
+                          head_length,
+                          b''.join(self._deflated),
+                          self._crc,
+                          self._length,
+                          _crc32_shift(self._length),
+                          self._digest.hexdigest())
+
+
+class PageCache:
+    """An in-process cache of CachedPages, bounded by compressed size."""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self._cache: cachetools.TTLCache[Hashable, CachedPage] = \
+            cachetools.TTLCache(maxsize=max_bytes,
+                                ttl=ttl,
+                                getsizeof=lambda page: (len(page.head)
+                                                        + len(page.tail)))
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[CachedPage]:
+        with self._lock:
+            return self._cache.get(key)
+
+    def put(self,
+            key: Hashable,
+            html: str,
+            secret: str) -> Optional[CachedPage]:
+        """Compress a page and cache it (if it fits).
+
+        Returns None if the page cannot be cached (see CachedPage.compress).
+        """
+        page = CachedPage.compress(html, secret)
+        if page is not None:
+            self.put_page(key, page)
+        return page
+
+    def put_page(self, key: Hashable, page: CachedPage) -> None:
+        """Cache an already compressed page (if it fits)."""
+        with self._lock:
+            try:
+                self._cache[key] = page
+            except ValueError:
+                pass  # larger than the whole cache
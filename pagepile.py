@@ -1,29 +1,89 @@
+import aiohttp
 import mwapi  # type: ignore
-import requests
+import sys
 from typing import Iterable, Optional, Sequence, Tuple
 
+from http_session import raise_if_unavailable, unavailable
+import metrics
 import sitematrix
 
 
+# can be changed to point to a different PagePile installation
+api_url = 'https://pagepile.toolforge.org/api.php'
+
+
 def load_pagepile(session: mwapi.Session,
                   id: int) -> Optional[Tuple[str, Sequence[str]]]:
+    """Load the given PagePile, as the domain of its wiki and its pages.
+
+    The request to PagePile reuses the HTTP session (connection pool),
+    user agent and timeout of the given MediaWiki API session,
+    which is also used to look up the domain in the sitematrix.
+    """
+    pile = fetch_pagepile(session, id)
+    if pile is None:
+        return None
+    dbname, pages = pile
+    return sitematrix.dbname_to_domain(session, dbname), pages
+
+
+def fetch_pagepile(session: mwapi.Session,
+                   id: int) -> Optional[Tuple[str, Sequence[str]]]:
+    """Load the given PagePile, as the dbname of its wiki and its pages.
+
+    Unlike load_pagepile(), this only makes the request to PagePile,
+    so that the sitematrix lookup can be made separately
+    (e.g. not counted as a call to PagePile, see app._load_pagepile()).
+    Raises an HTTPError if PagePile is unavailable (429 or 5xx).
+    """
+    params: dict[str, int | str] = {
+        'id': id,
+        'action': 'get_data',
+        'format': 'json',
+    }
+    with metrics.timed(metrics.upstream_duration, 'load_pagepile'):
+        r = session.session.get(api_url,
+                                params=params,
+                                headers=session.headers,
+                                timeout=session.timeout)
+    raise_if_unavailable(r)
     try:
-        params: dict[str, int | str] = {
-            'id': id,
-            'action': 'get_data',
-            'format': 'json',
-        }
-        r = requests.get('https://pagepile.toolforge.org/api.php',
-                         params=params)
         pile = r.json()
     except ValueError:
         # PagePile doesn’t properly catch most errors,
         # it just dumps them to the output, producing invalid JSON –
         # we simply treat them all as “no such pile”
         return None
-    domain = sitematrix.dbname_to_domain(session, pile['wiki'])
-    pages = [page.replace('_', ' ') for page in pile['pages']]
-    return domain, pages
+    return pile['wiki'], _pages(pile['pages'])
+
+
+async def fetch_pagepile_async(
+        http_session: aiohttp.ClientSession,
+        id: int,
+) -> Optional[Tuple[str, Sequence[str]]]:
+    """Like fetch_pagepile(), but asynchronous, with the aiohttp session."""
+    params = {
+        'id': str(id),
+        'action': 'get_data',
+        'format': 'json',
+    }
+    with metrics.timed(metrics.upstream_duration, 'load_pagepile'):
+        async with http_session.get(api_url, params=params) as r:
+            if unavailable(r.status):
+                r.raise_for_status()
+            try:
+                # PagePile doesn’t send a JSON content type
+                pile = await r.json(content_type=None)
+            except ValueError:
+                # see fetch_pagepile()
+                return None
+    return pile['wiki'], _pages(pile['pages'])
+
+
+def _pages(pages: Iterable[str]) -> Sequence[str]:
+    # interned, so that titles loaded again (e.g. with the imageinfo,
+    # or in another pile filtered from this one) share the same string
+    return [sys.intern(page.replace('_', ' ')) for page in pages]
 
 
 def _page_for_pagepile(page: str) -> str:
@@ -35,9 +95,33 @@ def _page_for_pagepile(page: str) -> str:
 def create_pagepile(session: mwapi.Session,
                     domain: str,
                     pages: Iterable[str]) -> int:
-    r = requests.post('https://pagepile.toolforge.org/api.php', data={
+    """Create a PagePile of the given pages of the wiki with the domain.
+
+    Like load_pagepile(), the session is also used
+    to look up the dbname of the wiki in the sitematrix.
+    """
+    return post_pagepile(session,
+                         sitematrix.domain_to_dbname(session, domain),
+                         pages)
+
+
+def post_pagepile(session: mwapi.Session,
+                  dbname: str,
+                  pages: Iterable[str]) -> int:
+    """Create a PagePile of the given pages of the wiki with the dbname.
+
+    Only makes the request to PagePile (see fetch_pagepile()).
+    Raises an HTTPError if PagePile is unavailable (429 or 5xx).
+    """
+    data = {
         'action': 'create_pile_with_data',
-        'wiki': sitematrix.domain_to_dbname(session, domain),
+        'wiki': dbname,
         'data': '\n'.join(map(_page_for_pagepile, pages)),
-    })
+    }
+    with metrics.timed(metrics.upstream_duration, 'create_pagepile'):
+        r = session.session.post(api_url,
+                                 data=data,
+                                 headers=session.headers,
+                                 timeout=session.timeout)
+    raise_if_unavailable(r)
     return r.json()['pile']['id']
@@ -0,0 +1,77 @@
+from typing import Iterable, Sequence
+
+
+def encode_selection(indices: Iterable[int]) -> str:
+    """Encode a set of indices into a pile as a compact string.
+
+    Consecutive indices are combined into runs, so that selecting
+    most (or very few) of the files in a pile stays short:
+    for example, [0, 1, 2, 3, 7, 9, 10] is encoded as "0-3,7,9-10".
+    static/compact-selection.js implements the same encoding.
+    """
+    return encode_runs(indices_to_runs(indices))
+
+
+def encode_runs(runs: Iterable[range]) -> str:
+    """Encode ascending, non-overlapping runs like encode_selection()."""
+    return ','.join(str(run.start) if len(run) == 1
+                    else '%d-%d' % (run.start, run.stop - 1)
+                    for run in runs if run)
+
+
+def indices_to_runs(indices: Iterable[int]) -> list[range]:
+    """Combine a set of indices into ascending runs of consecutive indices."""
+    runs: list[range] = []
+    for index in sorted(set(indices)):
+        if runs and runs[-1].stop == index:
+            runs[-1] = range(runs[-1].start, index + 1)
+        else:
+            runs.append(range(index, index + 1))
+    return runs
+
+
+def complement_runs(runs: Sequence[range], size: int) -> list[range]:
+    """Get the runs of indices (below size) that are not in the given runs.
+
+    The given runs must be ascending and non-overlapping,
+    as returned by decode_selection().
+    """
+    complement: list[range] = []
+    start = 0
+    for run in runs:
+        if run.start > start:
+            complement.append(range(start, run.start))
+        start = max(start, run.stop)
+    if start < size:
+        complement.append(range(start, size))
+    return complement
+
+
+def decode_selection(selection: str, size: int) -> list[range]:
+    """Decode a string produced by encode_selection().
+
+    Returns the runs of selected indices as ranges,
+    so that the cost of decoding depends only on the number of runs,
+    not on the number of selected files.
+    Raises ValueError if the string is malformed,
+    if any index is not in range for a pile of the given size,
+    or if the runs are not in ascending order.
+    """
+    runs: list[range] = []
+    if not selection:
+        return runs
+    for run in selection.split(','):
+        start_str, sep, end_str = run.partition('-')
+        if not start_str.isdigit() or sep and not end_str.isdigit():
+            raise ValueError('Malformed selection run: %r' % run)
+        start = int(start_str)
+        end = int(end_str) if sep else start
+        if end < start:
+            raise ValueError('Descending selection run: %r' % run)
+        if end >= size:
+            raise ValueError('Selection index %d out of range for '
+                             'pile of size %d' % (end, size))
+        if runs and start < runs[-1].stop:
+            raise ValueError('Selection runs overlap or are out of order')
+        runs.append(range(start, end + 1))
+    return runs
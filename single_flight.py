@@ -0,0 +1,307 @@
+"""Coalescing of concurrent identical upstream requests ("single flight").
+
+When a pile link is shared, many users open it at the same time;
+instead of each request loading the pile and its imageinfo on its own,
+the first request for a key (e.g. a pile ID) loads it,
+and concurrent requests for the same key wait for it and share the result.
+
+Within a process, the waiting requests get the result directly.
+Across processes (e.g. the workers of one gunicorn master),
+this requires a shared cache and a shared lock store:
+the loading process holds a lock in the store while it loads
+(and writes the result to the cache), and the other processes
+poll the cache until the lock is released or has expired.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import secrets
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from cache import Cache, RedisCache, SqliteCache, SqliteConnections
+import metrics
+
+
+T = TypeVar('T')
+
+_logger = logging.getLogger(__name__)
+
+
+class LockStore:
+    """Named locks shared by several processes, expiring after a time.
+
+    Each lock is held with a random token,
+    so that a process never releases a lock it no longer holds
+    (because it expired and was acquired by another process).
+    """
+
+    def acquire(self, key: str, token: str, ttl: float) -> bool:
+        """Try to acquire the lock without waiting; return whether it was."""
+        raise NotImplementedError
+
+    def release(self, key: str, token: str) -> None:
+        raise NotImplementedError
+
+    def after_fork(self) -> None:
+        """Drop any state that must not be shared with a parent process."""
+        pass
+
+
+class SqliteLockStore(LockStore):
+    """Locks in a table of an SQLite database file (e.g. the cache's)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connections = SqliteConnections(path)
+        with self._connections.get() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS locks ('
+                               'key TEXT PRIMARY KEY, '
+                               'token TEXT NOT NULL, '
+                               'expires REAL NOT NULL)')
+
+    def after_fork(self) -> None:
+        self._connections.after_fork()
+
+    def acquire(self, key: str, token: str, ttl: float) -> bool:
+        now = time.time()
+        with self._connections.get() as connection:
+            connection.execute('DELETE FROM locks '
+                               'WHERE key = ? AND expires <= ?',
+                               (key, now))
+            cursor = connection.execute('INSERT OR IGNORE INTO locks '
+                                        '(key, token, expires) '
+                                        'VALUES (?, ?, ?)',
+                                        (key, token, now + ttl))
+            return cursor.rowcount == 1
+
+    def release(self, key: str, token: str) -> None:
+        with self._connections.get() as connection:
+            connection.execute('DELETE FROM locks '
+                               'WHERE key = ? AND token = ?',
+                               (key, token))
+
+
+class RedisLockStore(LockStore):
+    """Locks in a Redis-compatible key-value store (e.g. the cache's).
+
+    Releasing a lock is not atomic (GET, then DEL), so a lock that
+    expires just while it is released may release the next holder's lock;
+    at worst, this makes two processes load the same thing.
+    """
+
+    def __init__(self, client: Any, prefix: str = 'ppvf:lock:'):
+        self.client = client
+        self.prefix = prefix
+
+    def acquire(self, key: str, token: str, ttl: float) -> bool:
+        return bool(self.client.set(self.prefix + key,
+                                    token,
+                                    nx=True,
+                                    px=int(ttl * 1000)))
+
+    def release(self, key: str, token: str) -> None:
+        if self.client.get(self.prefix + key) == token.encode('utf-8'):
+            self.client.delete(self.prefix + key)
+
+
+def make_lock_store(cache: Cache) -> Optional[LockStore]:
+    """Create a lock store next to the given cache, if it is shared.
+
+    With a cache that is not shared between processes,
+    other processes could not find the result in it anyway.
+    """
+    if isinstance(cache, SqliteCache):
+        return SqliteLockStore(cache.path)
+    if isinstance(cache, RedisCache):
+        return RedisLockStore(cache.client, prefix=cache.prefix + 'lock:')
+    return None
+
+
+def _kind(key: str) -> str:
+    # 'pile:123' => 'pile'
+    return key.split(':', 1)[0]
+
+
+class SingleFlight:
+    """Coalesces concurrent loads of the same key.
+
+    The loads of a key should store their result in the shared cache
+    (if there is one) before they return, and the lookup function
+    should find it there, so that other processes can use it;
+    lookup returns None if there is no result (yet).
+    If the lock of a key is held longer than lock_ttl seconds,
+    or the deadline of the waiting request passes,
+    the other processes stop waiting for it and load the key themselves.
+    """
+
+    def __init__(self,
+                 lock_store: Optional[LockStore] = None,
+                 lock_ttl: float = 60,
+                 poll_interval: float = 0.1):
+        self.lock_store = lock_store
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self._flights: dict[str, concurrent.futures.Future] = {}
+        self._flights_lock = threading.Lock()
+        # only used from the thread of the event loop (see asgi.py)
+        self._async_flights: dict[str, asyncio.Future] = {}
+
+    def after_fork(self) -> None:
+        if self.lock_store is not None:
+            self.lock_store.after_fork()
+
+    def run(self,
+            key: str,
+            load: Callable[[], T],
+            lookup: Callable[[], Optional[T]] = lambda: None,
+            deadline: Optional[float] = None) -> T:
+        """Load the key, unless a concurrent call is already loading it.
+
+        If the load raises an exception, it is raised in all the
+        calls that waited for it (within this process).
+        Waiting for another process ends at the deadline
+        (a time.monotonic() value, or None if there is none).
+        """
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if flight is None:
+                flight = self._flights[key] = concurrent.futures.Future()
+        if not leader:
+            metrics.coalesced_requests.inc(kind=_kind(key), scope='process')
+            return flight.result()
+        try:
+            value = self._run_locked(key, load, lookup, deadline)
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        else:
+            flight.set_result(value)
+            return value
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+
+    def _run_locked(self,
+                    key: str,
+                    load: Callable[[], T],
+                    lookup: Callable[[], Optional[T]],
+                    deadline: Optional[float]) -> T:
+        if self.lock_store is None:
+            return load()
+        token = secrets.token_hex(16)
+        wait_until = self._wait_until(deadline)
+        locked = waited = False
+        try:
+            while True:
+                locked = self.lock_store.acquire(key, token, self.lock_ttl)
+                if locked:
+                    break
+                waited = True
+                value = lookup()
+                if value is not None:
+                    metrics.coalesced_requests.inc(kind=_kind(key),
+                                                   scope='shared')
+                    return value
+                if time.monotonic() >= wait_until:
+                    # the other process seems to be stuck,
+                    # or the request is out of time (and the load fails fast)
+                    break
+                time.sleep(self.poll_interval)
+        except Exception:
+            _logger.warning('Lock store error', exc_info=True)
+        if not locked:
+            return load()
+        try:
+            # another process may have finished just before we got the lock
+            value = lookup() if waited else None
+            return value if value is not None else load()
+        finally:
+            try:
+                self.lock_store.release(key, token)
+            except Exception:
+                # it expires eventually
+                _logger.warning('Lock store error', exc_info=True)
+
+    def _wait_until(self, deadline: Optional[float]) -> float:
+        # how long to wait for the lock of another process
+        wait_until = time.monotonic() + self.lock_ttl
+        return wait_until if deadline is None else min(wait_until, deadline)
+
+    async def run_async(
+            self,
+            key: str,
+            load: Callable[[], Awaitable[T]],
+            lookup: Callable[[], Optional[T]] = lambda: None,
+            deadline: Optional[float] = None,
+    ) -> T:
+        """Like run(), but for asynchronous loads.
+
+        Concurrent calls are coalesced with each other,
+        but not with concurrent calls of run() in the same process;
+        the lock store and the lookup function are called in threads.
+        """
+        flight = self._async_flights.get(key)
+        if flight is not None:
+            metrics.coalesced_requests.inc(kind=_kind(key), scope='process')
+            # a cancelled waiter must not cancel the load for the others
+            return await asyncio.shield(flight)
+        flight = asyncio.get_running_loop().create_future()
+        self._async_flights[key] = flight
+        try:
+            value = await self._run_locked_async(key, load, lookup, deadline)
+        except BaseException as e:
+            flight.set_exception(e)
+            # don't warn about the exception if nobody waited for it
+            flight.exception()
+            raise
+        else:
+            flight.set_result(value)
+            return value
+        finally:
+            del self._async_flights[key]
+
+    async def _run_locked_async(
+            self,
+            key: str,
+            load: Callable[[], Awaitable[T]],
+            lookup: Callable[[], Optional[T]],
+            deadline: Optional[float],
+    ) -> T:
+        if self.lock_store is None:
+            return await load()
+        token = secrets.token_hex(16)
+        wait_until = self._wait_until(deadline)
+        locked = waited = False
+        try:
+            while True:
+                locked = await asyncio.to_thread(self.lock_store.acquire,
+                                                 key,
+                                                 token,
+                                                 self.lock_ttl)
+                if locked:
+                    break
+                waited = True
+                value = await asyncio.to_thread(lookup)
+                if value is not None:
+                    metrics.coalesced_requests.inc(kind=_kind(key),
+                                                   scope='shared')
+                    return value
+                if time.monotonic() >= wait_until:
+                    break
+                await asyncio.sleep(self.poll_interval)
+        except Exception:
+            _logger.warning('Lock store error', exc_info=True)
+        if not locked:
+            return await load()
+        try:
+            value = await asyncio.to_thread(lookup) if waited else None
+            return value if value is not None else await load()
+        finally:
+            try:
+                await asyncio.to_thread(self.lock_store.release, key, token)
+            except Exception:
+                _logger.warning('Lock store error', exc_info=True)
@@ -1,25 +1,98 @@
-import cachetools
+import json
+import logging
 import mwapi  # type: ignore
+import os
 import threading
-from typing import Any
+import time
+from typing import Any, Iterable, NamedTuple, Optional
 import warnings
 
+import metrics
 
-_sitematrix_cache: cachetools.TTLCache[Any, dict] = cachetools.TTLCache(
-    maxsize=1, ttl=24*60*60)
+
+# how long a sitematrix is considered fresh, in seconds;
+# after that, it is still used, but refreshed in the background
+ttl = 24*60*60
+
+# if set, the parsed sitematrix is also stored in this file,
+# so that new worker processes can start with it instead of fetching it
+persist_path: Optional[str] = None
+
+# '#sitematrix' => (time fetched, sitematrix)
+_sitematrix_cache: dict[str, tuple[float, dict]] = {}
 _sitematrix_cache_lock = threading.RLock()
+_refresh_thread: Optional[threading.Thread] = None
+
+_logger = logging.getLogger(__name__)
+
+
+class Capabilities(NamedTuple):
+    """What the tool can do with a wiki, according to the sitematrix."""
+    dbname: str
+    domain: str
+    # private wikis cannot be read by the tool's anonymous sessions
+    private: bool
+    # closed wikis are read-only, which is fine for this tool
+    closed: bool
+
+    @property
+    def supported(self) -> bool:
+        return not self.private
 
 
-@cachetools.cached(cache=_sitematrix_cache,
-                   key=lambda session: '#sitematrix',
-                   lock=_sitematrix_cache_lock)
 def _get_sitematrix(session: mwapi.Session) -> dict:
-    sitematrix: dict[str, dict[str, dict]] = {
+    """Get the sitematrix, fetching it if necessary.
+
+    Only the very first call (with nothing in memory or on disk)
+    fetches the sitematrix synchronously. Once the sitematrix is stale,
+    it keeps being returned while a background thread refreshes it
+    (stale-while-revalidate), so requests never block on the refresh.
+    """
+    global _refresh_thread
+    with _sitematrix_cache_lock:
+        entry = _sitematrix_cache.get('#sitematrix')
+        if entry is None and persist_path is not None:
+            entry = _load_persisted_sitematrix(persist_path)
+            if entry is not None:
+                _sitematrix_cache['#sitematrix'] = entry
+        if entry is None:
+            entry = _update_sitematrix(session)
+        fetched, sitematrix = entry
+        if time.time() - fetched > ttl and (
+                _refresh_thread is None or not _refresh_thread.is_alive()
+        ):
+            _refresh_thread = threading.Thread(target=_refresh_sitematrix,
+                                               args=(session,),
+                                               daemon=True)
+            _refresh_thread.start()
+        return sitematrix
+
+
+def _refresh_sitematrix(session: mwapi.Session) -> None:
+    try:
+        _update_sitematrix(session)
+    except Exception:
+        # keep serving the stale sitematrix, the next request will retry
+        _logger.warning('Could not refresh sitematrix', exc_info=True)
+
+
+def _update_sitematrix(session: mwapi.Session) -> tuple[float, dict]:
+    entry = time.time(), _fetch_sitematrix(session)
+    with _sitematrix_cache_lock:
+        _sitematrix_cache['#sitematrix'] = entry
+    if persist_path is not None:
+        _persist_sitematrix(persist_path, entry)
+    return entry
+
+
+def _fetch_sitematrix(session: mwapi.Session) -> dict:
+    sitematrix: dict[str, dict[str, Any]] = {
         'by_dbname': {},
         'by_url': {},
     }
-    result = session.get(action='sitematrix',
-                         formatversion=2)
+    with metrics.timed(metrics.upstream_duration, 'sitematrix'):
+        result = session.get(action='sitematrix',
+                             formatversion=2)
     for k, v in result['sitematrix'].items():
         if k == 'count':
             if v > 5000:
@@ -33,9 +106,73 @@ def _get_sitematrix(session: mwapi.Session) -> dict:
         for site in sites:
             sitematrix['by_dbname'][site['dbname']] = site
             sitematrix['by_url'][site['url']] = site
+    sitematrix['capabilities'] = _index_capabilities(
+        sitematrix['by_dbname'].values())
     return sitematrix
 
 
+def _index_capabilities(sites: Iterable[dict]) -> dict[str, list]:
+    """Precompute the Capabilities of the sites, by domain.
+
+    Stored as lists (like the JSON of the persisted sitematrix),
+    so that checking a wiki never needs to look at its raw site info.
+    """
+    index = {}
+    for site in sites:
+        if not site['url'].startswith('https://'):
+            continue
+        domain = site['url'][len('https://'):]
+        index[domain] = list(Capabilities(site['dbname'],
+                                          domain,
+                                          bool(site.get('private', False)),
+                                          bool(site.get('closed', False))))
+    return index
+
+
+def _load_persisted_sitematrix(path: str) -> Optional[tuple[float, dict]]:
+    try:
+        with open(path, encoding='utf-8') as f:
+            persisted: dict[str, Any] = json.load(f)
+        sitematrix = persisted['sitematrix']
+        if 'capabilities' not in sitematrix:
+            # persisted by an older version
+            sitematrix['capabilities'] = _index_capabilities(
+                sitematrix['by_dbname'].values())
+        return persisted['fetched'], sitematrix
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _persist_sitematrix(path: str, entry: tuple[float, dict]) -> None:
+    fetched, sitematrix = entry
+    # write to a temporary file and rename it,
+    # so that other workers never read a partially written file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'fetched': fetched, 'sitematrix': sitematrix}, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        _logger.warning('Could not persist sitematrix', exc_info=True)
+
+
+def warm_up(session: mwapi.Session) -> None:
+    """Make sure that a fresh sitematrix is loaded.
+
+    Unlike the lookups, this fetches a stale sitematrix synchronously,
+    rather than in a background thread, so that it can be called
+    before forking worker processes (see app.warm_up()).
+    """
+    with _sitematrix_cache_lock:
+        entry = _sitematrix_cache.get('#sitematrix')
+        if entry is None and persist_path is not None:
+            entry = _load_persisted_sitematrix(persist_path)
+            if entry is not None:
+                _sitematrix_cache['#sitematrix'] = entry
+        if entry is None or time.time() - entry[0] > ttl:
+            _update_sitematrix(session)
+
+
 def dbname_to_domain(session: mwapi.Session, dbname: str) -> str:
     sitematrix = _get_sitematrix(session)
     url = sitematrix['by_dbname'][dbname]['url']
@@ -46,3 +183,13 @@ def dbname_to_domain(session: mwapi.Session, dbname: str) -> str:
 def domain_to_dbname(session: mwapi.Session, domain: str) -> str:
     sitematrix = _get_sitematrix(session)
     return sitematrix['by_url']['https://' + domain]['dbname']
+
+
+def capabilities(session: mwapi.Session,
+                 domain: str) -> Optional[Capabilities]:
+    """Get the capabilities of the wiki, None if it is not a known wiki."""
+    sitematrix = _get_sitematrix(session)
+    capabilities = sitematrix['capabilities'].get(domain)
+    if capabilities is None:
+        return None
+    return Capabilities(*capabilities)
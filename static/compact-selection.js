@@ -0,0 +1,57 @@
+window.addEventListener( 'DOMContentLoaded', () => {
+    'use strict';
+
+    /**
+     * Submit the selection as runs of indices instead of full titles.
+     *
+     * With thousands of selected files, repeating file=<title> form fields
+     * results in huge POST bodies; instead, the indices of the selected files
+     * in the pile are encoded as comma-separated runs such as "0-3,7,9-10"
+     * (see encode_selection() in selection.py) and sent as a single field.
+     * If any selected file has no index, the full titles are sent as usual.
+     */
+
+    const form = document.getElementById( 'filter_form' );
+
+    function encodeSelection( indices ) {
+        const runs = [];
+        indices.sort( ( a, b ) => a - b );
+        for ( const index of indices ) {
+            const last = runs[ runs.length - 1 ];
+            if ( last && last[ 1 ] === index - 1 ) {
+                last[ 1 ] = index;
+            } else if ( !last || last[ 1 ] !== index ) {
+                runs.push( [ index, index ] );
+            }
+        }
+        return runs
+            .map( ( [ start, end ] ) => start === end ? `${start}` : `${start}-${end}` )
+            .join( ',' );
+    }
+
+    form.addEventListener( 'submit', () => {
+        const checkboxes = form.querySelectorAll( 'input[name=file]' ),
+              checked = [ ...checkboxes ].filter( checkbox => checkbox.checked );
+        if ( checked.some( checkbox => checkbox.dataset.index === undefined ) ) {
+            return;
+        }
+        const selection = document.createElement( 'input' );
+        selection.type = 'hidden';
+        selection.name = 'selection';
+        selection.value = encodeSelection(
+            checked.map( checkbox => Number( checkbox.dataset.index ) ) );
+        form.append( selection );
+        // disabled inputs are not submitted
+        checkboxes.forEach( checkbox => {
+            checkbox.disabled = true;
+        } );
+    } );
+
+    window.addEventListener( 'pageshow', () => {
+        // undo the above when the user navigates back to the page
+        form.querySelectorAll( 'input[name=selection]' ).forEach( input => input.remove() );
+        form.querySelectorAll( 'input[name=file]' ).forEach( checkbox => {
+            checkbox.disabled = false;
+        } );
+    } );
+} );
@@ -0,0 +1,25 @@
+window.addEventListener( 'DOMContentLoaded', () => {
+    'use strict';
+
+    /**
+     * Add buttons to select or deselect a whole group of near-duplicates
+     * (see duplicates.py), so that the group can be kept or dropped at once.
+     */
+
+    for ( const group of document.querySelectorAll( '.duplicate-group' ) ) {
+        const buttons = document.createElement( 'div' );
+        for ( const [ label, checked ] of [ [ 'Select group', true ], [ 'Deselect group', false ] ] ) {
+            const button = document.createElement( 'button' );
+            button.innerText = label;
+            button.type = 'button';
+            button.classList.add( 'btn', 'btn-secondary', 'btn-sm', 'mr-1' );
+            button.addEventListener( 'click', () => {
+                group.querySelectorAll( 'input[type=checkbox]' ).forEach( checkbox => {
+                    checkbox.checked = checked;
+                } );
+            } );
+            buttons.append( button );
+        }
+        group.prepend( buttons );
+    }
+} );
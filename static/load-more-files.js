@@ -0,0 +1,116 @@
+window.addEventListener( 'DOMContentLoaded', () => {
+    'use strict';
+
+    /**
+     * Load more files as the user scrolls towards the end of the page.
+     *
+     * The server only renders the first window of files;
+     * further windows are loaded from the JSON API and appended to the form.
+     * Files are never removed from the form again,
+     * so the selection of earlier windows is kept.
+     * Files of windows that have not been loaded yet are sent as a
+     * rest_offset, and kept by the server if the last bulk selection
+     * (see selection-buttons.js) selected them.
+     */
+
+    const moreFiles = document.getElementById( 'more_files' );
+    if ( !moreFiles ) {
+        return;
+    }
+    const files = document.getElementById( 'files' ),
+          restOffset = moreFiles.querySelector( 'input[name=rest_offset]' ),
+          restSelected = moreFiles.querySelector( 'input[name=rest_selected]' ),
+          filesUrl = moreFiles.dataset.filesUrl,
+          thumbnailUrl = moreFiles.dataset.thumbnailUrl,
+          limit = moreFiles.dataset.limit;
+    let offset = moreFiles.dataset.offset,
+        loading = false,
+        defaultChecked = false;
+
+    document.addEventListener( 'pagepile-bulk-selection', event => {
+        switch ( event.detail ) {
+            case 'all': defaultChecked = true; break;
+            case 'none': defaultChecked = false; break;
+            case 'invert': defaultChecked = !defaultChecked; break;
+        }
+        restSelected.value = defaultChecked ? '1' : '';
+    } );
+
+    // see is_thumbnail_url() in thumbnails.py
+    const thumbnailPattern = /^https:\/\/upload\.wikimedia\.org\/[^/?#]+\/[^/?#]+\/thumb\/[^?#]+\/[^/?#]*[0-9]+px-[^/?#]+$/;
+
+    function proxied( url ) {
+        // see thumbnail_url() in app.py
+        if ( thumbnailUrl && thumbnailPattern.test( url ) ) {
+            return `${thumbnailUrl}?url=${encodeURIComponent( url )}`;
+        }
+        return url;
+    }
+
+    function fileLabel( index, title, imageinfo ) {
+        const label = document.createElement( 'label' ),
+              input = document.createElement( 'input' ),
+              span = document.createElement( 'span' ),
+              img = document.createElement( 'img' );
+        input.type = 'checkbox';
+        input.name = 'file';
+        input.value = title;
+        input.className = 'sr-only';
+        input.checked = defaultChecked;
+        if ( index !== null ) {
+            input.dataset.index = index;
+        }
+        img.src = proxied( imageinfo.thumburl );
+        img.width = imageinfo.thumbwidth;
+        img.height = imageinfo.thumbheight;
+        if ( imageinfo.responsiveUrls ) {
+            img.srcset = Object.entries( imageinfo.responsiveUrls )
+                .map( ( [ factor, responsiveUrl ] ) => `${proxied( responsiveUrl )} ${factor}x` )
+                .join( ', ' );
+        }
+        img.loading = 'lazy';
+        span.append( img );
+        label.append( input, span );
+        return label;
+    }
+
+    async function loadMore() {
+        if ( loading ) {
+            return;
+        }
+        loading = true;
+        try {
+            // dpr: see client_density() in app.py
+            const url = `${filesUrl}?offset=${offset}&limit=${limit}&dpr=${window.devicePixelRatio}`,
+                  response = await fetch( url );
+            if ( response.status === 503 ) {
+                // the tool is shedding load (see overload.py): try again later
+                const retryAfter = Number( response.headers.get( 'Retry-After' ) ) || 5;
+                setTimeout( loadMore, retryAfter * 1000 );
+                return;
+            }
+            const json = await response.json();
+            for ( const { index, title, imageinfo } of json.files ) {
+                if ( imageinfo ) {
+                    files.append( fileLabel( index, title, imageinfo ), ' ' );
+                }
+            }
+            offset = json.next_offset;
+            restOffset.value = offset === null ? json.total : offset;
+            observer.unobserve( moreFiles );
+            if ( offset !== null ) {
+                // observe again in case the sentinel is still visible
+                observer.observe( moreFiles );
+            }
+        } finally {
+            loading = false;
+        }
+    }
+
+    const observer = new IntersectionObserver( entries => {
+        if ( entries.some( entry => entry.isIntersecting ) ) {
+            loadMore();
+        }
+    }, { rootMargin: '1000px' } );
+    observer.observe( moreFiles );
+} );
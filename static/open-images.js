@@ -1,23 +1,29 @@
 window.addEventListener( 'DOMContentLoaded', () => {
     'use strict';
 
-    document.querySelectorAll( 'img' ).forEach( img => {
-        function onClick( click ) {
-            if ( click.button === 1 ||
-                 click.button === 0 && (
-                     click.ctrlKey || click.metaKey
-                 ) ) {
-                const input = img.closest( 'label' ).querySelector( 'input' ),
-                      title = input.value,
-                      url = 'https://commons.wikimedia.org/wiki/' +
-                      encodeURIComponent( title.replace( / /g, '_' ) );
-                window.open( url, '_blank' );
-                click.preventDefault();
-            }
+    const domain = document.getElementById( 'filter_form' ).dataset.domain ||
+          'commons.wikimedia.org';
+
+    // listen on the document so that images added later are also covered
+    function onClick( click ) {
+        const img = click.target;
+        if ( !( img instanceof HTMLImageElement ) ) {
+            return;
+        }
+        if ( click.button === 1 ||
+             click.button === 0 && (
+                 click.ctrlKey || click.metaKey
+             ) ) {
+            const input = img.closest( 'label' ).querySelector( 'input' ),
+                  title = input.value,
+                  url = 'https://' + domain + '/wiki/' +
+                  encodeURIComponent( title.replace( / /g, '_' ) );
+            window.open( url, '_blank' );
+            click.preventDefault();
         }
-        img.addEventListener( 'click', onClick );
-        img.addEventListener( 'auxclick', onClick );
-    } );
+    }
+    document.addEventListener( 'click', onClick );
+    document.addEventListener( 'auxclick', onClick );
 
     const explanation = document.createElement( 'p' );
     explanation.textContent = 'Middle-click, control-click or command-click an image ' +
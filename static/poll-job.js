@@ -0,0 +1,35 @@
+window.addEventListener( 'DOMContentLoaded', () => {
+    'use strict';
+
+    /**
+     * Poll the status of a filter job (see jobs.py)
+     * and go to the new PagePile once it has been created.
+     * Without JavaScript, the page refreshes itself instead.
+     */
+
+    const status = document.getElementById( 'job_status' );
+    if ( !status ) {
+        return;
+    }
+
+    async function poll() {
+        try {
+            const response = await fetch( status.dataset.statusUrl );
+            const json = await response.json();
+            if ( json.state === 'done' ) {
+                window.location.href = json.url;
+                return;
+            }
+            if ( json.state === 'failed' ) {
+                // show the error
+                window.location.reload();
+                return;
+            }
+        } catch ( e ) {
+            // try again below
+        }
+        setTimeout( poll, 2000 );
+    }
+
+    setTimeout( poll, 1000 );
+} );
@@ -17,17 +17,22 @@ window.addEventListener( 'DOMContentLoaded', () => {
      * the new images from the scroll don’t have to wait too long –
      * they’re not penalized by the earlier throttling,
      * there’s no residual exponential backoff.
+     * The listener is registered on the document (error events don’t bubble,
+     * but they can be captured) so that it also covers images
+     * added later by load-more-files.js.
      */
 
     let earliestNextReload = 0; // performance.now() clock (milliseconds)
 
-    document.querySelectorAll( 'img' ).forEach( img => {
-        img.addEventListener( 'error', () => {
-            const now = performance.now();
-            earliestNextReload = Math.max( earliestNextReload, now ) + 100;
-            setTimeout( () => {
-                img.src = img.src; // reload
-            }, earliestNextReload - now );
-        } );
-    } );
+    document.addEventListener( 'error', event => {
+        const img = event.target;
+        if ( !( img instanceof HTMLImageElement ) ) {
+            return;
+        }
+        const now = performance.now();
+        earliestNextReload = Math.max( earliestNextReload, now ) + 100;
+        setTimeout( () => {
+            img.src = img.src; // reload
+        }, earliestNextReload - now );
+    }, true );
 } );
@@ -2,26 +2,31 @@ window.addEventListener('DOMContentLoaded', () => {
     const selectAllButton = document.createElement('button'),
           selectNoneButton = document.createElement('button'),
           invertSelectionButton = document.createElement('button'),
-          buttonsContainer = document.getElementById('selection_buttons');
+          buttonsContainer = document.getElementById('selection_buttons'),
+          // only the files, not e.g. the checkboxes of the filter form
+          fileCheckboxes = '#files input[name=file]';
 
     selectAllButton.innerText = 'Select all';
     selectNoneButton.innerText = 'Select none';
     invertSelectionButton.innerText = 'Invert selection';
 
     selectAllButton.addEventListener('click', () => {
-        document.querySelectorAll('input[type=checkbox]').forEach( checkbox => {
+        document.querySelectorAll(fileCheckboxes).forEach( checkbox => {
             checkbox.checked = true;
         });
+        document.dispatchEvent(new CustomEvent('pagepile-bulk-selection', { detail: 'all' }));
     });
     selectNoneButton.addEventListener('click', () => {
-        document.querySelectorAll('input[type=checkbox]').forEach( checkbox => {
+        document.querySelectorAll(fileCheckboxes).forEach( checkbox => {
             checkbox.checked = false;
         });
+        document.dispatchEvent(new CustomEvent('pagepile-bulk-selection', { detail: 'none' }));
     });
     invertSelectionButton.addEventListener('click', () => {
-        document.querySelectorAll('input[type=checkbox]').forEach( checkbox => {
+        document.querySelectorAll(fileCheckboxes).forEach( checkbox => {
             checkbox.checked = !checkbox.checked
         });
+        document.dispatchEvent(new CustomEvent('pagepile-bulk-selection', { detail: 'invert' }));
     });
 
     for (const button of [selectAllButton, selectNoneButton, invertSelectionButton]) {
@@ -1,6 +1,32 @@
+import gzip
+import mwapi  # type: ignore
 import pytest
+import requests
+import threading
+import time
 
 import app as pagepile_visual_filter
+from cache import MemoryCache
+from duplicates import DuplicateFinder
+from fake_upstream import FakeUpstream, LOCAL_PILE_OFFSET, SITES
+from imageinfo import ImageInfo
+from jobs import JobQueue
+from overload import Upstreams
+from page_cache import PageCache
+import sitematrix
+
+from test_utils import FakeSession
+
+
+@pytest.fixture(autouse=True)
+def clean_cache(monkeypatch):
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'cache',
+                        MemoryCache(maxsize=1000, ttl=60))
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'page_cache',
+                        PageCache(max_bytes=2**20, ttl=60))
+    monkeypatch.setattr(pagepile_visual_filter, 'upstreams', Upstreams())
 
 
 @pytest.fixture
@@ -40,15 +66,16 @@ def test_load_files():
         'File:Mona Lisa, by Leonardo da Vinci, from C2RMF retouched.jpg',  # large file
     ]
     files = pagepile_visual_filter.load_files(session, titles)
-    assert files == {
+    thumb_fields = {'thumburl', 'thumbwidth', 'thumbheight', 'responsiveUrls'}
+    assert {title: {field: value
+                    for field, value in imageinfo.to_json().items()
+                    if field in thumb_fields} if imageinfo else None
+            for title, imageinfo in files.items()} == {
         'Leonardo da Vinci': None,
         'File:Button small 2.png': {
             'thumburl': 'https://upload.wikimedia.org/wikipedia/commons/1/17/Button_small_2.png',
             'thumbwidth': 23,
             'thumbheight': 22,
-            'url': 'https://upload.wikimedia.org/wikipedia/commons/1/17/Button_small_2.png',
-            'descriptionurl': 'https://commons.wikimedia.org/wiki/File:Button_small_2.png',
-            'descriptionshorturl': 'https://commons.wikimedia.org/w/index.php?curid=1278021'
         },
         'File:Crystal Project Password.png': {
             'thumburl': 'https://upload.wikimedia.org/wikipedia/commons/thumb/1/13/Crystal_Project_Password.png/250px-Crystal_Project_Password.png',
@@ -58,9 +85,6 @@ def test_load_files():
                 '1.5': 'https://upload.wikimedia.org/wikipedia/commons/1/13/Crystal_Project_Password.png',
                 '2': 'https://upload.wikimedia.org/wikipedia/commons/1/13/Crystal_Project_Password.png'
             },
-            'url': 'https://upload.wikimedia.org/wikipedia/commons/1/13/Crystal_Project_Password.png',
-            'descriptionurl': 'https://commons.wikimedia.org/wiki/File:Crystal_Project_Password.png',
-            'descriptionshorturl': 'https://commons.wikimedia.org/w/index.php?curid=18332648'
         },
         'File:Mona Lisa, by Leonardo da Vinci, from C2RMF retouched.jpg': {
             'thumburl': 'https://upload.wikimedia.org/wikipedia/commons/thumb/e/ec/Mona_Lisa%2C_by_Leonardo_da_Vinci%2C_from_C2RMF_retouched.jpg/250px-Mona_Lisa%2C_by_Leonardo_da_Vinci%2C_from_C2RMF_retouched.jpg',
@@ -70,8 +94,983 @@ def test_load_files():
                 '1.5': 'https://upload.wikimedia.org/wikipedia/commons/thumb/e/ec/Mona_Lisa%2C_by_Leonardo_da_Vinci%2C_from_C2RMF_retouched.jpg/330px-Mona_Lisa%2C_by_Leonardo_da_Vinci%2C_from_C2RMF_retouched.jpg',
                 '2': 'https://upload.wikimedia.org/wikipedia/commons/thumb/e/ec/Mona_Lisa%2C_by_Leonardo_da_Vinci%2C_from_C2RMF_retouched.jpg/500px-Mona_Lisa%2C_by_Leonardo_da_Vinci%2C_from_C2RMF_retouched.jpg'
             },
-            'url': 'https://upload.wikimedia.org/wikipedia/commons/e/ec/Mona_Lisa%2C_by_Leonardo_da_Vinci%2C_from_C2RMF_retouched.jpg',
-            'descriptionurl': 'https://commons.wikimedia.org/wiki/File:Mona_Lisa,_by_Leonardo_da_Vinci,_from_C2RMF_retouched.jpg',
-            'descriptionshorturl': 'https://commons.wikimedia.org/w/index.php?curid=15442524'
         },
     }
+
+
+def fake_imageinfo(title):
+    return {
+        'thumburl': 'https://example/' + title,
+        'thumbwidth': 250,
+        'thumbheight': 250,
+    }
+
+
+def fake_imageinfo_response(*, titles, **kwargs):
+    return [{
+        'query': {
+            'pages': [
+                {
+                    'title': title,
+                    'imageinfo': [fake_imageinfo(title)],
+                }
+                for title in titles
+                if title.startswith('File:')
+            ],
+        },
+    }]
+
+
+def test_load_files_parallel_chunks():
+    titles = ['File:%d.jpg' % i for i in range(237)] + ['Not a file']
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def get(**kwargs):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight -= 1
+        return fake_imageinfo_response(**kwargs)
+
+    with pagepile_visual_filter.app.app_context():
+        files = pagepile_visual_filter.load_files(FakeSession(get), titles)
+
+    assert list(files) == titles
+    assert files['Not a file'] is None
+    assert files['File:236.jpg'] \
+        == ImageInfo.from_api(fake_imageinfo('File:236.jpg'))
+    assert max_in_flight > 1
+
+
+def test_load_files_uses_cache():
+    requested_titles = []
+
+    def get(**kwargs):
+        requested_titles.extend(kwargs['titles'])
+        return fake_imageinfo_response(**kwargs)
+
+    session = FakeSession(get)
+    with pagepile_visual_filter.app.app_context():
+        first = pagepile_visual_filter.load_files(session,
+                                                  ['File:A.jpg', 'B'])
+        second = pagepile_visual_filter.load_files(session,
+                                                   ['File:A.jpg', 'B', 'C'])
+
+    assert requested_titles == ['File:A.jpg', 'B', 'C']
+    assert first == {
+        'File:A.jpg': ImageInfo.from_api(fake_imageinfo('File:A.jpg')),
+        'B': None,
+    }
+    assert second == {**first, 'C': None}
+
+
+def test_load_files_too_many_values(monkeypatch):
+    monkeypatch.setattr(pagepile_visual_filter, '_batch_sizes', {})
+    batches = []
+
+    def get(**kwargs):
+        batches.append(len(kwargs['titles']))
+        if len(kwargs['titles']) > 20:
+            raise mwapi.errors.APIError(
+                'toomanyvalues',
+                'Too many values supplied for parameter "titles". '
+                'The limit is 20.',
+                None)
+        return fake_imageinfo_response(**kwargs)
+
+    titles = ['File:%d.jpg' % i for i in range(120)]
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'LOAD_FILES_CONCURRENCY',
+                        1)
+    with pagepile_visual_filter.app.app_context():
+        files = pagepile_visual_filter.load_files(FakeSession(get), titles)
+
+    assert list(files) == titles
+    assert all(files.values())
+    # the first chunk is split, the later chunks use the learned limit
+    assert batches == [50, 20, 20, 10, 20, 20, 20, 10]
+    assert pagepile_visual_filter._batch_size(None) == 20
+
+
+def test_load_files_high_limits(monkeypatch):
+    monkeypatch.setattr(pagepile_visual_filter, '_batch_sizes', {})
+    requests = []
+
+    def get(**kwargs):
+        requests.append(kwargs)
+        [response] = fake_imageinfo_response(**kwargs)
+        if 'meta' in kwargs:
+            response['query']['userinfo'] = {'rights': ['apihighlimits']}
+        return [response]
+
+    titles = ['File:%d.jpg' % i for i in range(600)]
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'LOAD_FILES_CONCURRENCY',
+                        1)
+    with pagepile_visual_filter.app.app_context():
+        files = pagepile_visual_filter.load_files(FakeSession(get), titles)
+
+    assert list(files) == titles
+    assert [len(request['titles']) for request in requests] == [50, 500, 50]
+    assert requests[0]['meta'] == ['userinfo']
+    assert 'meta' not in requests[1]
+
+
+def test_load_files_maxlag(monkeypatch):
+    monkeypatch.setattr(pagepile_visual_filter, '_batch_sizes', {})
+    sleeps = []
+    monkeypatch.setattr(pagepile_visual_filter.time, 'sleep', sleeps.append)
+    maxlags = []
+
+    def get(**kwargs):
+        maxlags.append(kwargs.get('maxlag'))
+        if 'maxlag' in kwargs:
+            raise mwapi.errors.APIError(
+                'maxlag',
+                'Waiting for 10.64.16.8: 7 seconds lagged.',
+                None)
+        return fake_imageinfo_response(**kwargs)
+
+    with pagepile_visual_filter.app.app_context():
+        files = pagepile_visual_filter.load_files(FakeSession(get),
+                                                  ['File:A.jpg'])
+
+    assert files['File:A.jpg'] is not None
+    # retried twice with backoff, then queried without maxlag
+    assert maxlags == [5, 5, None]
+    assert sleeps == [7, 14]
+
+
+def test_load_files_other_api_error(monkeypatch):
+    monkeypatch.setattr(pagepile_visual_filter, '_batch_sizes', {})
+
+    def get(**kwargs):
+        raise mwapi.errors.APIError('internal_api_error', 'Oops', None)
+
+    with pagepile_visual_filter.app.app_context():
+        with pytest.raises(mwapi.errors.APIError):
+            pagepile_visual_filter.load_files(FakeSession(get),
+                                              ['File:A.jpg'])
+
+
+@pytest.fixture
+def fake_sitematrix(monkeypatch):
+    """Look up the wikis of fake_upstream.py without fetching a sitematrix."""
+    domains = {site['dbname']: site['url'][len('https://'):]
+               for site in SITES}
+    dbnames = {domain: dbname for dbname, domain in domains.items()}
+    monkeypatch.setattr(sitematrix,
+                        'dbname_to_domain',
+                        lambda session, dbname: domains[dbname])
+    monkeypatch.setattr(sitematrix,
+                        'domain_to_dbname',
+                        lambda session, domain: dbnames[domain])
+
+
+def test_get_pagepile_uses_cache(monkeypatch, fake_sitematrix):
+    calls = []
+
+    def fetch_pagepile(session, id):
+        calls.append(id)
+        return 'commonswiki', ['File:A.jpg']
+
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'fetch_pagepile',
+                        fetch_pagepile)
+
+    assert pagepile_visual_filter.get_pagepile(1) \
+        == ('commons.wikimedia.org', ['File:A.jpg'])
+    assert pagepile_visual_filter.get_pagepile(1) \
+        == ('commons.wikimedia.org', ['File:A.jpg'])
+    assert calls == [1]
+
+
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    with FakeUpstream(latency=0.2) as fake:
+        monkeypatch.setattr(pagepile_visual_filter.pagepile_api,
+                            'api_url',
+                            fake.pagepile_api_url)
+        monkeypatch.setitem(pagepile_visual_filter.app.config,
+                            'WIKI_URL_TEMPLATE',
+                            fake.wiki_url_template)
+        monkeypatch.setattr(pagepile_visual_filter,
+                            '_anonymous_sessions',
+                            {})
+        monkeypatch.setattr(pagepile_visual_filter, '_batch_sizes', {})
+        yield fake
+
+
+def test_pagepile_burst(fake_upstream, monkeypatch):
+    # each request should load the pile and the files itself
+    monkeypatch.setattr(pagepile_visual_filter, 'page_cache', None)
+    # warm up the sitematrix
+    pagepile_visual_filter.get_pagepile(1)
+    barrier = threading.Barrier(20)
+    responses = []
+
+    def view():
+        client = pagepile_visual_filter.app.test_client()
+        barrier.wait()
+        responses.append(client.get('/pagepile/30/'))
+
+    threads = [threading.Thread(target=view) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [response.status_code for response in responses] == [200] * 20
+    assert all(response.get_data(as_text=True).count('<img') == 30
+               for response in responses)
+    assert fake_upstream.counts['get_data'] == 2  # pile 1 and pile 30
+    assert fake_upstream.counts['query+imageinfo'] == 1
+
+
+def open_circuit(monkeypatch, host):
+    upstreams = Upstreams(failure_threshold=1)
+    monkeypatch.setattr(pagepile_visual_filter, 'upstreams', upstreams)
+    with pytest.raises(mwapi.errors.ConnectionError):
+        with upstreams.call(host, 30):
+            raise mwapi.errors.ConnectionError('refused')
+
+
+def test_pagepile_circuit_open(fake_upstream, monkeypatch):
+    open_circuit(monkeypatch, 'commons.wikimedia.org')
+    client = pagepile_visual_filter.app.test_client()
+
+    response = client.get('/pagepile/30/')
+    assert response.status_code == 503
+    assert 25 <= int(response.headers['Retry-After']) <= 30
+    assert 'Temporarily overloaded' in response.get_data(as_text=True)
+    response = client.get('/pagepile/30/files')
+    assert response.status_code == 503
+    assert response.get_json() == {'error': 'overloaded'}
+    # the pile was loaded, but no imageinfo was queried
+    assert fake_upstream.counts['get_data'] == 1
+    assert 'query+imageinfo' not in fake_upstream.counts
+
+
+def test_pagepile_circuit_open_streamed(fake_upstream, monkeypatch):
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'STREAM_PAGEPILE',
+                        True)
+    open_circuit(monkeypatch, 'commons.wikimedia.org')
+    client = pagepile_visual_filter.app.test_client()
+
+    response = client.get('/pagepile/30/')
+    assert response.status_code == 503
+
+
+def test_pagepile_deadline(fake_upstream, monkeypatch):
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'REQUEST_DEADLINE',
+                        0.3)
+    fake_upstream.latency = 1
+    client = pagepile_visual_filter.app.test_client()
+
+    # the timed out call is not retried with the full timeout
+    start = time.perf_counter()
+    response = client.get('/pagepile/30/')
+    assert response.status_code == 503
+    assert time.perf_counter() - start < 0.8
+    assert pagepile_visual_filter.metrics.shed_requests.value(
+        host=pagepile_visual_filter.pagepile_host(),
+        reason='deadline') >= 1
+
+
+def test_pagepile_unavailable(fake_upstream, monkeypatch):
+    upstreams = Upstreams(failure_threshold=1, retries=0)
+    monkeypatch.setattr(pagepile_visual_filter, 'upstreams', upstreams)
+    fake_upstream.error_rate = 1
+
+    # not “no such pile”, but a failure of PagePile
+    with pytest.raises(requests.HTTPError):
+        pagepile_visual_filter.get_pagepile(30)
+    assert upstreams.degraded(pagepile_visual_filter.pagepile_host())
+
+
+def test_pagepile_sitematrix_unavailable(fake_upstream, monkeypatch):
+    upstreams = Upstreams(failure_threshold=1, retries=3)
+    monkeypatch.setattr(pagepile_visual_filter, 'upstreams', upstreams)
+
+    def dbname_to_domain(session, dbname):
+        # the shared session, not one with the timeout of the call
+        assert session \
+            is pagepile_visual_filter.anonymous_session('meta.wikimedia.org')
+        raise requests.ConnectionError('Meta is down')
+
+    monkeypatch.setattr(sitematrix, 'dbname_to_domain', dbname_to_domain)
+
+    # not a failure of PagePile, nor retried
+    with pytest.raises(requests.ConnectionError):
+        pagepile_visual_filter.get_pagepile(30)
+    assert fake_upstream.counts['get_data'] == 1
+    assert not upstreams.degraded(pagepile_visual_filter.pagepile_host())
+
+
+def test_healthz(client):
+    response = client.get('/healthz')
+    assert response.status_code == 200
+    assert response.get_json() == {'status': 'ok', 'upstreams': {}}
+
+
+def test_healthz_degraded(client, monkeypatch):
+    open_circuit(monkeypatch, 'commons.wikimedia.org')
+    response = client.get('/healthz')
+    assert response.status_code == 503
+    json = response.get_json()
+    assert json['status'] == 'degraded'
+    assert json['upstreams']['commons.wikimedia.org']['circuit'] == 'open'
+
+
+def test_healthz_other_wiki_not_degraded(client, monkeypatch):
+    open_circuit(monkeypatch, 'de.wikipedia.org')
+    response = client.get('/healthz')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'ok'
+
+
+def test_pagepile_other_wiki(fake_upstream):
+    client = pagepile_visual_filter.app.test_client()
+
+    response = client.get('/pagepile/%d/' % (LOCAL_PILE_OFFSET + 10))
+
+    assert response.status_code == 200
+    html = response.get_data(as_text=True)
+    assert html.count('<img') == 10
+    assert html.count('src="https://upload.wikimedia.org/wikipedia/de/') == 5
+    assert 'data-domain="de.wikipedia.org"' in html
+    # the files from Commons came with the same response
+    assert fake_upstream.counts['query+imageinfo@de.wikipedia.org'] == 1
+    assert 'query+imageinfo' not in fake_upstream.counts
+    # and were cached for Commons piles too
+    response = client.get('/pagepile/10/')
+    assert response.get_data(as_text=True).count('<img') == 10
+    assert fake_upstream.counts['query+imageinfo'] == 1
+    assert fake_upstream.last_titles == [
+        'File:Benchmark 10-%d.jpg' % i for i in range(1, 10, 2)]
+
+
+def test_pagepile_other_wiki_commons_files_cached_separately(fake_upstream):
+    # cached from an earlier view, but no longer cached on Commons
+    pagepile_visual_filter._cache_files({
+        'File:Benchmark %d-%d.jpg' % (10, i):
+        'File:Benchmark %d-%d.jpg' % (10, i)
+        for i in range(0, 10, 2)
+    }, 'de.wikipedia.org')
+    client = pagepile_visual_filter.app.test_client()
+
+    response = client.get('/pagepile/%d/' % (LOCAL_PILE_OFFSET + 10))
+
+    assert response.get_data(as_text=True).count('<img') == 10
+    # the local files and the files from Commons, separately
+    assert fake_upstream.counts['query+imageinfo@de.wikipedia.org'] == 1
+    assert fake_upstream.counts['query+imageinfo'] == 1
+    assert fake_upstream.last_titles == [
+        'File:Benchmark 10-%d.jpg' % i for i in range(0, 10, 2)]
+
+
+def test_pagepile_files_other_wiki(client, fake_upstream):
+    response = client.get('/pagepile/%d/files?offset=2&limit=4'
+                          % (LOCAL_PILE_OFFSET + 10))
+    assert response.status_code == 200
+    files = response.get_json()['files']
+    assert [file['title'] for file in files] == [
+        'File:Benchmark 10-2.jpg',
+        'File:Benchmark local 10-3.jpg',
+        'File:Benchmark 10-4.jpg',
+        'File:Benchmark local 10-5.jpg',
+    ]
+    assert [file['imageinfo']['thumburl'].split('/')[4]
+            for file in files] == ['commons', 'de', 'commons', 'de']
+
+
+def test_pagepile_unsupported_wiki(client, fake_upstream):
+    fake_upstream.created_piles[1_000_000] = ('officewiki', ['File:A.jpg'])
+
+    response = client.get('/pagepile/1000000/')
+    assert response.status_code == 400
+    assert 'only supports PagePiles for public Wikimedia wikis' \
+        in response.get_data(as_text=True)
+    response = client.get('/pagepile/1000000/files')
+    assert response.status_code == 400
+    assert not any(action.endswith('@office.wikimedia.org')
+                   for action in fake_upstream.counts)
+
+
+def test_shared_titles_from_response():
+    response = {'query': {'pages': [
+        {'title': 'Datei:A.jpg', 'ns': 6, 'missing': True, 'known': True,
+         'imagerepository': 'shared',
+         'imageinfo': [fake_imageinfo('File:A.jpg')]},
+        {'title': 'Datei:B.jpg', 'ns': 6, 'imagerepository': 'local',
+         'imageinfo': [fake_imageinfo('File:B.jpg')]},
+        {'title': 'C', 'ns': 0, 'missing': True},
+    ]}}
+    assert list(pagepile_visual_filter._shared_titles_from_response(
+        response)) == [('Datei:A.jpg', 'File:A.jpg')]
+
+
+def test_pagepile_streaming(client, monkeypatch):
+    titles = ['File:%d.jpg' % i for i in range(120)]
+    imageinfo_loadable = threading.Event()
+
+    def get(**kwargs):
+        assert imageinfo_loadable.wait(timeout=5)
+        return fake_imageinfo_response(**kwargs)
+
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'STREAM_PAGEPILE',
+                        True)
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'get_pagepile',
+                        lambda id: ('commons.wikimedia.org', titles))
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'anonymous_session',
+                        lambda domain: FakeSession(get))
+
+    response = client.get('/pagepile/1/', buffered=False)
+    assert 'Set-Cookie' in response.headers
+    body = iter(response.response)
+    head = ''
+    while 'id="files"' not in head:
+        head += next(body).decode()
+    assert '<img' not in head
+    # the form can be sent right away
+    assert 'name="csrf_token"' in head
+
+    imageinfo_loadable.set()
+    rest = b''.join(body).decode()
+    assert rest.count('<img') == len(titles)
+    assert rest.index('File:0.jpg') < rest.index('File:119.jpg')
+
+    # the streamed page was cached
+    imageinfo_loadable.clear()
+    response = client.get('/pagepile/1/')
+    assert 'ETag' in response.headers
+    assert response.get_data(as_text=True) == head + rest
+
+
+@pytest.fixture
+def fake_pile(monkeypatch):
+    """Make pile 1 a Commons pile of 120 files, with fake imageinfo."""
+    titles = ['File:%d.jpg' % i for i in range(120)]
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'get_pagepile',
+                        lambda id: ('commons.wikimedia.org', titles))
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'anonymous_session',
+                        lambda domain: FakeSession(fake_imageinfo_response))
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'PAGEPILE_WINDOW_SIZE',
+                        50)
+    return titles
+
+
+def test_pagepile_first_window(client, fake_pile):
+    response = client.get('/pagepile/1/')
+    html = response.get_data(as_text=True)
+    assert html.count('<img') == 50
+    assert 'data-offset="50"' in html
+
+
+def test_pagepile_all(client, fake_pile):
+    response = client.get('/pagepile/1/?all=1')
+    html = response.get_data(as_text=True)
+    assert html.count('<img') == 120
+    assert 'more_files' not in html
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_pagepile_metadata_filters(client, fake_pile, monkeypatch, stream):
+    def get(*, titles, **kwargs):
+        return [{'query': {'pages': [
+            {'title': title, 'imageinfo': [{
+                **fake_imageinfo(title),
+                'width': 1000 if int(title[5:-4]) % 2 == 0 else 100,
+                'mime': 'image/jpeg',
+            }]}
+            for title in titles
+        ]}}]
+
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'anonymous_session',
+                        lambda domain: FakeSession(get))
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'STREAM_PAGEPILE',
+                        stream)
+    response = client.get('/pagepile/1/?min_width=500&mime=image/*')
+    html = response.get_data(as_text=True)
+    # all 120 files are filtered, not just the first window of 50
+    assert html.count('<img') == 60
+    assert 'value="File:118.jpg"' in html
+    assert 'value="File:117.jpg"' not in html
+    assert 'more_files' not in html
+    assert 'Remove filters' in html
+
+
+def test_pagepile_cached(client, fake_pile, monkeypatch):
+    first = client.get('/pagepile/1/', headers={'Accept-Encoding': 'gzip'})
+    assert first.headers['Content-Encoding'] == 'gzip'
+    assert 'Cookie' in first.headers['Vary']
+    html = gzip.decompress(first.get_data()).decode('utf-8')
+    assert html.count('<img') == 50
+    with client.session_transaction() as session:
+        assert 'value="%s"' % session['csrf_token'] in html
+
+    # neither the pile nor the imageinfo are needed again
+    monkeypatch.setattr(pagepile_visual_filter, 'get_pagepile', None)
+    second = client.get('/pagepile/1/')
+    assert 'Content-Encoding' not in second.headers
+    assert second.get_data(as_text=True) == html
+    assert second.headers['ETag'] == first.headers['ETag']
+
+    not_modified = client.get('/pagepile/1/', headers={
+        'If-None-Match': first.headers['ETag'],
+    })
+    assert not_modified.status_code == 304
+    assert not_modified.get_data() == b''
+
+    # another session gets its own token, and a different ETag
+    with client.session_transaction() as session:
+        session['csrf_token'] = 'other token'
+    other = client.get('/pagepile/1/', headers={
+        'If-None-Match': first.headers['ETag'],
+    })
+    assert other.status_code == 200
+    assert 'value="other token"' in other.get_data(as_text=True)
+    assert other.headers['ETag'] != first.headers['ETag']
+
+
+def test_pagepile_cached_per_parameters(client, fake_pile):
+    client.get('/pagepile/1/')
+    html = client.get('/pagepile/1/?all=1').get_data(as_text=True)
+    assert html.count('<img') == 120
+
+
+def test_pagepile_invalid_filter(client, fake_pile):
+    assert client.get('/pagepile/1/?min_width=wide').status_code == 400
+
+
+def title_hash(data):
+    # File:N.jpg => hash N // 10, i.e. groups of ten duplicates
+    return int(data.decode()[len('https://example/File:'):-len('.jpg')]) // 10
+
+
+def test_pagepile_duplicates(client, fake_pile, monkeypatch):
+    finder = DuplicateFinder(pagepile_visual_filter.cache,
+                             lambda url: url.encode(),
+                             max_distance=0,
+                             processes=1,
+                             hash_function=title_hash)
+    monkeypatch.setattr(pagepile_visual_filter, 'duplicate_finder', finder)
+    html = client.get('/pagepile/1/?duplicates=1').get_data(as_text=True)
+    # all 120 files (not just the first window), in 12 groups
+    assert html.count('<img') == 120
+    assert html.count('class="duplicate-group"') == 12
+    assert 'have not been compared yet' not in html
+
+
+def test_fetch_thumbnail_rate_limited(fake_upstream, monkeypatch):
+    class FakeBucket:
+        tokens = 0
+
+        def acquire(self, timeout=None):
+            self.tokens += 1
+            return True
+
+    bucket = FakeBucket()
+    monkeypatch.setattr(pagepile_visual_filter, 'thumbnail_bucket', bucket)
+    fake_upstream.error_rate = 1
+    # one token per request, and 429 or 5xx responses are not retried
+    with pytest.raises(requests.HTTPError):
+        pagepile_visual_filter._fetch_thumbnail(
+            fake_upstream.pagepile_api_url)
+    assert bucket.tokens == 1
+    assert fake_upstream.counts[''] == 1
+
+
+def test_pagepile_duplicates_disabled(client, fake_pile):
+    html = client.get('/pagepile/1/?duplicates=1').get_data(as_text=True)
+    assert 'duplicate-group' not in html
+    assert html.count('<img') == 50
+
+
+def test_pagepile_files(client, fake_pile):
+    response = client.get('/pagepile/1/files?offset=100&limit=1000')
+    assert response.json == {
+        'files': [
+            {
+                'index': index,
+                'title': title,
+                'imageinfo': fake_imageinfo(title),
+            }
+            for index, title in enumerate(fake_pile[100:], start=100)
+        ],
+        'next_offset': None,
+        'total': 120,
+    }
+
+
+def test_pagepile_files_limit_capped(client, fake_pile):
+    response = client.get('/pagepile/1/files?offset=10&limit=1000')
+    assert len(response.json['files']) == 50
+    assert response.json['next_offset'] == 60
+
+
+@pytest.fixture
+def created_piles(monkeypatch, fake_sitematrix):
+    created_piles = []
+
+    def post_pagepile(session, dbname, pages):
+        created_piles.append((dbname, list(pages)))
+        return 2
+
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'post_pagepile',
+                        post_pagepile)
+    return created_piles
+
+
+def test_filter_pagepile_rest_selected(client, fake_pile, created_piles):
+    with client.session_transaction() as session:
+        session['csrf_token'] = 'test token'
+    response = client.post('/pagepile/1/filter', data={
+        'csrf_token': 'test token',
+        'file': ['File:3.jpg', 'File:7.jpg'],
+        'rest_offset': '100',
+        'rest_selected': '1',
+    })
+    assert response.status_code == 302
+    assert created_piles == [
+        ('commonswiki',
+         ['File:3.jpg', 'File:7.jpg'] + fake_pile[100:]),
+    ]
+
+
+def test_filter_pagepile_rest_not_selected(client, fake_pile, created_piles):
+    with client.session_transaction() as session:
+        session['csrf_token'] = 'test token'
+    client.post('/pagepile/1/filter', data={
+        'csrf_token': 'test token',
+        'file': ['File:3.jpg', 'File:7.jpg'],
+        'rest_offset': '100',
+        'rest_selected': '',
+    })
+    assert created_piles == [
+        ('commonswiki', ['File:3.jpg', 'File:7.jpg']),
+    ]
+
+
+def test_filter_pagepile_compact_selection(client, fake_pile, created_piles):
+    with client.session_transaction() as session:
+        session['csrf_token'] = 'test token'
+    client.post('/pagepile/1/filter', data={
+        'csrf_token': 'test token',
+        'selection': '3,7-9,119',
+    })
+    assert created_piles == [
+        ('commonswiki',
+         ['File:3.jpg', 'File:7.jpg', 'File:8.jpg', 'File:9.jpg',
+          'File:119.jpg']),
+    ]
+
+
+def test_filter_pagepile_compact_selection_out_of_range(client,
+                                                        fake_pile,
+                                                        created_piles):
+    with client.session_transaction() as session:
+        session['csrf_token'] = 'test token'
+    response = client.post('/pagepile/1/filter', data={
+        'csrf_token': 'test token',
+        'selection': '3,7-120',
+    })
+    assert response.status_code == 400
+    assert created_piles == []
+
+
+def test_filter_pagepile_remembers_diff(client, monkeypatch,
+                                        fake_sitematrix):
+    titles = ['File:%d.jpg' % i for i in range(10)]
+    loaded = []
+    created = []
+
+    def fetch_pagepile(session, id):
+        loaded.append(id)
+        return 'commonswiki', titles
+
+    def post_pagepile(session, dbname, pages):
+        created.append(list(pages))
+        return 100 + len(created)
+
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'fetch_pagepile',
+                        fetch_pagepile)
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'post_pagepile',
+                        post_pagepile)
+    with client.session_transaction() as session:
+        session['csrf_token'] = 'test token'
+    client.post('/pagepile/1/filter', data={
+        'csrf_token': 'test token',
+        'selection': '0-4,8-9',
+    })
+    assert tuple(pagepile_visual_filter.cache.get('pile-diff:101')) \
+        == (1, '5-7')
+    # second round, filtering the derived pile
+    client.post('/pagepile/101/filter', data={
+        'csrf_token': 'test token',
+        'selection': '1-5',
+    })
+    assert tuple(pagepile_visual_filter.cache.get('pile-diff:102')) \
+        == (101, '0,6')
+    expected = ['File:1.jpg', 'File:2.jpg', 'File:3.jpg', 'File:4.jpg',
+                'File:8.jpg']
+    assert created[1] == expected
+    assert pagepile_visual_filter.get_pagepile(102) \
+        == ('commons.wikimedia.org', expected)
+    assert loaded == [1]
+
+
+@pytest.fixture
+def job_queue(monkeypatch, tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'),
+                     pagepile_visual_filter._run_filter_job)
+    monkeypatch.setattr(pagepile_visual_filter, 'job_queue', queue)
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'FILTER_JOB_THRESHOLD',
+                        100)
+    return queue
+
+
+def test_filter_pagepile_job(client, fake_pile, created_piles, job_queue):
+    with client.session_transaction() as session:
+        session['csrf_token'] = 'test token'
+    response = client.post('/pagepile/1/filter', data={
+        'csrf_token': 'test token',
+        'selection': '0-99',
+    })
+    assert response.status_code == 303
+    job_url = response.headers['Location']
+    assert job_url.startswith('/job/')
+    assert created_piles == []
+
+    response = client.get(job_url)
+    assert response.status_code == 200
+    assert 'Creating the new PagePile' in response.get_data(as_text=True)
+    assert client.get(job_url + '/status').json['state'] == 'queued'
+
+    assert job_queue.run_pending()
+    assert created_piles == [('commonswiki', fake_pile[:100])]
+    assert client.get(job_url + '/status').json == {
+        'state': 'done',
+        'pile': 2,
+        'url': pagepile_visual_filter.pagepile_url(2),
+        'error': None,
+    }
+    response = client.get(job_url)
+    assert response.status_code == 302
+    assert response.headers['Location'] \
+        == pagepile_visual_filter.pagepile_url(2)
+
+
+def test_filter_pagepile_below_job_threshold(client, fake_pile,
+                                             created_piles, job_queue):
+    with client.session_transaction() as session:
+        session['csrf_token'] = 'test token'
+    response = client.post('/pagepile/1/filter', data={
+        'csrf_token': 'test token',
+        'selection': '0-98',
+    })
+    assert response.status_code == 302
+    assert len(created_piles) == 1
+
+
+def test_job_failed(client, monkeypatch, fake_pile, fake_sitematrix,
+                    job_queue):
+    def post_pagepile(session, dbname, pages):
+        raise RuntimeError('PagePile is down')
+
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'post_pagepile',
+                        post_pagepile)
+    job_queue.retries = 0
+    job_id = job_queue.submit({'id': 1, 'kept': '0-99'})
+    assert job_queue.run_pending()
+    response = client.get('/job/%s' % job_id)
+    html = response.get_data(as_text=True)
+    assert 'Filtering failed' in html
+    assert 'PagePile is down' in html
+
+
+def test_no_such_job(client):
+    assert client.get('/job/missing').status_code == 404
+    assert client.get('/job/missing/status').status_code == 404
+
+
+def test_pagepile_data_index(client, fake_pile):
+    html = client.get('/pagepile/1/').get_data(as_text=True)
+    assert 'value="File:7.jpg" class="sr-only" data-index="7"' in html
+
+
+def test_anonymous_session_shared():
+    commons = pagepile_visual_filter.anonymous_session('commons.wikimedia.org')
+    assert pagepile_visual_filter.anonymous_session('commons.wikimedia.org') \
+        is commons
+    meta = pagepile_visual_filter.anonymous_session('meta.wikimedia.org')
+    assert meta is not commons
+    assert meta.session is commons.session
+
+
+def test_metrics(client, fake_pile):
+    client.get('/pagepile/1/')
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert 'pagepile_visual_filter_upstream_duration_seconds_count' \
+        '{operation="load_files_chunk"}' in text
+    assert 'pagepile_visual_filter_render_duration_seconds_count' \
+        '{operation="render",template="pagepile.html"}' in text
+
+
+def test_server_timing(client, fake_pile, monkeypatch):
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'SERVER_TIMING',
+                        True)
+    response = client.get('/pagepile/1/')
+    assert 'load_files_chunk;desc="1 calls"' \
+        in response.headers['Server-Timing']
+    assert 'render;desc="1 calls"' in response.headers['Server-Timing']
+
+
+def test_thumbnail_disabled(client):
+    assert client.get('/thumbnail?url=https://upload.wikimedia.org/x.jpg') \
+        .status_code == 404
+
+
+@pytest.fixture
+def thumbnail_proxy(monkeypatch, tmp_path):
+    class FakeProxy:
+        def __init__(self):
+            self.prefetched = []
+
+        def get(self, url, timeout):
+            return 200, b'thumbnail', 'image/jpeg'
+
+        def prefetch(self, urls):
+            self.prefetched.extend(urls)
+
+    proxy = FakeProxy()
+    monkeypatch.setattr(pagepile_visual_filter, 'thumbnail_proxy', proxy)
+    return proxy
+
+
+def proxied_thumburl(title, width):
+    name = title[len('File:'):]
+    return 'https://upload.wikimedia.org/wikipedia/commons/thumb/a/ab/' \
+        '%s/%dpx-%s' % (name, width, name)
+
+
+def test_thumbnail(client, thumbnail_proxy):
+    response = client.get('/thumbnail',
+                          query_string={'url': proxied_thumburl('File:A.jpg',
+                                                                250)})
+    assert response.status_code == 200
+    assert response.data == b'thumbnail'
+    assert response.mimetype == 'image/jpeg'
+
+
+@pytest.mark.parametrize('url', [
+    'https://example.com/',
+    # originals are not proxied
+    'https://upload.wikimedia.org/wikipedia/commons/a/ab/A.jpg',
+])
+def test_thumbnail_not_proxied(client, thumbnail_proxy, url):
+    response = client.get('/thumbnail', query_string={'url': url})
+    assert response.status_code == 400
+
+
+def proxied_imageinfo_response(**kwargs):
+    return [{'query': {'pages': [
+        {'title': title, 'imageinfo': [{
+            'thumburl': proxied_thumburl(title, 250),
+            'responsiveUrls': {
+                '1.5': proxied_thumburl(title, 375),
+                '2': proxied_thumburl(title, 500),
+            },
+        }]}
+        for title in kwargs['titles']
+    ]}}]
+
+
+def test_pagepile_thumbnail_proxy(client, fake_pile, thumbnail_proxy,
+                                  monkeypatch):
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'anonymous_session',
+                        lambda domain: FakeSession(proxied_imageinfo_response))
+    response = client.get('/pagepile/1/')
+    html = response.get_data(as_text=True)
+    assert 'src="/thumbnail?url=%s"' % proxied_thumburl('File:0.jpg', 250) \
+        in html
+    assert 'data-thumbnail-url="/thumbnail"' in html
+    assert response.headers['Accept-CH'] == 'Sec-CH-DPR'
+    # the next window
+    assert thumbnail_proxy.prefetched == [
+        proxied_thumburl('File:%d.jpg' % i, 250) for i in range(50, 100)]
+
+
+def test_pagepile_thumbnail_proxy_density(client, fake_pile, thumbnail_proxy,
+                                          monkeypatch):
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'anonymous_session',
+                        lambda domain: FakeSession(proxied_imageinfo_response))
+    client.get('/pagepile/1/', headers={'Sec-CH-DPR': '2'})
+    assert thumbnail_proxy.prefetched[0] \
+        == proxied_thumburl('File:50.jpg', 500)
+    thumbnail_proxy.prefetched.clear()
+    client.get('/pagepile/1/files?offset=50&limit=50&dpr=1.25')
+    assert thumbnail_proxy.prefetched == [
+        proxied_thumburl('File:%d.jpg' % i, 375) for i in range(100, 120)]
+    thumbnail_proxy.prefetched.clear()
+    # the last window has no next one
+    client.get('/pagepile/1/files?offset=100&limit=50')
+    assert thumbnail_proxy.prefetched == []
+
+
+def test_after_fork(monkeypatch, tmp_path):
+    connectable = threading.Event()
+    queries = []
+
+    def query(domain):
+        assert connectable.wait(timeout=5)
+        queries.append(domain)
+
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'anonymous_session',
+                        lambda domain: FakeSession(
+                            lambda **kwargs: query(domain)))
+    heads = []
+    monkeypatch.setattr(pagepile_visual_filter.upstream_http_session,
+                        'head',
+                        lambda url, **kwargs: heads.append(
+                            (url, kwargs['timeout'])))
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), lambda params: params)
+    monkeypatch.setattr(pagepile_visual_filter, 'job_queue', queue)
+
+    # does not wait for the upstreams
+    pagepile_visual_filter.after_fork()
+    assert queue._worker is not None and queue._worker.is_alive()
+
+    connectable.set()
+    deadline = time.monotonic() + 5
+    while not heads:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert queries == ['commons.wikimedia.org', 'meta.wikimedia.org']
+    assert heads == [(pagepile_visual_filter.pagepile_api.api_url, 5)]
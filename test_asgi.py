@@ -0,0 +1,210 @@
+import asyncio
+import pytest
+import time
+
+import app as pagepile_visual_filter
+import asgi
+from cache import MemoryCache
+from fake_upstream import FakeUpstream, LOCAL_PILE_OFFSET
+from overload import Upstreams
+import pagepile
+
+
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    with FakeUpstream(latency=0.2) as fake:
+        monkeypatch.setattr(pagepile, 'api_url', fake.pagepile_api_url)
+        monkeypatch.setitem(pagepile_visual_filter.app.config,
+                            'WIKI_URL_TEMPLATE',
+                            fake.wiki_url_template)
+        monkeypatch.setattr(pagepile_visual_filter,
+                            '_anonymous_sessions',
+                            {})
+        monkeypatch.setattr(asgi, '_async_sessions', {})
+        monkeypatch.setattr(pagepile_visual_filter,
+                            'cache',
+                            MemoryCache(maxsize=10_000, ttl=60))
+        monkeypatch.setattr(pagepile_visual_filter, 'upstreams', Upstreams())
+        yield fake
+
+
+async def lifespan(event):
+    messages = [{'type': 'lifespan.' + event}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    task = asyncio.create_task(asgi.app({'type': 'lifespan'}, receive, send))
+    while not sent:
+        await asyncio.sleep(0.01)
+    if event == 'shutdown':
+        await task
+    else:
+        task.cancel()
+
+
+async def get(path, query_string=b''):
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('ascii'),
+        'query_string': query_string,
+        'root_path': '',
+        'headers': [(b'host', b'localhost')],
+        'server': ('localhost', 80),
+        'client': ('127.0.0.1', 12345),
+    }
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.app(scope, receive, send)
+    status = sent[0]['status']
+    body = b''.join(message.get('body', b'') for message in sent[1:])
+    return status, body.decode('utf-8')
+
+
+def test_pagepile(fake_upstream):
+    async def run():
+        await lifespan('startup')
+        try:
+            return await get('/pagepile/20/')
+        finally:
+            await lifespan('shutdown')
+
+    status, html = asyncio.run(run())
+    assert status == 200
+    assert html.count('<img') == 20
+    # the Flask view found everything in the cache
+    assert fake_upstream.counts['get_data'] == 1
+    assert fake_upstream.counts['query+imageinfo'] == 1
+
+
+def test_files(fake_upstream):
+    async def run():
+        await lifespan('startup')
+        try:
+            return await get('/pagepile/120/files', b'offset=100&limit=10')
+        finally:
+            await lifespan('shutdown')
+
+    status, json = asyncio.run(run())
+    assert status == 200
+    assert '"index":109' in json.replace(' ', '')
+    assert fake_upstream.counts['query+imageinfo'] == 1
+
+
+def test_concurrent_views(fake_upstream):
+    # warm up the sitematrix
+    pagepile_visual_filter.get_pagepile(1)
+
+    async def run():
+        await lifespan('startup')
+        try:
+            return await asyncio.gather(*[get('/pagepile/%d/' % id)
+                                          for id in range(10, 60)])
+        finally:
+            await lifespan('shutdown')
+
+    start = time.perf_counter()
+    responses = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    assert [status for status, html in responses] == [200] * 50
+    # 50 views × 2 upstream requests × 0.2 s each would take 20 s
+    # if handled sequentially, or 2 s with the 10 WSGI threads
+    assert elapsed < 1.5
+
+
+def test_burst(fake_upstream, monkeypatch):
+    monkeypatch.setattr(pagepile_visual_filter, 'page_cache', None)
+
+    async def run():
+        await lifespan('startup')
+        try:
+            return await asyncio.gather(*[get('/pagepile/30/')
+                                          for _ in range(20)])
+        finally:
+            await lifespan('shutdown')
+
+    responses = asyncio.run(run())
+    assert [status for status, html in responses] == [200] * 20
+    # the concurrent prefetches shared one load of the pile and files
+    assert fake_upstream.counts['get_data'] == 1
+    assert fake_upstream.counts['query+imageinfo'] == 1
+
+
+def test_pagepile_other_wiki(fake_upstream):
+    async def run():
+        await lifespan('startup')
+        try:
+            return await get('/pagepile/%d/' % (LOCAL_PILE_OFFSET + 20))
+        finally:
+            await lifespan('shutdown')
+
+    status, html = asyncio.run(run())
+    assert status == 200
+    assert html.count('<img') == 20
+    # the Flask view found everything in the cache
+    assert fake_upstream.counts['query+imageinfo@de.wikipedia.org'] == 1
+    assert 'query+imageinfo' not in fake_upstream.counts
+
+
+def test_load_files_too_many_values(monkeypatch):
+    monkeypatch.setattr(pagepile_visual_filter, '_batch_sizes', {})
+    monkeypatch.setattr(asgi, '_async_sessions', {})
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'cache',
+                        MemoryCache(maxsize=10_000, ttl=60))
+    titles = ['File:%d.jpg' % i for i in range(100)]
+
+    async def load_files():
+        try:
+            session = asgi.anonymous_async_session('commons.wikimedia.org')
+            return await asgi.load_files_async(session, titles)
+        finally:
+            await asgi.http_session().close()
+
+    with FakeUpstream(titles_limit=20) as fake:
+        monkeypatch.setitem(pagepile_visual_filter.app.config,
+                            'WIKI_URL_TEMPLATE',
+                            fake.wiki_url_template)
+        files = asyncio.run(load_files())
+
+    assert list(files) == titles
+    assert all(files.values())
+    # two rejected chunks of 50, each split into 20 + 20 + 10
+    assert fake.counts['query+imageinfo'] == 2 + 2 * 3
+
+
+def test_deadline(fake_upstream, monkeypatch):
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'REQUEST_DEADLINE',
+                        0.3)
+    monkeypatch.setattr(pagepile_visual_filter, 'page_cache', None)
+    fake_upstream.latency = 1
+
+    async def run():
+        await lifespan('startup')
+        try:
+            return await get('/pagepile/20/')
+        finally:
+            await lifespan('shutdown')
+
+    start = time.perf_counter()
+    status, html = asyncio.run(run())
+    # the deadline started before the prefetch, which used it up
+    assert status == 503
+    assert time.perf_counter() - start < 0.8
+    assert fake_upstream.counts['get_data'] == 1
@@ -0,0 +1,91 @@
+import io
+import json
+import pytest
+
+import app as pagepile_visual_filter
+import benchmark
+import pagepile
+
+
+@pytest.fixture(autouse=True)
+def restore_configuration(monkeypatch):
+    monkeypatch.setattr(pagepile, 'api_url', pagepile.api_url)
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'WIKI_URL_TEMPLATE',
+                        'https://{domain}')
+    monkeypatch.setattr(pagepile_visual_filter, '_anonymous_sessions', {})
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'cache',
+                        pagepile_visual_filter.cache)
+
+
+def test_run():
+    output = io.StringIO()
+    results = benchmark.run([10, 120],
+                            ['view', 'view_all', 'filter'],
+                            iterations=2,
+                            concurrency=2,
+                            output=output)
+    assert [json.loads(line) for line in output.getvalue().splitlines()] \
+        == results
+    assert [(result['scenario'], result['size']) for result in results] == [
+        ('view', 10), ('view', 120),
+        ('view_all', 10), ('view_all', 120),
+        ('filter', 10), ('filter', 120),
+    ]
+    for result in results:
+        assert 0 < result['p50_ms'] <= result['p99_ms']
+        assert result['requests_per_second'] > 0
+        assert result['peak_rss_kib'] > 0
+    view_all_120 = results[3]
+    # 2 iterations × 3 chunks, unless the concurrent iterations
+    # shared chunks (see single_flight.py)
+    assert 3 <= view_all_120['upstream_requests']['query+imageinfo'] <= 2 * 3
+
+
+def test_run_warm():
+    results = benchmark.run([10],
+                            ['view'],
+                            iterations=2,
+                            warm=True,
+                            output=io.StringIO())
+    assert 'query+imageinfo' not in results[0]['upstream_requests']
+
+
+def test_run_with_injected_errors(monkeypatch):
+    monkeypatch.setitem(pagepile_visual_filter.app.config,
+                        'HTTP_BACKOFF',
+                        0)
+    monkeypatch.setattr(pagepile_visual_filter,
+                        'http_session',
+                        pagepile_visual_filter.make_http_session(
+                            pagepile_visual_filter.app.config))
+    results = benchmark.run([10],
+                            ['view'],
+                            iterations=5,
+                            error_rate=0.5,
+                            output=io.StringIO())
+    # failed requests were retried (5 × get_data, 5 × imageinfo, sitematrix)
+    assert sum(results[0]['upstream_requests'].values()) > 11
+
+
+def test_run_memory():
+    output = io.StringIO()
+    results = benchmark.run_memory([100], output=output)
+    assert [json.loads(line) for line in output.getvalue().splitlines()] \
+        == results
+    assert results[0]['scenario'] == 'memory'
+    assert results[0]['compact_bytes_per_file'] \
+        < results[0]['api_bytes_per_file']
+
+
+def test_run_startup():
+    output = io.StringIO()
+    cold, preload = benchmark.run_startup([10], output=output)
+    assert [json.loads(line) for line in output.getvalue().splitlines()] \
+        == [cold, preload]
+    assert (cold['mode'], preload['mode']) == ('cold', 'preload')
+    assert cold['first_request_ms'] > 0
+    # the sitematrix was fetched before forking
+    assert 'warm_up_ms' in preload and 'warm_up_ms' not in cold
+    assert preload['upstream_requests']['sitematrix'] == 1
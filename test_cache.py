@@ -0,0 +1,127 @@
+import pytest
+import threading
+import time
+
+from cache import MemoryCache, RedisCache, SqliteCache, SqliteConnections
+
+from test_utils import FakeRedis
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def cache(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryCache(maxsize=3, ttl=60)
+    if request.param == 'sqlite':
+        return SqliteCache(str(tmp_path / 'cache.sqlite3'), maxsize=3, ttl=60)
+    if request.param == 'redis':
+        return RedisCache(FakeRedis(), ttl=60)
+
+
+def test_get_missing(cache):
+    assert cache.get('missing') is None
+    assert cache.get('missing', 'default') == 'default'
+    assert cache.get_many(['missing']) == {}
+
+
+def test_set_get(cache):
+    cache.set('pile:1', ['commons.wikimedia.org', ['File:A.jpg']])
+    assert cache.get('pile:1') == ['commons.wikimedia.org', ['File:A.jpg']]
+
+
+def test_get_many_includes_cached_none(cache):
+    cache.set_many({'a': None, 'b': {'thumburl': 'https://example/b'}})
+    assert cache.get_many(['a', 'b', 'c']) == {
+        'a': None,
+        'b': {'thumburl': 'https://example/b'},
+    }
+
+
+def test_sqlite_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    SqliteCache(path, maxsize=3, ttl=60).set('key', 'value')
+    assert SqliteCache(path, maxsize=3, ttl=60).get('key') == 'value'
+
+
+@pytest.mark.parametrize('make_cache', [
+    lambda tmp_path: MemoryCache(maxsize=2, ttl=60),
+    lambda tmp_path: SqliteCache(str(tmp_path / 'cache.sqlite3'),
+                                 maxsize=2,
+                                 ttl=60,
+                                 touch_interval=0),
+])
+def test_lru_eviction(make_cache, tmp_path):
+    cache = make_cache(tmp_path)
+    cache.set('a', 1)
+    time.sleep(0.01)
+    cache.set('b', 2)
+    time.sleep(0.01)
+    cache.get('a')
+    time.sleep(0.01)
+    cache.set('c', 3)
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'c': 3}
+
+
+@pytest.mark.parametrize('make_cache', [
+    lambda tmp_path: MemoryCache(maxsize=2, ttl=0.01),
+    lambda tmp_path: SqliteCache(str(tmp_path / 'cache.sqlite3'),
+                                 maxsize=2,
+                                 ttl=0.01),
+])
+def test_ttl_expiry(make_cache, tmp_path):
+    cache = make_cache(tmp_path)
+    cache.set('a', 1)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+
+
+def sqlite_count(cache):
+    return cache._connections.get().execute(
+        'SELECT COUNT(*) FROM cache').fetchone()[0]
+
+
+def test_sqlite_touch_interval(tmp_path):
+    cache = SqliteCache(str(tmp_path / 'cache.sqlite3'),
+                        maxsize=2,
+                        ttl=60,
+                        touch_interval=0.05)
+    cache.set('a', 1)
+    time.sleep(0.01)
+    cache.set('b', 2)
+    # accessed too recently to be updated
+    cache.get('a')
+    time.sleep(0.06)
+    cache.set('c', 3)
+    assert cache.get_many(['a', 'b', 'c']) == {'b': 2, 'c': 3}
+
+
+def test_sqlite_eviction_batches(tmp_path):
+    cache = SqliteCache(str(tmp_path / 'cache.sqlite3'), maxsize=300, ttl=60)
+    cache.set_many({'key%d' % i: i for i in range(300)})
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert sqlite_count(cache) == 302
+    cache.set('c', 3)
+    assert sqlite_count(cache) == 300
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2, 'c': 3}
+
+
+def test_sqlite_connections(tmp_path):
+    connections = SqliteConnections(str(tmp_path / 'cache.sqlite3'))
+    connection = connections.get()
+    assert connections.get() is connection
+    other = []
+    thread = threading.Thread(target=lambda: other.append(connections.get()))
+    thread.start()
+    thread.join()
+    assert other[0] is not connection
+    connections.after_fork()
+    assert connections.get() is not connection
+
+
+def test_sqlite_after_fork(tmp_path):
+    cache = SqliteCache(str(tmp_path / 'cache.sqlite3'), maxsize=3, ttl=60)
+    cache.set('key', 'value')
+    connection = cache._connections.get()
+    cache.after_fork()
+    assert cache._connections.get() is not connection
+    assert cache.get('key') == 'value'
@@ -0,0 +1,110 @@
+import io
+import itertools
+import pytest
+import random
+
+from cache import MemoryCache
+from duplicates import DuplicateFinder, HashIndex, cluster, dhash, \
+    hamming_distance
+from imageinfo import ImageInfo
+
+
+def test_hamming_distance():
+    assert hamming_distance(0b1011, 0b1011) == 0
+    assert hamming_distance(0b1011, 0b0010) == 2
+    assert hamming_distance(0, 2**64 - 1) == 64
+
+
+@pytest.mark.parametrize('max_distance', [0, 3, 6, 9])
+def test_hash_index_matches_brute_force(max_distance):
+    r = random.Random(max_distance)
+    hashes = [r.getrandbits(64) for _ in range(200)]
+    # plus some near-duplicates
+    for hash in hashes[:100]:
+        for _ in range(r.randint(0, max_distance + 2)):
+            hash ^= 1 << r.randrange(64)
+        hashes.append(hash)
+    index: HashIndex[int] = HashIndex(max_distance)
+    for position, hash in enumerate(hashes):
+        index.add(hash, position)
+    for hash in hashes[::10]:
+        assert set(index.search(hash)) == {
+            position for position, other in enumerate(hashes)
+            if hamming_distance(hash, other) <= max_distance
+        }
+
+
+def test_cluster():
+    hashes = [
+        ('A', 0b0000),
+        ('B', 0b1111_0000),
+        ('C', 0b0001),
+        ('D', 0b0011),  # close to C, not to A
+        ('E', 0b1111_0001),
+    ]
+    assert cluster(hashes, 1) == [['A', 'C', 'D'], ['B', 'E']]
+    assert cluster(hashes, 0) == [['A'], ['B'], ['C'], ['D'], ['E']]
+
+
+def test_dhash():
+    Image = pytest.importorskip('PIL.Image')
+
+    def png(image):
+        data = io.BytesIO()
+        image.save(data, format='PNG')
+        return data.getvalue()
+
+    gradient = Image.linear_gradient('L').rotate(90).resize((300, 200))
+    larger = gradient.resize((600, 400))
+    inverted = gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    assert hamming_distance(dhash(png(gradient)), dhash(png(larger))) <= 2
+    assert hamming_distance(dhash(png(gradient)), dhash(png(inverted))) > 32
+
+
+def int_hash(data):
+    # must be picklable for the process pool
+    return int(data)
+
+
+def files(hashes):
+    return [(index,
+             'File:%d.jpg' % index,
+             ImageInfo('https://example/%d' % hash, 250, 250))
+            for index, hash in enumerate(hashes)]
+
+
+def test_duplicate_finder_group():
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        return url[len('https://example/'):].encode()
+
+    finder = DuplicateFinder(MemoryCache(maxsize=100, ttl=60),
+                             fetch,
+                             max_distance=1,
+                             processes=1,
+                             hash_function=int_hash)
+    pile = files([0b0000, 0b1111_0000, 0b0001]) + [(3, 'Not a file', None)]
+    groups, pending = finder.group(pile, timeout=None)
+    assert groups == [[pile[0], pile[2]], [pile[1]], [pile[3]]]
+    assert pending == 0
+    # hashes are cached
+    finder.group(pile, timeout=None)
+    assert len(fetched) == 3
+
+
+def test_duplicate_finder_timeout():
+    def fetch(url):
+        raise ConnectionError('no network')
+
+    finder = DuplicateFinder(MemoryCache(maxsize=100, ttl=60),
+                             fetch,
+                             processes=1,
+                             hash_function=int_hash)
+    pile = files([0, 0])
+    groups, pending = finder.group(pile, timeout=0)
+    assert len(list(itertools.chain(*groups))) == 2
+    assert pending in {0, 2}  # depending on how quickly fetch() failed
+    # failed fetches are not cached
+    assert finder.cache.get_many(['dhash:title:File:0.jpg']) == {}
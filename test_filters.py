@@ -0,0 +1,77 @@
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from filters import Filters
+from imageinfo import ImageInfo, parse_timestamp
+
+
+def imageinfo(mime='image/jpeg', size=1000, width=800, height=600,
+              timestamp='2020-06-01T12:00:00Z'):
+    return ImageInfo('https://example/thumb.jpg', 250, 188,
+                     mime=mime,
+                     size=size,
+                     width=width,
+                     height=height,
+                     timestamp=parse_timestamp(timestamp))
+
+
+def test_no_filters():
+    filters = Filters.from_args(MultiDict({'all': '1', 'mime': ''}))
+    assert not filters
+    assert filters.matches(imageinfo())
+    assert not filters.matches(None)
+
+
+@pytest.mark.parametrize('args, matches', [
+    ({'mime': 'image/jpeg'}, True),
+    ({'mime': 'image/png'}, False),
+    ({'mime': 'image/*'}, True),
+    ({'mime': 'video/*'}, False),
+    ({'min_width': '800'}, True),
+    ({'min_width': '801'}, False),
+    ({'max_width': '800'}, True),
+    ({'max_height': '599'}, False),
+    ({'min_size': '1000', 'max_size': '1000'}, True),
+    ({'max_size': '999'}, False),
+    ({'after': '2020-01-01'}, True),
+    ({'after': '2021-01-01'}, False),
+    ({'before': '2020-06-01T12:00:00Z'}, True),
+    ({'before': '2020-06-01'}, False),
+    ({'mime': 'image/jpeg', 'min_width': '1000'}, False),
+])
+def test_matches(args, matches):
+    filters = Filters.from_args(MultiDict(args))
+    assert filters
+    assert filters.matches(imageinfo()) == matches
+
+
+def test_several_mime_types():
+    filters = Filters.from_args(MultiDict([('mime', 'image/png'),
+                                           ('mime', 'image/jpeg')]))
+    assert filters.matches(imageinfo())
+    assert not filters.matches(imageinfo(mime='image/gif'))
+
+
+def test_missing_metadata():
+    filters = Filters.from_args(MultiDict({'min_width': '1'}))
+    assert not filters.matches(ImageInfo('https://example/thumb.jpg', 1, 1))
+
+
+@pytest.mark.parametrize('args', [
+    {'min_width': 'wide'},
+    {'after': 'yesterday'},
+])
+def test_invalid(args):
+    with pytest.raises(ValueError):
+        Filters.from_args(MultiDict(args))
+
+
+def test_apply():
+    filters = Filters.from_args(MultiDict({'min_width': '1000'}))
+    files = [
+        ('File:Small.jpg', imageinfo(width=500)),
+        ('File:Large.jpg', imageinfo(width=5000)),
+        ('Not a file', None),
+    ]
+    assert [title for title, _ in filters.apply(iter(files))] \
+        == ['File:Large.jpg']
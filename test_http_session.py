@@ -0,0 +1,45 @@
+import pytest
+import requests
+
+from fake_upstream import FakeUpstream
+from http_session import make_http_session, make_upstream_session
+
+
+def test_make_http_session_defaults():
+    session = make_http_session({})
+    adapter = session.get_adapter('https://pagepile.toolforge.org/')
+    assert adapter._pool_maxsize == 10
+    assert adapter._pool_connections == 50
+    assert adapter.max_retries.total == 3
+    assert 'POST' not in adapter.max_retries.allowed_methods
+
+
+def test_make_http_session_config():
+    session = make_http_session({
+        'HTTP_POOL_SIZE': 20,
+        'HTTP_POOL_HOSTS': 5,
+        'HTTP_RETRIES': 5,
+        'HTTP_BACKOFF': 2,
+    })
+    adapter = session.get_adapter('https://commons.wikimedia.org/')
+    assert adapter._pool_maxsize == 20
+    assert adapter._pool_connections == 5
+    assert adapter.max_retries.total == 5
+    assert adapter.max_retries.backoff_factor == 2
+
+
+def test_make_upstream_session():
+    session = make_http_session({'HTTP_BACKOFF': 0})
+    upstream = make_upstream_session(session)
+    adapter = upstream.get_adapter('https://commons.wikimedia.org/')
+    assert adapter.max_retries.total == 0
+    assert adapter.poolmanager \
+        is session.get_adapter('https://commons.wikimedia.org/').poolmanager
+    with FakeUpstream(error_rate=1) as fake:
+        # the shared session retries and then returns the response
+        assert session.get(fake.pagepile_api_url).status_code == 503
+        assert fake.counts[''] == 4
+        with pytest.raises(requests.HTTPError) as excinfo:
+            upstream.get(fake.pagepile_api_url)
+        assert excinfo.value.response.status_code == 503
+        assert fake.counts[''] == 5
@@ -0,0 +1,106 @@
+import json
+
+from imageinfo import ImageInfo
+
+
+API_IMAGEINFO = {
+    'thumburl': 'https://upload.wikimedia.org/wikipedia/commons/thumb/'
+    'a/ab/A.jpg/250px-A.jpg',
+    'thumbwidth': 250,
+    'thumbheight': 188,
+    'responsiveUrls': {
+        '1.5': 'https://upload.wikimedia.org/wikipedia/commons/thumb/'
+        'a/ab/A.jpg/375px-A.jpg',
+        '2': 'https://upload.wikimedia.org/wikipedia/commons/thumb/'
+        'a/ab/A.jpg/500px-A.jpg',
+    },
+    'timestamp': '2020-01-01T00:00:00Z',
+    'size': 123456,
+    'width': 4000,
+    'height': 3000,
+    'mime': 'image/jpeg',
+    'url': 'https://upload.wikimedia.org/wikipedia/commons/a/ab/A.jpg',
+    'descriptionurl': 'https://commons.wikimedia.org/wiki/File:A.jpg',
+}
+
+
+def test_from_api():
+    imageinfo = ImageInfo.from_api(API_IMAGEINFO)
+    assert imageinfo.thumburl == API_IMAGEINFO['thumburl']
+    assert imageinfo.thumbwidth == 250
+    assert imageinfo.thumbheight == 188
+    assert imageinfo.responsiveUrls == API_IMAGEINFO['responsiveUrls']
+    assert imageinfo._thumburl == 'a/ab/A.jpg/250px-A.jpg'
+    assert imageinfo.mime == 'image/jpeg'
+    assert imageinfo.size == 123456
+    assert (imageinfo.width, imageinfo.height) == (4000, 3000)
+    assert imageinfo.timestamp == 1577836800
+
+
+def test_to_json():
+    imageinfo = ImageInfo.from_api(API_IMAGEINFO)
+    assert imageinfo.to_json() == {
+        'thumburl': API_IMAGEINFO['thumburl'],
+        'thumbwidth': 250,
+        'thumbheight': 188,
+        'responsiveUrls': API_IMAGEINFO['responsiveUrls'],
+        'mime': 'image/jpeg',
+        'size': 123456,
+        'width': 4000,
+        'height': 3000,
+        'timestamp': '2020-01-01T00:00:00Z',
+    }
+
+
+def test_other_urls_kept():
+    imageinfo = ImageInfo('https://example/A.jpg', 10, 20,
+                          [('2', 'http://example/B.jpg')])
+    assert imageinfo.thumburl == 'https://example/A.jpg'
+    assert imageinfo.responsiveUrls == {'2': 'http://example/B.jpg'}
+    assert 'responsiveUrls' in imageinfo.to_json()
+    assert 'responsiveUrls' not in ImageInfo('https://example/A.jpg',
+                                             10,
+                                             20).to_json()
+
+
+def test_cached_roundtrip():
+    imageinfo = ImageInfo.from_api(API_IMAGEINFO)
+    assert ImageInfo.from_cached(imageinfo.to_cached()) == imageinfo
+    # the shared cache backends store JSON
+    cached = json.loads(json.dumps(imageinfo.to_cached()))
+    assert ImageInfo.from_cached(cached) == imageinfo
+    assert ImageInfo.from_cached(cached).responsiveUrls \
+        == API_IMAGEINFO['responsiveUrls']
+
+
+def test_no_instance_dict():
+    assert not hasattr(ImageInfo.from_api(API_IMAGEINFO), '__dict__')
+
+
+def test_responsive_urls_stored_as_widths():
+    imageinfo = ImageInfo.from_api(API_IMAGEINFO)
+    assert imageinfo._responsive == (('1.5', 375), ('2', 500))
+    other = ImageInfo.from_api({
+        **API_IMAGEINFO,
+        'thumburl': API_IMAGEINFO['thumburl'].replace('A.jpg', 'B.jpg'),
+    })
+    # the responsive URLs no longer match the thumb URL
+    assert other._responsive == (('1.5', 'a/ab/A.jpg/375px-A.jpg'),
+                                 ('2', 'a/ab/A.jpg/500px-A.jpg'))
+    assert other.responsiveUrls == API_IMAGEINFO['responsiveUrls']
+
+
+def test_thumburl_for():
+    imageinfo = ImageInfo('https://upload.wikimedia.org/1x.jpg', 250, 200, [
+        ('2', 'https://upload.wikimedia.org/2x.jpg'),
+        ('1.5', 'https://upload.wikimedia.org/1.5x.jpg'),
+    ])
+    assert imageinfo.thumburl_for(1) == 'https://upload.wikimedia.org/1x.jpg'
+    assert imageinfo.thumburl_for(0.5) \
+        == 'https://upload.wikimedia.org/1x.jpg'
+    assert imageinfo.thumburl_for(1.25) \
+        == 'https://upload.wikimedia.org/1.5x.jpg'
+    assert imageinfo.thumburl_for(2) == 'https://upload.wikimedia.org/2x.jpg'
+    assert imageinfo.thumburl_for(3) == 'https://upload.wikimedia.org/2x.jpg'
+    assert ImageInfo('https://upload.wikimedia.org/1x.jpg', 250, 200) \
+        .thumburl_for(2) == 'https://upload.wikimedia.org/1x.jpg'
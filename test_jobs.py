@@ -0,0 +1,108 @@
+import time
+
+from jobs import JobQueue
+
+
+def test_submit_run(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), lambda params: params * 2)
+    id = queue.submit(21)
+    assert queue.get(id).state == 'queued'
+    assert queue.run_pending()
+    job = queue.get(id)
+    assert job.state == 'done'
+    assert job.result == 42
+    assert job.attempts == 1
+    assert not queue.run_pending()
+
+
+def test_get_missing(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), lambda params: None)
+    assert queue.get('missing') is None
+
+
+def test_retry_then_fail(tmp_path):
+    def handler(params):
+        raise RuntimeError('upload failed')
+
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'),
+                     handler,
+                     retries=1,
+                     backoff=0)
+    id = queue.submit({})
+    assert queue.run_pending()
+    job = queue.get(id)
+    assert job.state == 'queued'
+    assert job.error == 'upload failed'
+    assert queue.run_pending()
+    job = queue.get(id)
+    assert job.state == 'failed'
+    assert job.attempts == 2
+    assert not queue.run_pending()
+
+
+def test_retry_backoff(tmp_path):
+    attempts = []
+
+    def handler(params):
+        attempts.append(params)
+        if len(attempts) == 1:
+            raise RuntimeError('upload failed')
+        return 'ok'
+
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), handler, backoff=60)
+    id = queue.submit('params')
+    assert queue.run_pending()
+    # not retried before the backoff is over
+    assert not queue.run_pending()
+    assert queue.get(id).state == 'queued'
+
+
+def test_survives_restart(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    id = JobQueue(path, lambda params: None).submit('params')
+    queue = JobQueue(path, lambda params: params.upper())
+    assert queue.run_pending()
+    assert queue.get(id).result == 'PARAMS'
+
+
+def test_expired_lease_is_picked_up_again(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    crashed = JobQueue(path, lambda params: None, lease=0)
+    id = crashed.submit('params')
+    assert crashed._claim().id == id  # the worker dies before finishing
+    queue = JobQueue(path, lambda params: 'done')
+    assert queue.run_pending()
+    job = queue.get(id)
+    assert job.state == 'done'
+    assert job.attempts == 2
+
+
+def test_running_job_not_picked_up_twice(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    queue = JobQueue(path, lambda params: None)
+    queue.submit('params')
+    assert queue._claim() is not None
+    assert queue._claim() is None
+
+
+def test_worker_thread(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), lambda params: params)
+    queue.start()
+    id = queue.submit('params')
+    deadline = time.monotonic() + 5
+    while queue.get(id).state != 'done':
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_after_fork(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), lambda params: params)
+    connection = queue._connections.get()
+    queue.after_fork()
+    assert queue._connections.get() is not connection
+    queue.start()
+    id = queue.submit('params')
+    deadline = time.monotonic() + 5
+    while queue.get(id).state != 'done':
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
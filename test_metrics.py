@@ -0,0 +1,74 @@
+import flask
+
+import metrics
+
+
+def test_counter_expose():
+    counter = metrics.Counter('test_total', 'A test counter.')
+    counter.inc(cache='pile', result='hit')
+    counter.inc(2, cache='pile', result='hit')
+    counter.inc(cache='pile', result='miss')
+    assert list(counter.expose()) == [
+        '# HELP test_total A test counter.',
+        '# TYPE test_total counter',
+        'test_total{cache="pile",result="hit"} 3.0',
+        'test_total{cache="pile",result="miss"} 1.0',
+    ]
+
+
+def test_gauge_expose():
+    gauge = metrics.Gauge('test_limit', 'A test gauge.')
+    gauge.set(10, host='a')
+    gauge.set(5, host='a')
+    gauge.set(7, host='b')
+    assert gauge.value(host='a') == 5
+    assert list(gauge.expose()) == [
+        '# HELP test_limit A test gauge.',
+        '# TYPE test_limit gauge',
+        'test_limit{host="a"} 5.0',
+        'test_limit{host="b"} 7.0',
+    ]
+
+
+def test_histogram_expose():
+    histogram = metrics.Histogram('test_seconds', 'A test histogram.', (1, 5))
+    histogram.observe(0.5, operation='x')
+    histogram.observe(3, operation='x')
+    histogram.observe(10, operation='x')
+    assert list(histogram.expose()) == [
+        '# HELP test_seconds A test histogram.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{operation="x",le="1.0"} 1',
+        'test_seconds_bucket{operation="x",le="5.0"} 2',
+        'test_seconds_bucket{operation="x",le="+Inf"} 3',
+        'test_seconds_sum{operation="x"} 13.5',
+        'test_seconds_count{operation="x"} 3',
+    ]
+    assert histogram.count(operation='x') == 3
+    assert histogram.count(operation='y') == 0
+
+
+def test_label_escaping():
+    counter = metrics.Counter('test_total', 'A test counter.')
+    counter.inc(template='a"b\\c')
+    assert list(counter.expose())[-1] \
+        == 'test_total{template="a\\"b\\\\c"} 1.0'
+
+
+def test_timed_server_timing():
+    histogram = metrics.Histogram('test_seconds', 'A test histogram.', (1,))
+    with flask.Flask(__name__).test_request_context():
+        with metrics.timed(histogram, 'chunk'):
+            pass
+        with metrics.timed(histogram, 'chunk'):
+            pass
+        header = metrics.server_timing_header()
+    assert histogram.count(operation='chunk') == 2
+    assert header.startswith('chunk;desc="2 calls";dur=')
+
+
+def test_timed_without_request_context():
+    histogram = metrics.Histogram('test_seconds', 'A test histogram.', (1,))
+    with metrics.timed(histogram, 'sitematrix'):
+        pass
+    assert histogram.count(operation='sitematrix') == 1
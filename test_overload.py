@@ -0,0 +1,365 @@
+import aiohttp
+import asyncio
+import mwapi  # type: ignore
+import pytest
+import requests
+import threading
+import time
+
+from overload import AdaptiveLimit, CircuitBreaker, Overloaded, Upstreams, \
+    is_failure
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_is_failure():
+    assert is_failure(mwapi.errors.ConnectionError('refused'))
+    assert is_failure(mwapi.errors.TimeoutError('timed out'))
+    assert is_failure(asyncio.TimeoutError())
+    assert not is_failure(mwapi.errors.APIError('maxlag', 'lagged', None))
+    assert not is_failure(ValueError('invalid JSON'))
+    wrapped = mwapi.errors.RequestError('API error')
+    wrapped.__cause__ = mwapi.errors.APIError('maxlag', 'lagged', None)
+    assert not is_failure(wrapped)
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    error = requests.HTTPError(response=response)
+    # as raised by mwapi.Session
+    wrapped = mwapi.errors.HTTPError(str(error))
+    wrapped.__cause__ = error
+    return wrapped
+
+
+def test_is_failure_http_status():
+    assert is_failure(http_error(503))
+    assert is_failure(http_error(429))
+    assert not is_failure(http_error(404))
+    response_error = aiohttp.ClientResponseError(None, (), status=502)
+    assert is_failure(response_error)
+    wrapped = mwapi.errors.RequestError('bad gateway')
+    wrapped.__cause__ = response_error
+    assert is_failure(wrapped)
+    assert not is_failure(aiohttp.ClientResponseError(None, (), status=400))
+
+
+def test_limit_acquire():
+    limit = AdaptiveLimit(initial=2)
+    assert limit.acquire(0)
+    assert limit.acquire(0)
+    start = time.perf_counter()
+    assert not limit.acquire(0.1)
+    assert time.perf_counter() - start >= 0.1
+    limit.release()
+    assert limit.acquire(0)
+    assert limit.in_flight == 2
+
+
+def test_limit_acquire_waits_for_release():
+    limit = AdaptiveLimit(initial=1)
+    assert limit.acquire(0)
+    timer = threading.Timer(0.1, limit.release)
+    timer.start()
+    assert limit.acquire(1)
+    timer.join()
+
+
+def test_limit_decreases_on_slow_or_failed_calls():
+    clock = FakeClock()
+    limit = AdaptiveLimit(initial=16, latency_target=1, clock=clock)
+    for _ in range(3):
+        limit.acquire(0)
+    limit.release(2)
+    assert limit.limit == 8
+    # calls that were slow together only count once
+    limit.release(0.1, failed=True)
+    assert limit.limit == 8
+    clock.now += 1
+    limit.release(0.1, failed=True)
+    assert limit.limit == 4
+
+
+def test_limit_minimum():
+    clock = FakeClock()
+    limit = AdaptiveLimit(initial=2, latency_target=1, clock=clock)
+    for _ in range(3):
+        limit.acquire(0)
+        limit.release(2)
+        clock.now += 1
+    assert limit.limit == 1
+
+
+def test_limit_increases_on_fast_calls_when_used():
+    limit = AdaptiveLimit(initial=4, maximum=6)
+    # lone calls in a limit of 4 do not raise it
+    for _ in range(10):
+        limit.acquire(0)
+        limit.release(0.1)
+    assert limit.limit == 4
+    # rounds of fast calls using the whole limit raise it, up to the maximum
+    limits = []
+    for _ in range(7):
+        for _ in range(limit.limit):
+            assert limit.acquire(0)
+        for _ in range(limit.limit):
+            limit.release(0.1)
+        limits.append(limit.limit)
+    assert limits == [4, 4, 5, 5, 6, 6, 6]
+
+
+def test_breaker_opens_after_consecutive_failures():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10,
+                             clock=clock)
+    for success in (False, False, True, False, False):
+        assert breaker.allow()
+        breaker.record(success)
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    clock.now += 4
+    assert breaker.retry_after() == 6
+
+
+def test_breaker_half_open():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10,
+                             clock=clock)
+    breaker.allow()
+    breaker.record(False)
+    clock.now += 10
+    assert breaker.state == 'half-open'
+    # one trial call at a time
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == 'open'
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_breaker_trial_not_made():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10,
+                             clock=clock)
+    breaker.allow()
+    breaker.record(False)
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record(None)
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+
+
+def fail(upstreams, host, count=1):
+    for _ in range(count):
+        with pytest.raises(mwapi.errors.ConnectionError):
+            with upstreams.call(host, 30):
+                raise mwapi.errors.ConnectionError('refused')
+
+
+def test_call_circuit_open():
+    upstreams = Upstreams(failure_threshold=2, reset_timeout=30)
+    fail(upstreams, 'commons.wikimedia.org', 2)
+
+    with pytest.raises(Overloaded) as excinfo:
+        with upstreams.call('commons.wikimedia.org', 30):
+            pytest.fail('call not refused')
+    assert excinfo.value.reason == 'circuit'
+    assert 29 < excinfo.value.retry_after <= 30
+    # other hosts are not affected
+    with upstreams.call('de.wikipedia.org', 30):
+        pass
+    assert upstreams.degraded('commons.wikimedia.org')
+    assert not upstreams.degraded('de.wikipedia.org')
+    status = upstreams.status()
+    assert status['commons.wikimedia.org']['circuit'] == 'open'
+    assert status['de.wikipedia.org']['circuit'] == 'closed'
+
+
+def test_call_api_error_is_no_failure():
+    upstreams = Upstreams(failure_threshold=1)
+    with pytest.raises(mwapi.errors.APIError):
+        with upstreams.call('commons.wikimedia.org', 30):
+            raise mwapi.errors.APIError('maxlag', 'lagged', None)
+    assert not upstreams.degraded('commons.wikimedia.org')
+
+
+def test_call_limit():
+    upstreams = Upstreams(initial_limit=1, queue_timeout=0.1)
+    entered = threading.Event()
+    done = threading.Event()
+
+    def hold():
+        with upstreams.call('commons.wikimedia.org', 30):
+            entered.set()
+            done.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    entered.wait()
+    try:
+        with pytest.raises(Overloaded) as excinfo:
+            with upstreams.call('commons.wikimedia.org', 30):
+                pytest.fail('call not refused')
+        assert excinfo.value.reason == 'limit'
+        assert upstreams.degraded('commons.wikimedia.org')
+    finally:
+        done.set()
+        thread.join()
+    with upstreams.call('commons.wikimedia.org', 30):
+        pass
+    upstreams.degraded_window = 0
+    assert not upstreams.degraded('commons.wikimedia.org')
+
+
+def test_call_waiting_is_not_degraded():
+    upstreams = Upstreams(initial_limit=1, queue_timeout=1)
+    with upstreams.call('commons.wikimedia.org', 30):
+        thread = threading.Thread(target=fail,
+                                  args=(upstreams, 'commons.wikimedia.org'))
+        thread.start()
+        time.sleep(0.1)
+        assert not upstreams.degraded('commons.wikimedia.org')
+    thread.join()
+
+
+def test_call_deadline():
+    upstreams = Upstreams()
+    with upstreams.call('commons.wikimedia.org',
+                        30,
+                        time.monotonic() + 5) as timeout:
+        assert 4 < timeout <= 5
+    with upstreams.call('commons.wikimedia.org', 3, None) as timeout:
+        assert timeout == 3
+    with pytest.raises(Overloaded) as excinfo:
+        with upstreams.call('commons.wikimedia.org',
+                            30,
+                            time.monotonic() - 1):
+            pytest.fail('call not refused')
+    assert excinfo.value.reason == 'deadline'
+
+
+def test_call_out_of_time():
+    upstreams = Upstreams(failure_threshold=1, latency_target=0.05)
+    with pytest.raises(Overloaded) as excinfo:
+        with upstreams.call('commons.wikimedia.org',
+                            30,
+                            time.monotonic() + 0.1) as timeout:
+            time.sleep(timeout)
+            raise mwapi.errors.TimeoutError('timed out')
+    assert excinfo.value.reason == 'deadline'
+    assert isinstance(excinfo.value.__cause__, mwapi.errors.TimeoutError)
+    # the call timed out because the request was out of time,
+    # not because of the host
+    status = upstreams.status()['commons.wikimedia.org']
+    assert status['circuit'] == 'closed'
+    assert status['limit'] == upstreams.initial_limit
+
+
+def test_call_expect_slow():
+    upstreams = Upstreams(initial_limit=8, latency_target=0.05)
+    with upstreams.call('commons.wikimedia.org', 30, expect_slow=True):
+        time.sleep(0.1)
+    assert upstreams.status()['commons.wikimedia.org']['limit'] == 8
+    with upstreams.call('commons.wikimedia.org', 30):
+        time.sleep(0.1)
+    assert upstreams.status()['commons.wikimedia.org']['limit'] == 4
+
+
+def test_check():
+    upstreams = Upstreams(failure_threshold=1, reset_timeout=30)
+    upstreams.check('commons.wikimedia.org', time.monotonic() + 5, 1)
+    with pytest.raises(Overloaded):
+        upstreams.check('commons.wikimedia.org', time.monotonic() + 5, 10)
+    fail(upstreams, 'commons.wikimedia.org')
+    with pytest.raises(Overloaded):
+        upstreams.check('commons.wikimedia.org')
+    # the circuit will let a trial call through after the delay
+    upstreams.check('commons.wikimedia.org', None, 60)
+
+
+def test_run_retries_failures():
+    upstreams = Upstreams(retries=2, backoff=0)
+    timeouts = []
+
+    def call(timeout):
+        timeouts.append(timeout)
+        if len(timeouts) < 3:
+            raise mwapi.errors.ConnectionError('refused')
+        return 'result'
+
+    assert upstreams.run('commons.wikimedia.org', call, 30) == 'result'
+    assert timeouts == [30, 30, 30]
+    timeouts.clear()
+    upstreams.retries = 1
+    with pytest.raises(mwapi.errors.ConnectionError):
+        upstreams.run('commons.wikimedia.org', call, 30)
+    assert len(timeouts) == 2
+
+
+def test_run_does_not_retry_other_errors():
+    upstreams = Upstreams(backoff=0)
+    calls = []
+
+    def call(timeout):
+        calls.append(timeout)
+        raise mwapi.errors.APIError('maxlag', 'lagged', None)
+
+    with pytest.raises(mwapi.errors.APIError):
+        upstreams.run('commons.wikimedia.org', call, 30)
+    assert len(calls) == 1
+
+
+def test_run_retries_within_deadline():
+    upstreams = Upstreams(retries=3, backoff=0.2)
+    timeouts = []
+
+    def call(timeout):
+        timeouts.append(timeout)
+        raise mwapi.errors.ConnectionError('refused')
+
+    start = time.perf_counter()
+    with pytest.raises(Overloaded) as excinfo:
+        upstreams.run('commons.wikimedia.org',
+                      call,
+                      30,
+                      time.monotonic() + 0.5)
+    assert time.perf_counter() - start < 0.5
+    assert excinfo.value.reason == 'deadline'
+    assert isinstance(excinfo.value.__cause__, mwapi.errors.ConnectionError)
+    # retried after 0.2 seconds, but not after another 0.4
+    assert len(timeouts) == 2
+    assert all(timeout <= 0.5 for timeout in timeouts)
+
+
+def test_call_async_does_not_wait():
+    upstreams = Upstreams(initial_limit=1, queue_timeout=10)
+
+    async def run():
+        async with upstreams.call_async('commons.wikimedia.org', 30):
+            start = time.perf_counter()
+            with pytest.raises(Overloaded):
+                async with upstreams.call_async('commons.wikimedia.org', 30):
+                    pytest.fail('call not refused')
+            assert time.perf_counter() - start < 1
+        async with upstreams.call_async('commons.wikimedia.org',
+                                        30,
+                                        time.monotonic() + 5) as timeout:
+            assert timeout <= 5
+
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+import gzip
+from markupsafe import Markup
+import zlib
+
+from page_cache import CachedPage, PageCache, PageCompressor, \
+    _crc32_shift, _gf2_times
+
+
+def test_cached_page_gzip():
+    html = '<p>%s</p><input value="secret">\n</html>' % ('x' * 10_000)
+    page = CachedPage.compress(html, 'secret')
+    assert page is not None
+    assert len(page.head) + len(page.tail) < 1000
+    assert gzip.decompress(page.gzip('secret')).decode('utf-8') == html
+    assert gzip.decompress(page.gzip('other')).decode('utf-8') \
+        == html.replace('secret', 'other')
+
+
+def test_cached_page_gzip_secret_in_the_middle():
+    html = '%s<input value="secret">%s' % ('a' * 5_000, 'ü' * 70_000)
+    page = CachedPage.compress(html, 'secret')
+    assert page is not None
+    assert gzip.decompress(page.gzip('other')).decode('utf-8') \
+        == html.replace('secret', 'other')
+    # the whole tail is cached compressed
+    assert len(page.tail) < 1000
+
+
+def test_page_compressor():
+    html = '<p>%s</p><input value="secret">%s' % ('ä' * 5_000, 'x' * 5_000)
+    # in chunks of all sizes, also splitting the secret
+    for size in [1, 3, 7, 100, len(html)]:
+        compressor = PageCompressor('secret')
+        for i in range(0, len(html), size):
+            compressor.write(html[i:i + size])
+        page = compressor.close()
+        assert page is not None
+        assert gzip.decompress(page.gzip('other')).decode('utf-8') \
+            == html.replace('secret', 'other')
+        assert page.digest == CachedPage.compress(html, 'secret').digest
+
+
+def test_page_compressor_markup():
+    compressor = PageCompressor('secret')
+    for chunk in [Markup('<p>'), '<b>secret</b>', Markup('</p>')]:
+        compressor.write(chunk)
+    page = compressor.close()
+    assert page is not None
+    assert page.text('secret') == '<p><b>secret</b></p>'
+
+
+def test_page_compressor_secret_not_once():
+    compressor = PageCompressor('secret')
+    for chunk in ['sec', 'ret sec', 're', 't']:
+        compressor.write(chunk)
+    assert compressor.close() is None
+    compressor = PageCompressor('secret')
+    compressor.write('no secr')
+    assert compressor.close() is None
+
+
+def test_crc32_shift():
+    for a, b in [(b'', b''), (b'head', b''), (b'', b'tail'),
+                 (b'head', b'tail' * 1000)]:
+        assert _gf2_times(_crc32_shift(len(b)), zlib.crc32(a)) \
+            ^ zlib.crc32(b) == zlib.crc32(a + b)
+
+
+def test_cached_page_text():
+    page = CachedPage.compress('<p>ä</p><input value="secret">', 'secret')
+    assert page is not None
+    assert page.text('other') == '<p>ä</p><input value="other">'
+
+
+def test_cached_page_etag():
+    page = CachedPage.compress('<p>A</p>secret', 'secret')
+    other_page = CachedPage.compress('<p>B</p>secret', 'secret')
+    assert page is not None and other_page is not None
+    assert page.etag('secret') == page.etag('secret')
+    assert page.etag('secret') != page.etag('other')
+    assert page.etag('secret') != other_page.etag('secret')
+    assert 'secret' not in page.etag('secret')
+
+
+def test_cached_page_secret_not_once():
+    assert CachedPage.compress('secret secret', 'secret') is None
+    assert CachedPage.compress('no secret here', 'token') is None
+
+
+def test_page_cache():
+    cache = PageCache(max_bytes=2**20, ttl=60)
+    assert cache.get(1) is None
+    page = cache.put(1, '<p>A</p>secret', 'secret')
+    assert cache.get(1) == page
+    assert cache.put(2, 'secret secret', 'secret') is None
+    assert cache.get(2) is None
+
+
+def test_page_cache_too_large():
+    cache = PageCache(max_bytes=10, ttl=60)
+    page = cache.put(1, '<p>A</p>secret', 'secret')
+    assert page is not None
+    assert cache.get(1) is None
@@ -0,0 +1,60 @@
+import pytest
+
+from selection import complement_runs, decode_selection, encode_runs, \
+    encode_selection
+
+
+@pytest.mark.parametrize('indices, selection', [
+    ([], ''),
+    ([5], '5'),
+    ([0, 1, 2, 3, 7, 9, 10], '0-3,7,9-10'),
+    ([10, 9, 3, 3, 2], '2-3,9-10'),
+])
+def test_encode_selection(indices, selection):
+    assert encode_selection(indices) == selection
+
+
+@pytest.mark.parametrize('selection, runs', [
+    ('', []),
+    ('5', [range(5, 6)]),
+    ('0-3,7,9-10', [range(0, 4), range(7, 8), range(9, 11)]),
+])
+def test_decode_selection(selection, runs):
+    assert decode_selection(selection, 11) == runs
+
+
+def test_decode_selection_large():
+    assert decode_selection('0-49999', 50000) == [range(0, 50000)]
+
+
+@pytest.mark.parametrize('selection', [
+    '11',
+    '5-11',
+    '-1',
+    '3-1',
+    '1,,2',
+    'a',
+    '1-b',
+    '4,2',
+    '0-4,4',
+    ' 1',
+])
+def test_decode_selection_invalid(selection):
+    with pytest.raises(ValueError):
+        decode_selection(selection, 11)
+
+
+@pytest.mark.parametrize('runs, size, complement', [
+    ([], 3, [range(0, 3)]),
+    ([range(0, 3)], 3, []),
+    ([range(1, 2), range(4, 6)], 8,
+     [range(0, 1), range(2, 4), range(6, 8)]),
+    ([range(0, 2), range(2, 4)], 4, []),
+])
+def test_complement_runs(runs, size, complement):
+    assert complement_runs(runs, size) == complement
+
+
+def test_encode_runs_roundtrip():
+    selection = '0-3,7,9-10'
+    assert encode_runs(decode_selection(selection, 11)) == selection
@@ -0,0 +1,235 @@
+import asyncio
+import pytest
+import requests
+import threading
+import time
+
+from cache import MemoryCache, RedisCache, SqliteCache
+from fake_upstream import FakeUpstream
+from single_flight import LockStore, RedisLockStore, SingleFlight, \
+    SqliteLockStore, make_lock_store
+
+from test_utils import FakeRedis
+
+
+def burst(function, count=10):
+    """Call the function in count threads at once, return the results.
+
+    The function is called with the index of the thread.
+    """
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(index):
+        barrier.wait()
+        results[index] = function(index)
+
+    threads = [threading.Thread(target=run, args=(index,))
+               for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_run_coalesces_concurrent_calls():
+    single_flight = SingleFlight()
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'value'
+
+    results = burst(lambda index: single_flight.run('key', load))
+
+    assert results == ['value'] * 10
+    assert calls == [1]
+
+
+def test_run_different_keys():
+    single_flight = SingleFlight()
+    results = burst(lambda index: single_flight.run(str(index),
+                                                    lambda: index))
+    assert results == list(range(10))
+
+
+def test_run_sequential_calls():
+    single_flight = SingleFlight()
+    calls = []
+
+    def load():
+        calls.append(1)
+        return len(calls)
+
+    assert single_flight.run('key', load) == 1
+    assert single_flight.run('key', load) == 2
+
+
+def test_run_raises_in_all_callers():
+    single_flight = SingleFlight()
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.2)
+        raise ValueError('upstream error')
+
+    def run(index):
+        try:
+            single_flight.run('key', load)
+        except ValueError as e:
+            return str(e)
+
+    assert burst(run) == ['upstream error'] * 10
+    assert calls == [1]
+
+
+def test_run_async_coalesces_concurrent_calls():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return 'value'
+
+    async def run():
+        return await asyncio.gather(*[single_flight.run_async('key', load)
+                                      for _ in range(10)])
+
+    assert asyncio.run(run()) == ['value'] * 10
+    assert calls == [1]
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def lock_store(request, tmp_path):
+    if request.param == 'sqlite':
+        return SqliteLockStore(str(tmp_path / 'cache.sqlite3'))
+    if request.param == 'redis':
+        return RedisLockStore(FakeRedis())
+
+
+def test_lock_store(lock_store):
+    assert lock_store.acquire('key', 'a', 60)
+    assert not lock_store.acquire('key', 'b', 60)
+    lock_store.release('key', 'b')  # not held with this token
+    assert not lock_store.acquire('key', 'b', 60)
+    lock_store.release('key', 'a')
+    assert lock_store.acquire('key', 'b', 60)
+
+
+def test_sqlite_lock_store_expiry(tmp_path):
+    lock_store = SqliteLockStore(str(tmp_path / 'cache.sqlite3'))
+    assert lock_store.acquire('key', 'a', 0.1)
+    time.sleep(0.2)
+    assert lock_store.acquire('key', 'b', 60)
+
+
+def test_make_lock_store(tmp_path):
+    assert make_lock_store(MemoryCache(maxsize=10, ttl=60)) is None
+    sqlite = make_lock_store(SqliteCache(str(tmp_path / 'cache.sqlite3'),
+                                         maxsize=10,
+                                         ttl=60))
+    assert isinstance(sqlite, SqliteLockStore)
+    redis = make_lock_store(RedisCache(FakeRedis(), ttl=60, prefix='p:'))
+    assert isinstance(redis, RedisLockStore)
+    assert redis.prefix == 'p:lock:'
+
+
+def test_run_shared_between_processes(lock_store):
+    # two instances stand in for two worker processes
+    workers = [SingleFlight(lock_store, poll_interval=0.01)
+               for _ in range(2)]
+    shared = {}
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.2)
+        shared['key'] = 'value'
+        return 'value'
+
+    results = burst(lambda index: workers[index % 2].run(
+        'key', load, lambda: shared.get('key')))
+
+    assert results == ['value'] * 10
+    assert calls == [1]
+
+
+def test_run_shared_lock_expired(tmp_path):
+    lock_store = SqliteLockStore(str(tmp_path / 'cache.sqlite3'))
+    # held by a process that died
+    lock_store.acquire('key', 'other', 0.2)
+    single_flight = SingleFlight(lock_store, poll_interval=0.01)
+
+    start = time.perf_counter()
+    assert single_flight.run('key', lambda: 'value') == 'value'
+    assert 0.2 <= time.perf_counter() - start < 1
+
+
+def test_run_shared_lock_wait_ends_at_deadline(tmp_path):
+    lock_store = SqliteLockStore(str(tmp_path / 'cache.sqlite3'))
+    lock_store.acquire('key', 'other', 60)
+    single_flight = SingleFlight(lock_store, lock_ttl=60, poll_interval=0.01)
+
+    start = time.perf_counter()
+    assert single_flight.run('key',
+                             lambda: 'value',
+                             deadline=time.monotonic() + 0.2) == 'value'
+    assert 0.2 <= time.perf_counter() - start < 1
+
+
+def test_run_load_error_after_wait(tmp_path):
+    lock_store = SqliteLockStore(str(tmp_path / 'cache.sqlite3'))
+    # held by a process that seems to be stuck
+    lock_store.acquire('key', 'other', 60)
+    single_flight = SingleFlight(lock_store, lock_ttl=0.1, poll_interval=0.01)
+    calls = []
+
+    def load():
+        calls.append(1)
+        raise ValueError('load failed')
+
+    with pytest.raises(ValueError):
+        single_flight.run('key', load)
+    assert calls == [1]
+
+
+def test_run_lock_store_error():
+    class BrokenLockStore(LockStore):
+        def acquire(self, key, token, ttl):
+            raise OSError('disk full')
+
+    single_flight = SingleFlight(BrokenLockStore())
+    assert single_flight.run('key', lambda: 'value') == 'value'
+
+
+def test_burst_against_fake_upstream(tmp_path):
+    # a burst of requests for the same pile, split over two "workers"
+    # sharing an SQLite cache, results in a single upstream request
+    path = str(tmp_path / 'cache.sqlite3')
+    cache = SqliteCache(path, maxsize=100, ttl=60)
+    workers = [SingleFlight(SqliteLockStore(path), poll_interval=0.01)
+               for _ in range(2)]
+    with FakeUpstream(latency=0.2) as fake:
+
+        def load():
+            response = requests.get(fake.pagepile_api_url,
+                                    params={'action': 'get_data', 'id': 30})
+            pages = response.json()['pages']
+            cache.set('pile:30', pages)
+            return pages
+
+        def view(index):
+            pages = cache.get('pile:30')
+            if pages is not None:
+                return pages
+            return workers[index % 2].run(
+                'pile:30', load, lambda: cache.get('pile:30'))
+
+        results = burst(view, count=20)
+
+    assert all(len(pages) == 30 for pages in results)
+    assert fake.counts['get_data'] == 1
@@ -1,8 +1,11 @@
+import json
 import mwapi  # type: ignore
 import pytest
+import time
 
-from sitematrix import dbname_to_domain, domain_to_dbname, \
-    _sitematrix_cache, _sitematrix_cache_lock
+import sitematrix
+from sitematrix import Capabilities, capabilities, dbname_to_domain, \
+    domain_to_dbname, _sitematrix_cache, _sitematrix_cache_lock
 
 from test_utils import FakeSession, user_agent
 
@@ -12,13 +15,14 @@ def clean_sitematrix():
     with _sitematrix_cache_lock:
         _sitematrix_cache.clear()
     yield
+    wait_for_refresh()
     with _sitematrix_cache_lock:
         _sitematrix_cache.clear()
 
 
 fake_session = FakeSession({
     'sitematrix': {
-        'count': 4,
+        'count': 5,
         '0': {
             'code': 'en',
             'name': 'English',
@@ -61,6 +65,14 @@ fake_session = FakeSession({
                 'lang': 'wikidata',
                 'sitename': 'Wikipedia',
             },
+            {
+                'url': 'https://office.wikimedia.org',
+                'dbname': 'officewiki',
+                'code': 'office',
+                'lang': 'office',
+                'sitename': 'Wikimedia Office',
+                'private': True,
+            },
         ],
     },
 })
@@ -132,3 +144,111 @@ def test_domain_to_dbname_real_session(internet_connection):
     assert domain_to_dbname(session, 'en.wiktionary.org') == 'enwiktionary'
     assert domain_to_dbname(session, 'pt.wikipedia.org') == 'ptwiki'
     assert domain_to_dbname(session, 'www.wikidata.org') == 'wikidatawiki'
+
+
+def wait_for_refresh():
+    thread = sitematrix._refresh_thread
+    if thread is not None:
+        thread.join(timeout=5)
+
+
+def test_stale_sitematrix_served_while_refreshing():
+    stale = {
+        'by_dbname': {'enwiki': {'url': 'https://old.wikipedia.org',
+                                 'dbname': 'enwiki'}},
+        'by_url': {},
+    }
+    with _sitematrix_cache_lock:
+        _sitematrix_cache['#sitematrix'] = (time.time() - sitematrix.ttl - 1,
+                                            stale)
+
+    assert dbname_to_domain(fake_session, 'enwiki') == 'old.wikipedia.org'
+    wait_for_refresh()
+    assert dbname_to_domain(fake_session, 'enwiki') == 'en.wikipedia.org'
+
+
+def test_stale_sitematrix_kept_if_refresh_fails():
+    class FailingSession:
+        def get(self, *args, **kwargs):
+            raise mwapi.errors.ConnectionError('no connection')
+
+    stale = {
+        'by_dbname': {'enwiki': {'url': 'https://old.wikipedia.org',
+                                 'dbname': 'enwiki'}},
+        'by_url': {},
+    }
+    with _sitematrix_cache_lock:
+        _sitematrix_cache['#sitematrix'] = (time.time() - sitematrix.ttl - 1,
+                                            stale)
+
+    assert dbname_to_domain(FailingSession(), 'enwiki') == 'old.wikipedia.org'
+    wait_for_refresh()
+    assert dbname_to_domain(FailingSession(), 'enwiki') == 'old.wikipedia.org'
+
+
+def test_fresh_sitematrix_not_refreshed():
+    dbname_to_domain(fake_session, 'enwiki')
+    thread = sitematrix._refresh_thread
+    dbname_to_domain(fake_session, 'enwiki')
+    assert sitematrix._refresh_thread is thread
+
+
+def test_persisted_sitematrix(tmp_path, monkeypatch):
+    path = str(tmp_path / 'sitematrix.json')
+    monkeypatch.setattr(sitematrix, 'persist_path', path)
+
+    assert dbname_to_domain(fake_session, 'enwiki') == 'en.wikipedia.org'
+    with open(path) as f:
+        assert 'enwiki' in json.load(f)['sitematrix']['by_dbname']
+
+    # a new worker (empty memory cache) starts from the file
+    with _sitematrix_cache_lock:
+        _sitematrix_cache.clear()
+    assert dbname_to_domain(FakeSession(None), 'enwiki') == 'en.wikipedia.org'
+
+
+def test_persisted_sitematrix_without_capabilities(tmp_path, monkeypatch):
+    path = tmp_path / 'sitematrix.json'
+    site = {'url': 'https://en.wikipedia.org', 'dbname': 'enwiki'}
+    path.write_text(json.dumps({
+        'fetched': time.time(),
+        'sitematrix': {'by_dbname': {'enwiki': site},
+                       'by_url': {'https://en.wikipedia.org': site}},
+    }))
+    monkeypatch.setattr(sitematrix, 'persist_path', str(path))
+
+    assert capabilities(FakeSession(None), 'en.wikipedia.org').supported
+
+
+def test_capabilities():
+    assert capabilities(fake_session, 'en.wikipedia.org') \
+        == Capabilities('enwiki', 'en.wikipedia.org', False, False)
+    # precomputed, no further requests
+    session = FakeSession(None)
+    assert capabilities(session, 'en.wikipedia.org').supported
+    assert capabilities(session, 'www.wikidata.org').dbname == 'wikidatawiki'
+    office = capabilities(session, 'office.wikimedia.org')
+    assert office.private
+    assert not office.supported
+    assert capabilities(session, 'example.org') is None
+
+
+def test_warm_up():
+    sitematrix.warm_up(fake_session)
+    assert dbname_to_domain(FakeSession(None), 'enwiki') == 'en.wikipedia.org'
+
+
+def test_warm_up_refreshes_stale_sitematrix_synchronously():
+    with _sitematrix_cache_lock:
+        _sitematrix_cache['#sitematrix'] = (time.time() - sitematrix.ttl - 1,
+                                            {'by_dbname': {}, 'by_url': {}})
+    sitematrix.warm_up(fake_session)
+    assert sitematrix._refresh_thread is None \
+        or not sitematrix._refresh_thread.is_alive()
+    assert dbname_to_domain(FakeSession(None), 'enwiki') == 'en.wikipedia.org'
+
+
+def test_warm_up_keeps_fresh_sitematrix():
+    dbname_to_domain(fake_session, 'enwiki')
+    sitematrix.warm_up(FakeSession(None))
+    assert dbname_to_domain(FakeSession(None), 'enwiki') == 'en.wikipedia.org'
@@ -0,0 +1,291 @@
+import os
+import pytest
+import requests
+import threading
+import time
+
+from thumbnails import ThumbnailCache, ThumbnailProxy, TokenBucket, \
+    is_thumbnail_url
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, content=b'',
+                 content_type='image/jpeg'):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {'Content-Type': content_type,
+                        'Content-Length': str(len(content))}
+        self.read = 0
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            chunk = self.content[i:i + chunk_size]
+            self.read += len(chunk)
+            yield chunk
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(response=self)
+
+
+class FakeHttpSession:
+
+    def __init__(self, status_code=200, response=None):
+        self.status_code = status_code
+        self.response = response
+        self.urls = []
+        self.lock = threading.Lock()
+
+    def get(self, url, headers, timeout, stream=False):
+        assert stream
+        with self.lock:
+            self.urls.append(url)
+        if self.response is not None:
+            return self.response
+        return FakeResponse(self.status_code, b'thumbnail of ' + url.encode())
+
+
+def thumb_url(width):
+    return 'https://upload.wikimedia.org/wikipedia/commons/thumb/a/ab/' \
+        'A.jpg/%dpx-A.jpg' % width
+
+
+URL = thumb_url(250)
+
+
+@pytest.mark.parametrize('url', [
+    URL,
+    'https://upload.wikimedia.org/wikipedia/de/thumb/a/ab/A.pdf/'
+    'page1-250px-A.pdf.jpg',
+])
+def test_is_thumbnail_url(url):
+    assert is_thumbnail_url(url)
+
+
+@pytest.mark.parametrize('url', [
+    'https://upload.wikimedia.org/wikipedia/commons/a/ab/A.jpg',
+    'https://upload.wikimedia.org/wikipedia/commons/a/ab/A.webm',
+    URL + '?download',
+    'https://example.com/wikipedia/commons/thumb/a/ab/A.jpg/250px-A.jpg',
+])
+def test_is_not_thumbnail_url(url):
+    assert not is_thumbnail_url(url)
+
+
+def test_token_bucket_burst_then_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, burst=3, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        assert bucket.acquire()
+    assert clock.now == 0
+    assert bucket.acquire()
+    assert clock.now == pytest.approx(0.1)
+
+
+def test_token_bucket_timeout():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, burst=1, clock=clock, sleep=clock.sleep)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0.5)
+    assert bucket.acquire(timeout=1)
+
+
+def test_thumbnail_cache(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), max_bytes=1000)
+    assert cache.get(URL) is None
+    assert URL not in cache
+    cache.put(URL, b'data')
+    assert URL in cache
+    assert cache.get(URL) == b'data'
+
+
+def test_thumbnail_cache_lru_eviction(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), max_bytes=350)
+    for i in range(3):
+        cache.put('%s?%d' % (URL, i), b'x' * 100)
+        # make sure the modification times differ
+        os.utime(cache._path('%s?%d' % (URL, i)), (i, i))
+    os.utime(cache._path(URL + '?0'), (10, 10))  # recently used
+    cache.put(URL + '?3', b'x' * 100)
+    assert URL + '?0' in cache
+    assert URL + '?1' not in cache
+    assert URL + '?2' in cache
+    assert URL + '?3' in cache
+
+
+def test_thumbnail_proxy_caches(tmp_path):
+    session = FakeHttpSession()
+    proxy = ThumbnailProxy(session,
+                           'test',
+                           ThumbnailCache(str(tmp_path), max_bytes=10_000),
+                           TokenBucket(rate=100, burst=10))
+    assert proxy.get(URL, timeout=1) \
+        == (200, b'thumbnail of ' + URL.encode(), 'image/jpeg')
+    assert proxy.get(URL, timeout=1) \
+        == (200, b'thumbnail of ' + URL.encode(), 'image/jpeg')
+    assert session.urls == [URL]
+
+
+def test_thumbnail_proxy_upstream_error(tmp_path):
+    proxy = ThumbnailProxy(FakeHttpSession(status_code=404),
+                           'test',
+                           ThumbnailCache(str(tmp_path), max_bytes=10_000),
+                           TokenBucket(rate=100, burst=10))
+    assert proxy.get(URL, timeout=1) == (404, b'', None)
+    assert URL not in proxy.cache
+
+
+@pytest.mark.parametrize('status_code', [429, 500, 503])
+def test_thumbnail_proxy_upstream_unavailable(tmp_path, status_code):
+    session = FakeHttpSession(status_code=status_code)
+    proxy = ThumbnailProxy(session,
+                           'test',
+                           ThumbnailCache(str(tmp_path), max_bytes=10_000),
+                           TokenBucket(rate=100, burst=10))
+    assert proxy.get(URL, timeout=1) == (503, b'', None)
+    assert session.urls == [URL]
+    assert URL not in proxy.cache
+
+
+def test_thumbnail_proxy_rate_limited(tmp_path):
+    clock = FakeClock()
+    proxy = ThumbnailProxy(FakeHttpSession(),
+                           'test',
+                           ThumbnailCache(str(tmp_path), max_bytes=10_000),
+                           TokenBucket(rate=1, burst=1,
+                                       clock=clock, sleep=clock.sleep))
+    assert proxy.get(thumb_url(1), timeout=0)[0] == 200
+    assert proxy.get(thumb_url(2), timeout=0)[0] == 503
+
+
+def test_thumbnail_proxy_rejects_other_hosts(tmp_path):
+    proxy = ThumbnailProxy(FakeHttpSession(),
+                           'test',
+                           ThumbnailCache(str(tmp_path), max_bytes=10_000),
+                           TokenBucket(rate=100, burst=10))
+    with pytest.raises(ValueError):
+        proxy.get('https://example.com/upload.wikimedia.org/', timeout=1)
+    with pytest.raises(ValueError):
+        proxy.get('https://upload.wikimedia.org/wikipedia/commons/a/ab/A.jpg',
+                  timeout=1)
+
+
+def test_thumbnail_proxy_rejects_non_images(tmp_path):
+    proxy = ThumbnailProxy(FakeHttpSession(response=FakeResponse(
+                               200, b'<html>', 'text/html')),
+                           'test',
+                           ThumbnailCache(str(tmp_path), max_bytes=10_000),
+                           TokenBucket(rate=100, burst=10))
+    assert proxy.get(URL, timeout=1) == (502, b'', None)
+    assert URL not in proxy.cache
+
+
+def test_thumbnail_proxy_rejects_large_thumbnails(tmp_path):
+    response = FakeResponse(200, b'x' * 2**20)
+    del response.headers['Content-Length']
+    proxy = ThumbnailProxy(FakeHttpSession(response=response),
+                           'test',
+                           ThumbnailCache(str(tmp_path), max_bytes=10_000),
+                           TokenBucket(rate=100, burst=10),
+                           max_size=2**17)
+    assert proxy.get(URL, timeout=1) == (502, b'', None)
+    assert URL not in proxy.cache
+    # the rest of the body is not read
+    assert response.read <= 2**17 + 2**16
+    # or none of it, if the length is known
+    response = FakeResponse(200, b'x' * 2**20)
+    proxy.session = FakeHttpSession(response=response)
+    assert proxy.get(URL, timeout=1) == (502, b'', None)
+    assert response.read == 0
+
+
+def test_thumbnail_proxy_prefetch(tmp_path):
+    session = FakeHttpSession()
+    proxy = ThumbnailProxy(session,
+                           'test',
+                           ThumbnailCache(str(tmp_path), max_bytes=10_000),
+                           TokenBucket(rate=1000, burst=100))
+    urls = [thumb_url(i) for i in range(5)]
+    assert proxy.prefetch(iter(urls + ['https://example.com/']))
+    deadline = time.monotonic() + 5
+    while not all(url in proxy.cache for url in urls):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert session.urls == urls
+
+
+def test_thumbnail_proxy_prefetch_bounded(tmp_path):
+    proxy = ThumbnailProxy(FakeHttpSession(),
+                           'test',
+                           ThumbnailCache(str(tmp_path), max_bytes=10_000),
+                           TokenBucket(rate=1000, burst=100),
+                           prefetch_workers=1,
+                           max_pending_prefetches=1)
+    release = threading.Event()
+
+    def blocked_urls():
+        release.wait(timeout=5)
+        yield URL
+
+    assert proxy.prefetch(blocked_urls())
+    assert proxy.prefetch([thumb_url(1)])
+    assert not proxy.prefetch([thumb_url(2)])
+    release.set()
+    deadline = time.monotonic() + 5
+    while thumb_url(1) not in proxy.cache:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert proxy.prefetch([thumb_url(2)])
+
+
+class BlockingHttpSession(FakeHttpSession):
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def get(self, url, headers, timeout, stream=False):
+        assert self.release.wait(timeout=5)
+        return super().get(url, headers, timeout, stream)
+
+
+def test_thumbnail_proxy_shares_fetches(tmp_path):
+    session = BlockingHttpSession()
+    proxy = ThumbnailProxy(session,
+                           'test',
+                           ThumbnailCache(str(tmp_path), max_bytes=10_000),
+                           TokenBucket(rate=1000, burst=100))
+    assert proxy.prefetch([URL])
+    deadline = time.monotonic() + 5
+    while URL not in proxy._fetches:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    # the browser's request times out waiting for the prefetch ...
+    assert proxy.get(URL, timeout=0.05) == (503, b'', None)
+    threading.Timer(0.05, session.release.set).start()
+    # ... or gets its result
+    assert proxy.get(URL, timeout=5) \
+        == (200, b'thumbnail of ' + URL.encode(), 'image/jpeg')
+    assert session.urls == [URL]
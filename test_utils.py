@@ -10,9 +10,12 @@ class FakeSession:
         self.get_response = get_response
         self.post_response = post_response
         self.host = None
+        self.timeout = 30
         self.session = requests.Session()
 
     def get(self, *args, **kwargs):
+        if callable(self.get_response):
+            return self.get_response(*args, **kwargs)
         return self.get_response
 
     def post(self, *args, **kwargs):
@@ -23,3 +26,25 @@ class FakeSession:
                 return self.post_response
         else:
             raise NotImplementedError
+
+
+class FakeRedis:
+    """A local stand-in for a Redis client, supporting just what we need."""
+
+    def __init__(self):
+        self.data = {}
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value.encode('utf-8')
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
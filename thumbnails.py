@@ -0,0 +1,303 @@
+"""Server-side proxy for thumbnails from upload.wikimedia.org.
+
+Thumbor only queues a limited number of requests per client
+(see static/reload-images.js), so instead of letting every browser
+run into 429 errors on its own, the proxy paces all requests of a worker
+with a token bucket and keeps the thumbnails in a size-bounded
+on-disk cache, shared by all the workers using the same directory.
+"""
+
+import concurrent.futures
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import requests
+import threading
+import time
+from typing import Callable, Iterable, Optional, Tuple
+
+from http_session import raise_if_unavailable
+
+
+UPLOAD_PREFIX = 'https://upload.wikimedia.org/'
+
+# thumbnails rendered by Thumbor, as in the thumburl and responsiveUrls
+# of imageinfo, e.g. .../wikipedia/commons/thumb/a/ab/A.jpg/250px-A.jpg
+# (or .../page1-250px-A.pdf.jpg); originals (which imageinfo returns
+# for files smaller than the thumbnail) do not go through Thumbor
+# and can be arbitrarily large, so they are not proxied
+_THUMBNAIL_URL = re.compile(re.escape(UPLOAD_PREFIX)
+                            + r'[^/?#]+/[^/?#]+/thumb/[^?#]+/'
+                            r'[^/?#]*[0-9]+px-[^/?#]+')
+
+_logger = logging.getLogger(__name__)
+
+
+def is_thumbnail_url(url: str) -> bool:
+    """Whether the URL is a thumbnail on upload.wikimedia.org."""
+    return _THUMBNAIL_URL.fullmatch(url) is not None
+
+
+class TokenBucket:
+    """A token bucket rate limiter.
+
+    Tokens are added at the given rate (per second),
+    up to the burst size; each acquire() takes one token.
+    """
+
+    def __init__(self,
+                 rate: float,
+                 burst: int,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Take a token, waiting up to timeout seconds for one.
+
+        Returns False if no token became available in time.
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.burst,
+                                   self._tokens
+                                   + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            self._sleep(wait)
+
+
+class ThumbnailCache:
+    """A size-bounded on-disk cache of thumbnails, keyed by URL.
+
+    Reading a thumbnail updates its modification time,
+    and the least recently used thumbnails are evicted
+    once the total size exceeds max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory,
+                            hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def __contains__(self, url: str) -> bool:
+        return os.path.exists(self._path(url))
+
+    def get(self, url: str) -> Optional[bytes]:
+        path = self._path(url)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def put(self, url: str, data: bytes) -> None:
+        path = self._path(url)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _scan(self) -> Tuple[list[Tuple[float, int, str]], int]:
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries, sum(size for mtime, size, path in entries)
+
+    def _evict(self) -> None:
+        # evict down to 90% of the limit so we don't scan on every put;
+        # other workers may have written files too, hence the rescan
+        entries, size = self._scan()
+        for mtime, file_size, path in sorted(entries):
+            if size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= file_size
+        self._size = size
+
+
+class ThumbnailProxy:
+    """Fetches thumbnails from upload.wikimedia.org, through the cache.
+
+    Concurrent requests for the same thumbnail (e.g. from a browser
+    and from a prefetch) share one request to upload.wikimedia.org.
+    The session should not retry requests (see make_upstream_session):
+    each request takes a token from the bucket, and responses meaning
+    that Thumbor is overloaded (429 or 5xx) are reported as 503.
+    Only thumbnails (see is_thumbnail_url()) are proxied, and responses
+    that are not images or larger than max_size bytes are rejected (502).
+    Prefetches run in the background, one batch of URLs (e.g. the next
+    window of a pile) per worker thread; up to max_pending_prefetches
+    further batches wait, and any more are dropped.
+    """
+
+    def __init__(self,
+                 session: requests.Session,
+                 user_agent: str,
+                 cache: ThumbnailCache,
+                 bucket: TokenBucket,
+                 max_size: int = 2**22,
+                 prefetch_workers: int = 2,
+                 max_pending_prefetches: int = 8):
+        self.session = session
+        self.user_agent = user_agent
+        self.cache = cache
+        self.bucket = bucket
+        self.max_size = max_size
+        self._prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+            prefetch_workers, thread_name_prefix='thumbnail-prefetch')
+        self._prefetch_slots = threading.BoundedSemaphore(
+            prefetch_workers + max_pending_prefetches)
+        self._fetches: dict[str, concurrent.futures.Future] = {}
+        self._fetches_lock = threading.Lock()
+
+    def get(self,
+            url: str,
+            timeout: Optional[float]) -> Tuple[int, bytes, Optional[str]]:
+        """Get a thumbnail, from the cache or from upload.wikimedia.org.
+
+        Returns the HTTP status, the body and the content type.
+        If no request to upload.wikimedia.org can be made within the
+        timeout (in seconds), the status is 503.
+        """
+        if not is_thumbnail_url(url):
+            raise ValueError('Not a thumbnail URL: %r' % url)
+        content_type = mimetypes.guess_type(url)[0]
+        data = self.cache.get(url)
+        if data is not None:
+            return 200, data, content_type
+        with self._fetches_lock:
+            fetch = self._fetches.get(url)
+            leader = fetch is None
+            if fetch is None:
+                fetch = self._fetches[url] = concurrent.futures.Future()
+        if not leader:
+            try:
+                return fetch.result(timeout)
+            except concurrent.futures.TimeoutError:
+                return 503, b'', None
+        try:
+            result = self._fetch(url, timeout, content_type)
+        except BaseException as e:
+            fetch.set_exception(e)
+            raise
+        else:
+            fetch.set_result(result)
+            return result
+        finally:
+            with self._fetches_lock:
+                del self._fetches[url]
+
+    def _fetch(self,
+               url: str,
+               timeout: Optional[float],
+               content_type: Optional[str],
+               ) -> Tuple[int, bytes, Optional[str]]:
+        # one token per request: the session must not retry on its own
+        # (see make_upstream_session), and neither do we - the browser
+        # retries later (see static/reload-images.js), with a new token
+        if not self.bucket.acquire(timeout=timeout):
+            return 503, b'', None
+        try:
+            r = self.session.get(url,
+                                 headers={'User-Agent': self.user_agent},
+                                 timeout=30,
+                                 stream=True)
+            raise_if_unavailable(r)
+        except requests.HTTPError:
+            return 503, b'', None
+        with r:
+            if r.status_code != 200:
+                return r.status_code, b'', None
+            content_type = r.headers.get('Content-Type', content_type)
+            if content_type is None or not content_type.startswith('image/'):
+                _logger.warning('Not an image: %s (%s)', url, content_type)
+                return 502, b'', None
+            data = self._read(r)
+            if data is None:
+                _logger.warning('Thumbnail too large: %s', url)
+                return 502, b'', None
+        self.cache.put(url, data)
+        return 200, data, content_type
+
+    def _read(self, r: requests.Response) -> Optional[bytes]:
+        # the body, or None if it is larger than max_size
+        length = r.headers.get('Content-Length', '')
+        if length.isdigit() and int(length) > self.max_size:
+            return None
+        chunks = []
+        size = 0
+        for chunk in r.iter_content(2**16):
+            size += len(chunk)
+            if size > self.max_size:
+                return None
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def prefetch(self, urls: Iterable[str]) -> bool:
+        """Fetch the given thumbnails into the cache in the background.
+
+        The URLs are iterated in the background too,
+        so they can be produced lazily (e.g. while loading imageinfo).
+        Returns False if too many prefetches are pending already,
+        in which case the thumbnails are not prefetched.
+        """
+        if not self._prefetch_slots.acquire(blocking=False):
+            return False
+        self._prefetch_executor.submit(self._prefetch, urls)
+        return True
+
+    def _prefetch(self, urls: Iterable[str]) -> None:
+        try:
+            for url in urls:
+                if not is_thumbnail_url(url) or url in self.cache:
+                    continue
+                try:
+                    self.get(url, timeout=None)
+                except Exception:
+                    _logger.warning('Could not prefetch %s', url,
+                                    exc_info=True)
+        except Exception:
+            _logger.warning('Could not prefetch thumbnails', exc_info=True)
+        finally:
+            self._prefetch_slots.release()